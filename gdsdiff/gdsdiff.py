@@ -29,11 +29,12 @@ def get_polygons_on_layer(cell, layer):
         return None
 
 
-def gdsdiff(cellA, cellB):
+def gdsdiff(cellA, cellB, cellname=None):
     """
     Args:
         CellA: gds cell (as pp.Component) or path to gds file
         CellB: gds cell (as pp.Component) or path to gds file
+        cellname: only compares this cell of the GDS files (None for top cell)
 
     Output:
         gds file containing the diff between the two GDS files
@@ -43,9 +44,9 @@ def gdsdiff(cellA, cellB):
     if isinstance(cellB, pathlib.PosixPath):
         cellB = str(cellB)
     if type(cellA) == str:
-        cellA = import_gds(cellA, flatten=True)
+        cellA = import_gds(cellA, cellname=cellname, flatten=True)
     if type(cellB) == str:
-        cellB = import_gds(cellB, flatten=True)
+        cellB = import_gds(cellB, cellname=cellname, flatten=True)
 
     layers = set()
     layers.update(get_gds_layers(cellA))
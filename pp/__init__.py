@@ -12,13 +12,15 @@ classes:
     - pp.Port
     - CONFIG
 
-modules:
+modules (imported the first time they are used):
 
     - c: components
     - routing
     - layer: GDS layers
 """
-from phidl import quickplot as qp
+import importlib
+import sys
+
 import phidl.geometry as pg
 
 # NOTE: import order matters. Only change the order if you know what you are doing
@@ -37,19 +39,10 @@ from pp.write_component import write_component_type
 from pp.write_component import write_component
 from pp.write_doe import write_doe
 
-import pp.components as c
-import pp.routing as routing
-import pp.bias as bias
-import pp.klive as klive
-import pp.sp as sp
 import pp.port as port
-import pp.units as units
 
 from pp.component_from_yaml import component_from_yaml
 
-from pp.components import component_factory
-from pp.components.extension import extend_port
-from pp.components.extension import extend_ports
 from pp.add_padding import add_padding
 from pp.add_pins import add_pins
 from pp.import_gds import import_gds
@@ -58,6 +51,44 @@ from pp.plotgds import plotgds
 from pp.pack import pack
 from pp.boolean import boolean
 
+# name: (module, attribute), imported the first time pp.name is used
+# (the module itself when attribute is None)
+_lazy_imports = {
+    "c": ("pp.components", None),
+    "routing": ("pp.routing", None),
+    "sp": ("pp.sp", None),
+    "klive": ("pp.klive", None),
+    "bias": ("pp.bias", None),
+    "units": ("pp.units", None),
+    "component_factory": ("pp.components", "component_factory"),
+    "extend_port": ("pp.components.extension", "extend_port"),
+    "extend_ports": ("pp.components.extension", "extend_ports"),
+    "qp": ("phidl", "quickplot"),
+}
+
+
+def _import_lazy(name):
+    module_name, attribute = _lazy_imports[name]
+    value = importlib.import_module(module_name)
+    if attribute:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name in _lazy_imports:
+            return _import_lazy(name)
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    def __dir__():
+        return sorted(set(globals()) | set(_lazy_imports))
+else:  # no module __getattr__ (PEP 562)
+    for _name in _lazy_imports:
+        _import_lazy(_name)
+
 
 __all__ = [
     "CONFIG",
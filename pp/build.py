@@ -1,15 +1,24 @@
 from glob import glob
+import io
 import itertools
 from subprocess import Popen, PIPE, check_call
 import os
+import pathlib
 import sys
+import tempfile
 from multiprocessing import Pool
 import multiprocessing
 import shutil
 
 import time
 import re
+import runpy
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
 
+from pp.build_profile import OUTPUTS_ENV, BuildProfile, communicate
+from pp.build_profile import get_outputs_stats
+from pp.cache import NAME_TO_DEVICE
 from pp.components import component_type2factory
 from pp.config import CONFIG
 from pp.config import logging
@@ -18,14 +27,26 @@ from pp.doe import load_does
 
 def run_python(filename):
     """ Run a python script and keep track of some context """
+    filename, returncode, _ = run_python_profile(filename)
+    return filename, returncode
+
+
+def run_python_profile(filename):
+    """ Run a python script and returns its return code and profile
+    (seconds, peak memory, polygons and size of the GDS files it writes)
+    """
     logging.debug("Running `{}`.".format(filename))
     command = ["python", filename]
 
     # Run the process
-    t = time.time()
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, _ = process.communicate()
-    total_time = time.time() - t
+    with tempfile.NamedTemporaryFile(suffix=".outputs") as outputs:
+        env = dict(os.environ, **{OUTPUTS_ENV: outputs.name})
+        t = time.time()
+        process = Popen(command, stdout=PIPE, stderr=PIPE, env=env)
+        stdout, _, max_rss_mb = communicate(process)
+        total_time = time.time() - t
+        paths = pathlib.Path(outputs.name).read_text().split()
+
     if process.returncode == 0:
         logging.info("v {} ({:.1f}s)".format(os.path.relpath(filename), total_time))
     else:
@@ -36,11 +57,104 @@ def run_python(filename):
         # logging.error(message, exc_info=(Exception, stderr.strip(), None))
     if len(stdout.decode().strip()) > 0:
         logging.debug("Output of python {}:\n{}".format(filename, stdout.strip()))
-    return filename, process.returncode
+    profile = dict(seconds=total_time, max_rss_mb=max_rss_mb, **get_outputs_stats(paths))
+    return filename, process.returncode, profile
+
+
+def _init_warm_worker():
+    """ imports pp once per worker (already imported when the worker is forked) """
+    import pp  # noqa: F401
 
 
-def build_devices(regex=".*", overwrite=True):
-    """ Builds all the python files in devices/ """
+def _get_exit_code(exception):
+    """ returns the return code of `python file.py` that raised SystemExit """
+    if exception.code is None:
+        return 0
+    if isinstance(exception.code, int):
+        return exception.code
+    print(exception.code, file=sys.stderr)
+    return 1
+
+
+def run_python_warm(filename):
+    """ Run a python script as __main__ in this process (runpy)
+    and returns its return code and profile, like run_python_profile
+
+    Each script runs in a new module namespace, with an empty component cache
+    (restored after the script runs) and its own sys.argv and outputs file.
+    The modules that the script imports from its directory (or devices/) are
+    removed after it runs, other modules (pp, numpy ...) stay imported for the
+    next script.
+    max_rss_mb is None: the peak memory of a worker covers all the scripts
+    it ran so far, not this one.
+    """
+    logging.debug("Running `{}` in a warm worker.".format(filename))
+    dirname = os.path.dirname(os.path.abspath(filename))
+    local_dirs = [dirname + os.sep]
+    if CONFIG.get("devices_directory"):
+        local_dirs.append(os.path.abspath(CONFIG["devices_directory"]) + os.sep)
+    modules_before = set(sys.modules)
+    argv, path, cwd = sys.argv, sys.path, os.getcwd()
+    outputs_env = os.environ.get(OUTPUTS_ENV)
+    output = io.StringIO()
+    cached = list(NAME_TO_DEVICE.items())
+    NAME_TO_DEVICE.clear()
+
+    with tempfile.NamedTemporaryFile(suffix=".outputs") as outputs:
+        os.environ[OUTPUTS_ENV] = outputs.name
+        sys.argv = [os.path.abspath(filename)]
+        sys.path = [dirname] + path
+        t = time.time()
+        try:
+            with redirect_stdout(output), redirect_stderr(output):
+                try:
+                    runpy.run_path(os.path.abspath(filename), run_name="__main__")
+                    returncode = 0
+                except SystemExit as e:
+                    returncode = _get_exit_code(e)
+                except Exception:
+                    traceback.print_exc()
+                    returncode = 1
+        finally:
+            total_time = time.time() - t
+            sys.argv, sys.path = argv, path
+            os.chdir(cwd)
+            if outputs_env is None:
+                os.environ.pop(OUTPUTS_ENV, None)
+            else:
+                os.environ[OUTPUTS_ENV] = outputs_env
+            for name in set(sys.modules) - modules_before:
+                module_file = getattr(sys.modules[name], "__file__", None) or ""
+                if any(module_file.startswith(d) for d in local_dirs):
+                    del sys.modules[name]
+            NAME_TO_DEVICE.clear()
+            for name, component in cached:
+                NAME_TO_DEVICE[name] = component
+        paths = pathlib.Path(outputs.name).read_text().split()
+
+    if returncode == 0:
+        logging.info("v {} ({:.1f}s)".format(os.path.relpath(filename), total_time))
+    else:
+        logging.info(
+            "! Error in {} {:.1f}s)".format(os.path.relpath(filename), total_time)
+        )
+    if len(output.getvalue().strip()) > 0:
+        logging.debug("Output of python {}:\n{}".format(filename, output.getvalue()))
+    profile = dict(seconds=total_time, max_rss_mb=None, **get_outputs_stats(paths))
+    return filename, returncode, profile
+
+
+def build_devices(regex=".*", overwrite=True, build_profile=None, warm=False):
+    """ Builds all the python files in devices/
+    and records their profile in build_profile (defaults to BuildProfile())
+
+    Args:
+        regex: only builds the files that match
+        overwrite: rebuild when there are devices already built
+        build_profile: BuildProfile
+        warm: run the scripts with runpy in a pool of workers that have pp
+            already imported, instead of one `python file.py` process per script
+    """
     # Avoid accidentally rebuilding devices
     if (
         os.path.isdir(CONFIG["gds_directory"])
@@ -73,9 +187,20 @@ def build_devices(regex=".*", overwrite=True):
     )
 
     # Now run all the files in batches of $CPU_SIZE.
-    with Pool(processes=multiprocessing.cpu_count()) as pool:
-        for filename, rc in pool.imap_unordered(run_python, all_files):
+    build_profile = build_profile or BuildProfile()
+    if warm:
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        context = multiprocessing.get_context(method)
+        pool = context.Pool(multiprocessing.cpu_count(), initializer=_init_warm_worker)
+        run = run_python_warm
+    else:
+        pool = Pool(processes=multiprocessing.cpu_count())
+        run = run_python_profile
+    with pool:
+        for filename, rc, profile in pool.imap_unordered(run, all_files):
             logging.debug("Finished {} {}".format(filename, rc))
+            name = os.path.relpath(filename, CONFIG["devices_directory"])
+            build_profile.add("device", name, ok=rc == 0, **profile)
 
     # Report on what we did.
     devices = glob(os.path.join(CONFIG["gds_directory"], "*.gds"))
@@ -174,6 +299,40 @@ def build_does(filepath, component_type2factory=component_type2factory):
     #     p.start()
 
 
+def test_run_python_warm(tmp_path):
+    import pp
+
+    (tmp_path / "helper.py").write_text("length = 12.3\n")
+    (tmp_path / "wg.py").write_text(
+        "import sys\n"
+        "import pp\n"
+        "from helper import length\n"
+        "if __name__ == '__main__':\n"
+        "    c = pp.c.waveguide(length=length)\n"
+        "    pp.write_gds(c, sys.argv[0].replace('.py', '.gds'))\n"
+        "    print(c.name)\n"
+    )
+    (tmp_path / "exit.py").write_text("import sys\nsys.exit(3)\n")
+    (tmp_path / "error.py").write_text("raise ValueError('broken device')\n")
+    argv = list(sys.argv)
+    NAME_TO_DEVICE["cached_before"] = pp.c.waveguide(length=4.56)
+    names = list(NAME_TO_DEVICE)
+
+    filename, rc, profile = run_python_warm(str(tmp_path / "wg.py"))
+    assert filename == str(tmp_path / "wg.py")
+    assert rc == 0
+    assert profile["max_rss_mb"] is None
+    assert profile["polygons"] > 0 and profile["size_bytes"] > 0
+    assert (tmp_path / "wg.gds").exists()
+    assert "helper" not in sys.modules
+    assert sys.argv == argv and OUTPUTS_ENV not in os.environ
+    assert list(NAME_TO_DEVICE) == names
+    del NAME_TO_DEVICE["cached_before"]
+
+    assert run_python_warm(str(tmp_path / "exit.py"))[1] == 3
+    assert run_python_warm(str(tmp_path / "error.py"))[1] == 1
+
+
 if __name__ == "__main__":
     does_path = CONFIG["samples_path"] / "mask" / "does.yml"
     build_does(does_path)
@@ -0,0 +1,261 @@
+""" build profile: duration, peak memory, polygons and output size of each
+device script and DOE, appended to a JSON-lines file across builds
+
+.. code::
+
+    profile = BuildProfile()
+    profile.add("device", "mzi.py", seconds=2.1, max_rss_mb=180.0)
+    for regression in profile.get_regressions():
+        print(regression)
+
+Device scripts report the GDS files they write (write_gds) through the file
+in the `PP_BUILD_OUTPUTS` environment variable.
+"""
+
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+from subprocess import Popen
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from pp.config import CONFIG
+from pp.gds_index import get_gds_index
+
+OUTPUTS_ENV = "PP_BUILD_OUTPUTS"
+METRICS = ("seconds", "max_rss_mb", "polygons", "size_bytes")
+
+
+def get_max_rss_mb(rusage: Any = None) -> Optional[float]:
+    """ returns the peak resident memory (MB) of a rusage
+    (this process by default), None if the platform does not report it
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rusage = rusage or resource.getrusage(resource.RUSAGE_SELF)
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    return round(rusage.ru_maxrss / scale, 3)
+
+
+def communicate(process: Popen) -> Tuple[bytes, bytes, Optional[float]]:
+    """ returns stdout, stderr and the peak resident memory (MB)
+    of a process started with stdout=PIPE and stderr=PIPE,
+    and sets process.returncode
+    """
+    if not hasattr(os, "wait4"):
+        stdout, stderr = process.communicate()
+        return stdout, stderr, None
+
+    stderr = []
+    thread = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    thread.start()
+    stdout = process.stdout.read()
+    thread.join()
+    process.stdout.close()
+    process.stderr.close()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = (
+        os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    )
+    return stdout, stderr[0], get_max_rss_mb(rusage)
+
+
+def record_output(path: Union[str, pathlib.Path]) -> None:
+    """ adds a written file to the outputs of the build that runs this process """
+    filename = os.environ.get(OUTPUTS_ENV)
+    if filename:
+        with open(filename, "a") as f:
+            f.write(f"{path}\n")
+
+
+def get_outputs_stats(paths: Iterable[Union[str, pathlib.Path]]) -> Dict[str, int]:
+    """ returns the number of polygons and the size (bytes) of GDS files """
+    polygons = 0
+    size_bytes = 0
+    for path in set(str(path) for path in paths):
+        path = pathlib.Path(path)
+        if path.exists():
+            size_bytes += path.stat().st_size
+            if path.suffix == ".gds":
+                polygons += get_gds_index(path).count_polygons()
+    return dict(polygons=polygons, size_bytes=size_bytes)
+
+
+def get_built_variants(record: Dict[str, Any]) -> Optional[int]:
+    """ returns the number of DOE variants that a record built
+    (records without built_variants only counted the built variants)
+    """
+    return record.get("built_variants", record.get("variants"))
+
+
+def get_variant_seconds(record: Dict[str, Any]) -> float:
+    """ returns the build time of each built variant of a DOE record """
+    return record["seconds"] / max(get_built_variants(record) or 1, 1)
+
+
+class Regression:
+    """ metric of a device script or DOE that increased since its previous build """
+
+    def __init__(
+        self, kind: str, name: str, metric: str, before: float, after: float
+    ) -> None:
+        self.kind = kind
+        self.name = name
+        self.metric = metric
+        self.before = before
+        self.after = after
+
+    @property
+    def ratio(self) -> float:
+        return self.after / self.before if self.before else float("inf")
+
+    def __repr__(self) -> str:
+        return (
+            f"Regression({self.kind} {self.name} {self.metric} "
+            f"{self.before:g} -> {self.after:g}, x{self.ratio:.2f})"
+        )
+
+
+class BuildProfile:
+    """ build records of device scripts and DOEs (one JSON object per line)
+
+    each record has run, time, kind (device or doe), name, ok, seconds,
+    max_rss_mb, polygons, size_bytes (and for DOEs the number of variants
+    and of built_variants, the variants that were not cached)
+
+    Args:
+        path: JSON-lines file, defaults to CONFIG['build_profile']
+    """
+
+    def __init__(self, path: Optional[Union[str, pathlib.Path]] = None) -> None:
+        self.path = pathlib.Path(path or CONFIG["build_profile"])
+        self.run = f"{time.strftime('%Y-%m-%dT%H:%M:%S')}_{os.getpid()}"
+
+    def add(
+        self, kind: str, name: str, seconds: float, ok: bool = True, **metrics
+    ) -> Dict[str, Any]:
+        """ appends a record to the profile """
+        record = dict(
+            run=self.run,
+            time=time.time(),
+            kind=kind,
+            name=name,
+            ok=ok,
+            seconds=round(seconds, 6),
+            **metrics,
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def load(self, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        """ returns the records in the order they were added """
+        if not self.path.exists():
+            return []
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # line of an interrupted build
+                    continue
+                if kind is None or record.get("kind") == kind:
+                    records.append(record)
+        return records
+
+    def get_latest(self, kind: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """ returns the last successful record of each name """
+        return {
+            record["name"]: record for record in self.load(kind) if record.get("ok")
+        }
+
+    def get_regressions(
+        self,
+        threshold: float = 0.2,
+        min_seconds: float = 0.5,
+        kind: Optional[str] = None,
+    ) -> List[Regression]:
+        """ returns the metrics of the last build of each device script and DOE
+        that increased by more than threshold (0.2 = 20%) since their previous build
+
+        Args:
+            threshold: relative increase
+            min_seconds: smaller duration increases are not regressions
+            kind: device or doe (all by default)
+        """
+        history = {}
+        for record in self.load(kind):
+            if record.get("ok"):
+                history.setdefault((record["kind"], record["name"]), []).append(record)
+
+        regressions = []
+        for (record_kind, name), records in history.items():
+            after = records[-1]
+            previous = [r for r in records if r["run"] != after["run"]]
+            if not previous:
+                continue
+            before = previous[-1]
+            for metric in METRICS:
+                value_before = before.get(metric)
+                value_after = after.get(metric)
+                if value_before is None or value_after is None:
+                    continue
+                if metric == "seconds" and (
+                    get_built_variants(before) != get_built_variants(after)
+                ):
+                    # DOE partially cached: compare the time of each built variant
+                    metric = "seconds_per_variant"
+                    value_before = get_variant_seconds(before)
+                    value_after = get_variant_seconds(after)
+                if value_after <= value_before * (1 + threshold):
+                    continue
+                if (
+                    metric in ("seconds", "seconds_per_variant")
+                    and value_after - value_before < min_seconds
+                ):
+                    continue
+                regressions.append(
+                    Regression(record_kind, name, metric, value_before, value_after)
+                )
+        return regressions
+
+
+def test_build_profile(tmp_path):
+    path = tmp_path / "build_profile.jsonl"
+    profile = BuildProfile(path)
+    profile.add("device", "mzi.py", seconds=2.0, max_rss_mb=100.0, polygons=10)
+    profile.add("doe", "mmis", seconds=1.0, variants=2)
+    assert BuildProfile(path).get_latest("doe")["mmis"]["variants"] == 2
+
+    profile = BuildProfile(path)
+    profile.run += "_next"
+    profile.add("device", "mzi.py", seconds=3.0, max_rss_mb=101.0, polygons=20)
+    profile.add("doe", "mmis", seconds=1.1, variants=2)
+    profile.add("doe", "failed", seconds=1.0, ok=False)
+    regressions = profile.get_regressions()
+    assert [(r.name, r.metric) for r in regressions] == [
+        ("mzi.py", "seconds"),
+        ("mzi.py", "polygons"),
+    ]
+    assert regressions[1].ratio == 2
+    assert list(profile.get_latest()) == ["mzi.py", "mmis"]
+
+    # a DOE rebuilt from the cache is compared per built variant
+    profile.add("doe", "big", seconds=10.0, variants=10, built_variants=10)
+    profile.run += "_cached"
+    profile.add("doe", "big", seconds=1.2, variants=10, built_variants=1)
+    profile.run += "_full"
+    profile.add("doe", "big", seconds=11.0, variants=10, built_variants=10)
+    assert not profile.get_regressions(kind="doe")
+    assert get_variant_seconds(profile.get_latest()["big"]) == 1.1
+
+
+if __name__ == "__main__":
+    profile = BuildProfile()
+    for regression in profile.get_regressions():
+        print(regression)
@@ -0,0 +1,426 @@
+""" in-memory cache for the components built by `autoname`
+
+The cache is a bounded LRU (least recently used) mapping from component name to
+Component. It evicts the least recently used components when it holds more than
+`max_entries` components or more than `max_bytes` of polygon data.
+
+A component that is still referenced by a live ComponentReference (for example
+because it is part of another component) is pinned and never evicted, so that a
+cell name always maps to a single Component inside the same layout.
+
+Optionally (`conf.cache.disk`) built components are also pickled to disk, so
+other processes (including the DOE workers) can load them instead of building
+them again.
+"""
+
+import os
+import pathlib
+import pickle
+import tempfile
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+
+from pp.config import CONFIG, conf, logging
+
+
+def get_component_size(component: Any) -> int:
+    """ returns approximate memory (bytes) used by the polygons of a component
+    only counts the component own polygons, references are cached independently
+    """
+    n_points = 0
+    for polygonset in getattr(component, "polygons", []):
+        for points in polygonset.polygons:
+            n_points += len(points)
+    return 16 * n_points
+
+
+class ReferrerSet(weakref.WeakSet):
+    """ weak set of the references that point to a component
+    it is empty when unpickled, rebind_references registers the references again
+    """
+
+    def __reduce__(self):
+        return (self.__class__, ())
+
+
+def is_pinned(component: Any) -> bool:
+    """ True if any live ComponentReference points to the component """
+    return len(getattr(component, "_referrers", ())) > 0
+
+
+class ComponentCache:
+    """ LRU cache of components indexed by name
+
+    Args:
+        max_entries: maximum number of components (None for no limit)
+        max_bytes: approximate polygon memory budget in bytes (None for no limit)
+
+    """
+
+    def __init__(
+        self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._components = OrderedDict()
+        self._sizes = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._components
+
+    def __len__(self) -> int:
+        return len(self._components)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._components)
+
+    def __getitem__(self, name: str) -> Any:
+        component = self._components[name]
+        self._components.move_to_end(name)
+        return component
+
+    def __setitem__(self, name: str, component: Any) -> None:
+        if name in self._components:
+            self.pop(name)
+        size = get_component_size(component)
+        self._components[name] = component
+        self._sizes[name] = size
+        self.nbytes += size
+        self.evict(keep=name)
+
+    def __delitem__(self, name: str) -> None:
+        self.pop(name)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """ returns a component and keeps track of hits and misses """
+        if name in self._components:
+            self.hits += 1
+            return self[name]
+        self.misses += 1
+        return default
+
+    def pop(self, name: str, *default) -> Any:
+        if name not in self._components and default:
+            return default[0]
+        component = self._components.pop(name)
+        self.nbytes -= self._sizes.pop(name)
+        return component
+
+    def keys(self):
+        return self._components.keys()
+
+    def values(self):
+        return self._components.values()
+
+    def items(self):
+        return self._components.items()
+
+    def clear(self) -> None:
+        self._components.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def is_full(self) -> bool:
+        return (self.max_entries is not None and len(self) > self.max_entries) or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        )
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """ evicts least recently used components until the cache fits its budget
+        pinned components are moved to the most recently used end
+
+        Args:
+            keep: name of a component that is never evicted (the one just added)
+
+        Returns:
+            number of evicted components
+        """
+        evicted = 0
+        for _ in range(len(self._components)):
+            if not self.is_full():
+                break
+            name, component = next(iter(self._components.items()))
+            if name == keep:
+                break
+            if is_pinned(component):
+                self._components.move_to_end(name)
+            else:
+                self.pop(name)
+                evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """ returns cache counters """
+        return dict(
+            entries=len(self),
+            nbytes=self.nbytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+NAME_TO_DEVICE = ComponentCache(
+    max_entries=conf.cache.max_entries, max_bytes=conf.cache.max_bytes
+)
+
+
+def get_dependencies(component: Any) -> Iterator[Any]:
+    """ yields all the components referenced by a component (recursively) """
+    seen = set()
+    stack = [component]
+    while stack:
+        cell = stack.pop()
+        for reference in cell.references:
+            parent = reference.parent
+            if id(parent) not in seen:
+                seen.add(id(parent))
+                yield parent
+                stack.append(parent)
+
+
+def get_cache_name(component: Any) -> str:
+    """ returns the name of a component in NAME_TO_DEVICE """
+    return getattr(component, "name_long", None) or component.name
+
+
+def share_references(component: Any, get_shared: Callable[[Any], Any]) -> Any:
+    """ makes the references of a component and of all its new cells
+    point to get_shared(cell) instead of cell
+
+    cells replaced by get_shared are already in memory, so only the cells
+    that are kept are walked
+
+    Returns:
+        component
+    """
+    seen = set()
+    stack = [component]
+    while stack:
+        cell = stack.pop()
+        for reference in cell.references:
+            parent = reference.parent
+            shared = get_shared(parent)
+            if shared is not parent:
+                reference.parent = shared
+                reference.ref_cell = shared
+            elif id(parent) not in seen:
+                seen.add(id(parent))
+                stack.append(parent)
+            referrers = getattr(shared, "_referrers", None)
+            if referrers is not None:
+                referrers.add(reference)
+    return component
+
+
+def get_cached_cell(cell: Any, name_to_device: Optional[ComponentCache] = None) -> Any:
+    """ returns the cached cell with the same name as an autonamed cell
+    (adding the cell to the cache if there is none)
+    other cells are returned as they are
+    """
+    if getattr(cell, "function_name", None) is None:
+        return cell
+    name_to_device = NAME_TO_DEVICE if name_to_device is None else name_to_device
+    name = get_cache_name(cell)
+    cached = name_to_device.get(name)
+    if cached is None:
+        name_to_device[name] = cell
+        return cell
+    return cached
+
+
+def rebind_references(
+    component: Any, name_to_device: Optional[ComponentCache] = None
+) -> Any:
+    """ makes a component that comes from another process (pickle)
+    share cells with the components already in memory
+
+    references to a cell that is already in the cache point to the cached cell
+    and the other autonamed cells are added to the cache
+
+    Returns:
+        component
+    """
+    return share_references(
+        component, lambda cell: get_cached_cell(cell, name_to_device)
+    )
+
+
+class DiskCache:
+    """ stores pickled components in a directory
+
+    Args:
+        dirpath: cache directory
+        protocol: pickle protocol
+
+    """
+
+    def __init__(
+        self,
+        dirpath: Union[str, pathlib.Path],
+        protocol: int = pickle.HIGHEST_PROTOCOL,
+    ) -> None:
+        self.dirpath = pathlib.Path(dirpath)
+        self.protocol = protocol
+
+    def get_path(self, key: str) -> pathlib.Path:
+        return self.dirpath / f"{key}.pkl"
+
+    def __contains__(self, key: str) -> bool:
+        return self.get_path(key).exists()
+
+    def load(
+        self, key: str, check: Optional[Callable[[Any], bool]] = None
+    ) -> Optional[Any]:
+        """ returns a component from the cache or None if it is not there
+        (or can not be loaded)
+
+        Args:
+            key: cache key
+            check: function of the metadata saved with the component,
+                returns False if the cached component is stale
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Could not load {path} from cache: {e}")
+            return None
+        if not isinstance(data, dict) or "component" not in data:
+            data = dict(component=data, metadata=None)  # saved without metadata
+        if check is not None and not check(data["metadata"]):
+            logging.info(f"Stale component {path} in cache")
+            return None
+        return rebind_references(data["component"])
+
+    def save(self, key: str, component: Any, metadata: Any = None) -> bool:
+        """ pickles a component (and its metadata) into the cache
+        the file is first written as a temporary file and then renamed,
+        so processes writing the same component in parallel never leave
+        a partial file behind
+
+        Returns:
+            True if the component was saved
+        """
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        fd, tmppath = tempfile.mkstemp(dir=self.dirpath, suffix=".tmp")
+        data = dict(component=component, metadata=metadata)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(data, f, protocol=self.protocol)
+            os.replace(tmppath, path)
+        except Exception:
+            os.remove(tmppath)
+            return False
+        return True
+
+    def clear(self) -> None:
+        """ removes all the cached components """
+        for path in self.dirpath.glob("*.pkl"):
+            path.unlink()
+
+
+DISK_CACHE = DiskCache(CONFIG["component_cache_directory"])
+
+
+class _Polygons:
+    def __init__(self, n_points):
+        self.polygons = [[(0, 0)] * n_points]
+
+
+class _Dummy:
+    def __init__(self, n_points=4, pinned=False):
+        self.polygons = [_Polygons(n_points)]
+        self._referrers = [self] if pinned else []
+
+
+def test_cache_lru():
+    cache = ComponentCache(max_entries=2)
+    cache["a"] = _Dummy()
+    cache["b"] = _Dummy()
+    assert cache.get("a")
+    cache["c"] = _Dummy()
+    assert list(cache.keys()) == ["a", "c"]
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_bytes():
+    cache = ComponentCache(max_bytes=16 * 10)
+    cache["a"] = _Dummy(n_points=8)
+    assert cache.nbytes == 16 * 8
+    cache["b"] = _Dummy(n_points=8)
+    assert list(cache.keys()) == ["b"]
+    assert cache.nbytes == 16 * 8
+
+
+def test_cache_pinned():
+    cache = ComponentCache(max_entries=1)
+    cache["a"] = _Dummy(pinned=True)
+    cache["b"] = _Dummy()
+    cache["c"] = _Dummy()
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_cache_pinned_by_reference():
+    import pp
+
+    cache = ComponentCache(max_entries=1)
+    c1 = pp.Component()
+    c2 = pp.Component()
+    ref = pp.ComponentReference(c1)
+    cache["c1"] = c1
+    cache["c2"] = c2
+    assert "c1" in cache
+    del ref
+    cache["c3"] = pp.Component()
+    assert "c1" not in cache
+
+
+def test_disk_cache(tmp_path):
+    import pp
+    from pp.compare_cells import hash_cells
+
+    cache = DiskCache(tmp_path)
+    c = pp.c.mzi()
+    assert cache.save("mzi", c)
+    assert "mzi" in cache
+    c2 = cache.load("mzi")
+    assert c2.name == c.name
+    assert hash_cells(c2, {})[c2.name] == hash_cells(c, {})[c.name]
+    assert sorted(c2.ports.keys()) == sorted(c.ports.keys())
+    assert c2.settings == c.settings
+
+    # references point to the components already in memory
+    parents = {reference.parent.name: reference.parent for reference in c.references}
+    for reference in c2.references:
+        assert reference.parent is parents[reference.parent.name]
+    assert cache.load("missing") is None
+
+    assert cache.save("mzi_stale", c, metadata=dict(version=1))
+    assert cache.load("mzi_stale", check=lambda metadata: metadata["version"] == 1)
+    assert not cache.load("mzi_stale", check=lambda metadata: metadata["version"] == 2)
+
+
+if __name__ == "__main__":
+    test_cache_lru()
+    test_cache_pinned()
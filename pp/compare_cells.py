@@ -6,8 +6,21 @@ This is not a diff tool
 import hashlib
 import sys
 import json
+import weakref
+from typing import List
 import numpy as np
 
+"""
+# A random offset which fixes common rounding errors intrinsic
+# to floating point math. Example: with a precision of 0.1, the
+# floating points 7.049999 and 7.050001 round to different values
+# (7.0 and 7.1), but offset values (7.220485 and 7.220487) don't
+"""
+magic_offset = 0.17048614
+
+# {id(cell): (weakref to cell, geometry version, precision, polygons sha1)}
+_polygons_hashes = {}
+
 
 def _print(*args, **kwargs):
     print(*args, **kwargs)
@@ -18,12 +31,11 @@ def get_transform(cell_ref, precision=1e-4):
     """
     Get the transform from a cell-instance as a hashable object
     """
-    if cell_ref.rotation is None:
-        cell_ref.rotation = 0
+    rotation = cell_ref.rotation or 0
     return (
         int(cell_ref.origin[0] / precision),
         int(cell_ref.origin[1] / precision),
-        int(cell_ref.rotation) % 360,
+        int(rotation) % 360,
         cell_ref.x_reflection,
     )
 
@@ -60,25 +72,39 @@ def normalize_polygon_start_point(p, dbg=False):
     return np.roll(p, -i0, axis=0)
 
 
-def hash_cells(cell, dict_hashes={}, precision=1e-4, dbg_indent=0, dbg=False):
-    """
-    Algorithm:
-    For each polygon directly within this cell:
-         - sort the layers
+def hash_polygons(polygons, precision=1e-4) -> List[str]:
+    """ returns the sorted sha1 hashes of a list of polygons
 
-        For each layer, each polygon is individually hashed and then
-          the polygon hashes are sorted, to ensure the hash stays constant
-          regardless of the ordering the polygons.  Similarly, the layers
-          are sorted by (layer, datatype)
+    All polygons are quantized and normalized (start point with min x, then min y)
+    at once on the concatenated points, then each polygon is hashed
+    from a slice of the same buffer.
+    Returns the same hashes as hashing each normalize_polygon_start_point polygon.
+    """
+    if not polygons:
+        return []
+    lengths = np.array([len(p) for p in polygons])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate(polygons)
+    points = ((points / precision) + magic_offset).astype(np.int64)
+
+    segments = np.repeat(np.arange(len(polygons)), lengths)
+    order = np.lexsort((points[:, 1], points[:, 0], segments))
+    starts = order[offsets] - offsets
+    local_index = np.arange(len(points)) - np.repeat(offsets, lengths)
+    rolled_index = np.repeat(offsets, lengths) + (
+        (local_index + np.repeat(starts, lengths)) % np.repeat(lengths, lengths)
+    )
+    buffer = memoryview(np.ascontiguousarray(points[rolled_index]).tobytes())
 
-    For each cell instance:
-        recursively hash the ref_cell + transform
-        sort all the hashes for the hash to stay constant regardless of cell instance order
+    nbytes = points.itemsize * points.shape[1]
+    return sorted(
+        hashlib.sha1(buffer[offset * nbytes : (offset + length) * nbytes]).hexdigest()
+        for offset, length in zip(offsets, lengths)
+    )
 
-    """
-    if cell.name in dict_hashes:
-        return dict_hashes
 
+def _hash_polygons_by_layer(cell, precision=1e-4, dbg=False):
+    """ returns a sha1 object updated with the hashes of the cell polygons """
     polygons_by_spec = get_polygons_by_spec(cell)
     layers = list(polygons_by_spec.keys())
     layers.sort()
@@ -86,31 +112,78 @@ def hash_cells(cell, dict_hashes={}, precision=1e-4, dbg_indent=0, dbg=False):
     if dbg:
         _print(layers)
 
-    """
-    # A random offset which fixes common rounding errors intrinsic
-    # to floating point math. Example: with a precision of 0.1, the
-    # floating points 7.049999 and 7.050001 round to different values
-    # (7.0 and 7.1), but offset values (7.220485 and 7.220487) don't
-    """
-    magic_offset = 0.17048614
-
     final_hash = hashlib.sha1()
-
     for layer in layers:
         layer_hash = hashlib.sha1(str(layer).encode()).hexdigest()
-        polygons = polygons_by_spec[tuple(layer)]
-
-        polygons = [((p / precision) + magic_offset).astype(np.int64) for p in polygons]
-        polygons = [normalize_polygon_start_point(p) for p in polygons]
-        polygon_hashes = np.sort([hashlib.sha1(p).hexdigest() for p in polygons])
+        polygon_hashes = hash_polygons(polygons_by_spec[tuple(layer)], precision)
 
         if dbg:
-            _print(polygons)
             _print(layer, layer_hash, polygon_hashes)
 
         final_hash.update(layer_hash.encode())
         for ph in polygon_hashes:
             final_hash.update(ph.encode())
+    return final_hash
+
+
+def get_polygons_hash(cell, precision=1e-4, dbg=False):
+    """ returns a sha1 object updated with the hashes of the cell polygons
+
+    The result is cached for cells with a `_geometry_version` (Component)
+    until the cell geometry or the polygon layers change,
+    so unchanged cells are never hashed again.
+    """
+    version = getattr(cell, "_geometry_version", None)
+    if version is None or dbg:
+        return _hash_polygons_by_layer(cell, precision=precision, dbg=dbg)
+
+    # layers can be edited in place (remap_layers) without changing the version
+    version = (
+        version,
+        tuple((tuple(p.layers), tuple(p.datatypes)) for p in cell.polygons),
+    )
+    key = id(cell)
+    cached = _polygons_hashes.get(key)
+    if cached is not None:
+        cell_ref, cached_version, cached_precision, polygons_hash = cached
+        if (
+            cell_ref() is cell
+            and cached_version == version
+            and cached_precision == precision
+        ):
+            return polygons_hash.copy()
+
+    polygons_hash = _hash_polygons_by_layer(cell, precision=precision)
+    _polygons_hashes[key] = (
+        weakref.ref(cell, lambda _, key=key: _polygons_hashes.pop(key, None)),
+        version,
+        precision,
+        polygons_hash.copy(),
+    )
+    return polygons_hash
+
+
+def hash_cells(cell, dict_hashes={}, precision=1e-4, dbg_indent=0, dbg=False):
+    """
+    Algorithm:
+    For each polygon directly within this cell:
+         - sort the layers
+
+        For each layer, each polygon is individually hashed and then
+          the polygon hashes are sorted, to ensure the hash stays constant
+          regardless of the ordering the polygons.  Similarly, the layers
+          are sorted by (layer, datatype)
+        The polygons hash of each cell is cached until the cell geometry changes
+
+    For each cell instance:
+        recursively hash the ref_cell + transform
+        sort all the hashes for the hash to stay constant regardless of cell instance order
+
+    """
+    if cell.name in dict_hashes:
+        return dict_hashes
+
+    final_hash = get_polygons_hash(cell, precision=precision, dbg=dbg)
 
     # Ref cell hashes
     cell_ref_uids = []
@@ -0,0 +1,396 @@
+""" compiled netlist: a YAML netlist parsed and validated once
+
+`compile_netlist` turns a netlist (YAML for component_from_yaml or
+netlist_from_yaml, or the dict returned by Component.get_netlist) into plain
+python tables: each instance has an integer id (in netlist order) and a
+resolved factory, and each `instance,port` reference is an index in a port
+table of (instance id, port name).
+
+YAML netlists are compiled once and cached by the hash of their text, so
+building the same YAML again skips parsing and validation. Each call returns
+a copy of the cached netlist, with the factories resolved from the
+component_type2factory of the call.
+"""
+
+import collections
+import copy
+import hashlib
+import io
+import pathlib
+from typing import IO, Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import networkx as nx
+from omegaconf import DictConfig, ListConfig, OmegaConf
+
+PortId = int
+Connection = Tuple[PortId, PortId]
+
+valid_placements = ["x", "y", "rotation", "mirror"]
+
+# keys of component_from_yaml netlists
+valid_keys = [
+    "name",
+    "instances",
+    "placements",
+    "connections",
+    "ports",
+    "routes",
+    "bundle_routes",
+]
+# netlist_from_yaml names the exposed ports ports_map
+valid_netlist_keys = valid_keys + ["ports_map"]
+
+# compiled YAML netlists (without factories) by hash of the YAML text
+CACHE_SIZE = 128
+_compiled = collections.OrderedDict()
+
+
+class CompiledNetlist:
+    """ typed and validated netlist
+
+    Attributes:
+        name: component name
+        keys: top level keys of the netlist
+        instance_names: name of each instance id
+        instance_ids: {instance name: instance id}
+        component_types: component type of each instance id
+        factories: factory of each instance id
+        settings: settings dict of each instance id
+        placements: placement dict (x, y, rotation, mirror) of each instance id or None
+        transformations: transformation of each instance id (netlist_from_yaml)
+        properties: properties dict of each instance id (netlist_from_yaml)
+        ports: (instance id, port name) of each port id
+        port_ids: {(instance id, port name): port id}
+        connections: list of (src port id, dst port id)
+        routes: {route name: (src port id, dst port id)}
+        bundle_routes: {bundle name: list of (src port id, dst port id)}
+        exposed_ports: {port name: port id}
+        conf: netlist as plain python containers
+    """
+
+    def __init__(self, conf: Dict[str, Any]) -> None:
+        self.name = conf.get("name")
+        self.keys = list(conf.keys())
+        self.instance_names = []
+        self.instance_ids = {}
+        self.component_types = []
+        self.factories = []
+        self.settings = []
+        self.placements = []
+        self.transformations = []
+        self.properties = []
+        self.ports = []
+        self.port_ids = {}
+        self.connections = []
+        self.routes = {}
+        self.bundle_routes = {}
+        self.exposed_ports = {}
+        self.conf = conf
+        self._instance_ports = []
+        self._connections_sorted = None
+
+    def __len__(self) -> int:
+        return len(self.instance_names)
+
+    def copy(self) -> "CompiledNetlist":
+        """ returns a deep copy of the netlist """
+        return copy.deepcopy(self)
+
+    def __repr__(self) -> str:
+        return (
+            f"CompiledNetlist({self.name}, {len(self)} instances, "
+            f"{len(self.connections)} connections, {len(self.routes)} routes, "
+            f"{len(self.bundle_routes)} bundle_routes, "
+            f"{len(self.exposed_ports)} ports)"
+        )
+
+    def add_instance(
+        self,
+        instance_name: str,
+        component_type: str,
+        factory: Optional[Callable],
+        settings: Optional[Dict[str, Any]] = None,
+        placement: Optional[Dict[str, Any]] = None,
+        transformation: Optional[str] = None,
+        properties: Optional[Dict[str, Any]] = None,
+    ) -> int:
+        """ returns the id of a new instance """
+        if instance_name in self.instance_ids:
+            raise ValueError(f"instance {instance_name} is defined twice")
+        for k in placement or {}:
+            if k not in valid_placements:
+                raise ValueError(
+                    f"`{k}` not valid placement {valid_placements} for"
+                    f" {instance_name}"
+                )
+        instance_id = len(self.instance_names)
+        self.instance_names.append(instance_name)
+        self.instance_ids[instance_name] = instance_id
+        self.component_types.append(component_type)
+        self.factories.append(factory)
+        self.settings.append(settings or {})
+        self.placements.append(placement or None)
+        self.transformations.append(transformation)
+        self.properties.append(properties or {})
+        self._instance_ports.append(set())
+        return instance_id
+
+    def get_instance_id(self, instance_name: str) -> int:
+        instance_id = self.instance_ids.get(instance_name)
+        if instance_id is None:
+            raise ValueError(
+                f"{instance_name} not in {list(self.instance_ids.keys())}"
+            )
+        return instance_id
+
+    def get_port_id(self, instance_port: Union[str, List[str]]) -> PortId:
+        """ returns the port id of `instance,port` (or [instance, port]) """
+        if isinstance(instance_port, str):
+            if instance_port.count(",") != 1:
+                raise ValueError(f"`{instance_port}` needs to be `instance,port`")
+            instance_port = instance_port.split(",")
+        if len(instance_port) != 2:
+            raise ValueError(f"`{instance_port}` needs to be [instance, port]")
+        instance_name, port_name = (str(x).strip() for x in instance_port)
+        instance_id = self.get_instance_id(instance_name)
+        key = (instance_id, port_name)
+        port_id = self.port_ids.get(key)
+        if port_id is None:
+            port_id = len(self.ports)
+            self.ports.append(key)
+            self.port_ids[key] = port_id
+            self._instance_ports[instance_id].add(port_name)
+        return port_id
+
+    def get_port_string(self, port_id: PortId) -> str:
+        """ returns `instance,port` of a port id """
+        instance_id, port_name = self.ports[port_id]
+        return f"{self.instance_names[instance_id]},{port_name}"
+
+    def get_instance_ports(self, instance_id: int) -> Set[str]:
+        """ returns the port names of an instance used in the netlist """
+        return self._instance_ports[instance_id]
+
+    def check_ports(self, instance_id: int, ports: Dict[str, Any]) -> None:
+        """ raises ValueError if the netlist uses ports that the instance does not have """
+        missing = self._instance_ports[instance_id].difference(ports)
+        if missing:
+            raise ValueError(
+                f"{sorted(missing)} not in {list(ports.keys())} for"
+                f" {self.instance_names[instance_id]}"
+            )
+
+    def get_connections_sorted(self) -> List[Connection]:
+        """ returns the connections in dependency order, each instance is
+        connected after the instance it connects to (in netlist order
+        if the connections make a loop)
+        """
+        if self._connections_sorted is None:
+            graph = nx.DiGraph()
+            graph.add_nodes_from(range(len(self)))
+            graph.add_edges_from(
+                (self.ports[dst][0], self.ports[src][0])
+                for src, dst in self.connections
+            )
+            level = dict.fromkeys(graph, 0)
+            try:
+                for instance_id in nx.topological_sort(graph):
+                    for successor in graph.successors(instance_id):
+                        level[successor] = max(
+                            level[successor], level[instance_id] + 1
+                        )
+            except nx.NetworkXUnfeasible:
+                level = dict.fromkeys(graph, 0)
+            self._connections_sorted = sorted(
+                self.connections, key=lambda c: level[self.ports[c[0]][0]]
+            )
+        return self._connections_sorted
+
+    def get_connections(self) -> List[Tuple[str, str, str, str]]:
+        """ returns the connections as [instance1, port1, instance2, port2] """
+        connections = []
+        for src, dst in self.connections:
+            instance_src, port_src = self.ports[src]
+            instance_dst, port_dst = self.ports[dst]
+            connections.append(
+                [
+                    self.instance_names[instance_src],
+                    port_src,
+                    self.instance_names[instance_dst],
+                    port_dst,
+                ]
+            )
+        return connections
+
+
+def _to_container(conf: Any) -> Any:
+    if isinstance(conf, (DictConfig, ListConfig)):
+        return OmegaConf.to_container(conf, resolve=True)
+    return conf
+
+
+def _get_items(conf: Dict[str, Any], key: str) -> List[Tuple[Any, Any]]:
+    value = conf.get(key) or {}
+    if not hasattr(value, "items"):
+        raise ValueError(f"{key}: {value} needs to be a dict")
+    return list(value.items())
+
+
+def _compile(conf: Dict[str, Any]) -> CompiledNetlist:
+    """ returns a compiled netlist without factories """
+    for key in conf.keys():
+        if key not in valid_netlist_keys:
+            raise ValueError(f"{key} not in {list(valid_netlist_keys)}")
+
+    netlist = CompiledNetlist(conf)
+    placements = dict(_get_items(conf, "placements"))
+    for instance_name, instance_conf in _get_items(conf, "instances"):
+        instance_conf = instance_conf or {}
+        netlist.add_instance(
+            instance_name=str(instance_name),
+            component_type=instance_conf.get("component"),
+            factory=None,
+            settings=instance_conf.get("settings"),
+            placement=placements.pop(instance_name, None),
+            transformation=instance_conf.get("transformations"),
+            properties=instance_conf.get("properties"),
+        )
+    if placements:
+        raise ValueError(
+            f"placements {list(placements.keys())} not in"
+            f" {netlist.instance_names}"
+        )
+
+    connections = conf.get("connections") or {}
+    if hasattr(connections, "items"):
+        connections = list(connections.items())
+    else:
+        connections = [(c[:2], c[2:]) for c in connections]
+    netlist.connections = [
+        (netlist.get_port_id(src), netlist.get_port_id(dst)) for src, dst in connections
+    ]
+
+    for src, dst in _get_items(conf, "routes"):
+        netlist.routes[f"{src}:{dst}"] = (
+            netlist.get_port_id(src),
+            netlist.get_port_id(dst),
+        )
+    for bundle_name, bundle_conf in _get_items(conf, "bundle_routes"):
+        if not hasattr(bundle_conf, "items"):
+            raise ValueError(f"bundle_routes {bundle_name} needs to be a dict")
+        netlist.bundle_routes[bundle_name] = [
+            (netlist.get_port_id(src), netlist.get_port_id(dst))
+            for src, dst in bundle_conf.items()
+        ]
+    for key in ["ports", "ports_map"]:
+        for port_name, instance_port in _get_items(conf, key):
+            netlist.exposed_ports[port_name] = netlist.get_port_id(instance_port)
+    return netlist
+
+
+def _set_factories(
+    netlist: CompiledNetlist, component_type2factory: Dict[str, Callable], strict: bool
+) -> CompiledNetlist:
+    """ sets the factory of each instance from component_type2factory """
+    factories = []
+    for component_type in netlist.component_types:
+        factory = component_type2factory.get(component_type)
+        if factory is None and strict:
+            raise ValueError(
+                f"{component_type} not in {list(component_type2factory.keys())}"
+            )
+        factories.append(factory)
+    netlist.factories = factories
+    return netlist
+
+
+def _read_text(yaml: Union[str, pathlib.Path, IO[Any]]) -> str:
+    if isinstance(yaml, str) and "\n" in yaml:
+        return yaml
+    if isinstance(yaml, (str, pathlib.Path)):
+        return pathlib.Path(yaml).read_text()
+    return yaml.read()
+
+
+def compile_netlist(
+    yaml: Union[str, pathlib.Path, IO[Any], Dict[str, Any], DictConfig],
+    component_type2factory: Optional[Dict[str, Callable]] = None,
+    strict: bool = True,
+) -> CompiledNetlist:
+    """ returns a compiled netlist (YAML is parsed once, and each call
+    returns a copy with the current factories of component_type2factory)
+
+    Args:
+        yaml: YAML text, file or IO, or netlist dict (Component.get_netlist)
+        component_type2factory: dict of {factory_name: factory_function}
+        strict: raises ValueError for component types without factory
+            (otherwise their factory is None)
+
+    Returns:
+        CompiledNetlist
+    """
+    from pp.components import component_type2factory as component_type2factory_default
+
+    component_type2factory = component_type2factory or component_type2factory_default
+
+    if isinstance(yaml, (dict, DictConfig)):
+        netlist = _compile(_to_container(yaml))
+        return _set_factories(netlist, component_type2factory, strict)
+
+    text = _read_text(yaml)
+    key = hashlib.sha1(text.encode()).hexdigest()
+    netlist = _compiled.get(key)
+    if netlist is None:
+        conf = _to_container(OmegaConf.load(io.StringIO(text))) or {}
+        netlist = _compiled[key] = _compile(conf)
+        if len(_compiled) > CACHE_SIZE:
+            _compiled.popitem(last=False)
+    else:
+        _compiled.move_to_end(key)
+    return _set_factories(netlist.copy(), component_type2factory, strict)
+
+
+def test_compile_netlist():
+    import pytest
+    from pp.component_from_yaml import sample_mirror, sample_mmis
+
+    netlist = compile_netlist(sample_mirror)
+    netlist.settings[0]["edited"] = True
+    assert "edited" not in compile_netlist(sample_mirror).settings[0]
+    assert netlist.instance_names == ["CP1", "CP2", "arm_top", "arm_bot"]
+    assert netlist.get_port_string(netlist.connections[0][0]) == "arm_bot,W0"
+    assert netlist.get_port_string(netlist.exposed_ports["E0"]) == "CP2,W0"
+    assert netlist.get_instance_ports(netlist.instance_ids["CP2"]) == {
+        "E0",
+        "E1",
+        "W0",
+    }
+    assert netlist.placements[netlist.instance_ids["arm_bot"]]["rotation"] == 180
+    assert [
+        netlist.get_port_string(src) for src, _ in netlist.get_connections_sorted()
+    ] == ["arm_bot,W0", "arm_top,W0", "CP2,E0", "CP2,E1"]
+
+    netlist = compile_netlist(sample_mmis)
+    src, dst = netlist.routes["mmi_short,E1:mmi_long,E0"]
+    assert netlist.ports[src] == (netlist.instance_ids["mmi_short"], "E1")
+
+    with pytest.raises(ValueError):
+        compile_netlist(sample_mmis.replace("mmi_long,W0", "mmi_lng,W0"))
+    with pytest.raises(ValueError):
+        compile_netlist(sample_mmis.replace("rotation: 180", "rotate: 180"))
+
+    def mmi1x2(**kwargs):
+        return None
+
+    netlist = compile_netlist(sample_mmis, dict(mmi1x2=mmi1x2))
+    assert netlist.factories == [mmi1x2, mmi1x2]
+    with pytest.raises(ValueError):
+        compile_netlist(sample_mmis, dict(mmi2x2=mmi1x2))
+
+
+if __name__ == "__main__":
+    from pp.component_from_yaml import sample_mirror
+
+    netlist = compile_netlist(sample_mirror)
+    print(netlist)
+    print(netlist.get_connections())
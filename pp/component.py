@@ -7,15 +7,17 @@ import numpy as np
 from numpy import float64, int64, ndarray, pi, sin, cos, mod
 from omegaconf import OmegaConf
 import networkx as nx
+import gdspy
 
 from phidl.device_layout import Label
 from phidl.device_layout import Device
 from phidl.device_layout import DeviceReference
 from phidl.device_layout import _parse_layer
 
-from pp.port import Port, select_ports
+from pp.port import Port, PortDict, PortTable, get_ports_table, select_ports
 from pp.config import CONFIG, conf, connections
 from pp.compare_cells import hash_cells
+from pp.cache import ReferrerSet
 from pp.name import dict2hash, clean_dict, clean_list
 
 
@@ -133,6 +135,13 @@ def _rotate_points(
     return displacement * ca + perpendicular * sa + c0
 
 
+_reference_origin = gdspy.CellReference.origin
+_reference_rotation = gdspy.CellReference.rotation
+_reference_x_reflection = gdspy.CellReference.x_reflection
+_reference_magnification = gdspy.CellReference.magnification
+_geometry_versions = itertools.count(1)
+
+
 class ComponentReference(DeviceReference):
     def __init__(
         self,
@@ -151,12 +160,17 @@ class ComponentReference(DeviceReference):
             x_reflection=x_reflection,
         )
         self.parent = component
+        # register the reference so cached components in use are not evicted
+        referrers = getattr(component, "_referrers", None)
+        if referrers is not None:
+            referrers.add(self)
         # The ports of a DeviceReference have their own unique id (uid),
         # since two DeviceReferences of the same parent Device can be
         # in different locations and thus do not represent the same port
-        self._local_ports = {
-            name: port._copy(new_uid=True) for name, port in component.ports.items()
-        }
+        self._local_ports = PortDict(
+            {name: port._copy(new_uid=True) for name, port in component.ports.items()}
+        )
+        self._ports_key = None
         self.visual_label = visual_label
 
     def __repr__(self):
@@ -243,38 +257,143 @@ class ComponentReference(DeviceReference):
     @property
     def ports(self) -> Dict[str, Port]:
         """This property allows you to access myref.ports, and receive a copy
-        of the ports dict which is correctly rotated and translated"""
-        for name, port in self.parent.ports.items():
-            port = self.parent.ports[name]
-            new_midpoint, new_orientation = self._transform_port(
-                port.midpoint,
-                port.orientation,
-                self.origin,
-                self.rotation,
-                self.x_reflection,
-            )
-            if name not in self._local_ports:
-                self._local_ports[name] = port._copy(new_uid=True)
-            self._local_ports[name].midpoint = new_midpoint
-            self._local_ports[name].orientation = mod(new_orientation, 360)
-            self._local_ports[name].parent = self
-        # Remove any ports that no longer exist in the reference's parent
-        parent_names = self.parent.ports.keys()
-        local_names = list(self._local_ports.keys())
-        for name in local_names:
-            if name not in parent_names:
-                self._local_ports.pop(name)
+        of the ports dict which is correctly rotated and translated
+
+        The transformed ports are cached and only computed again when the reference
+        transformation, the parent ports or the local ports change
+        """
+        parent_ports = self.parent.ports
+        parent_version = getattr(parent_ports, "version", None)
+        origin = self.origin
+        transform = (
+            None if origin is None else tuple(np.asarray(origin).tolist()),
+            self.rotation,
+            self.x_reflection,
+        )
+        key = (transform, parent_version, self._local_ports.version)
+        if parent_version is None or key != self._ports_key:
+            self._update_ports(parent_ports)
+            self._ports_key = (transform, parent_version, self._local_ports.version)
         return self._local_ports
 
+    def _update_ports(self, parent_ports: Dict[str, Port]) -> None:
+        """ transforms all the parent ports at once into the local ports """
+        local_ports = self._local_ports
+        names = list(parent_ports.keys())
+        for name in list(local_ports.keys()):
+            if name not in parent_ports:
+                local_ports.pop(name)
+        if not names:
+            return
+
+        ports = [parent_ports[name] for name in names]
+        midpoints = np.array([port.midpoint for port in ports]).reshape(-1, 2)
+        orientations = np.array([port.orientation for port in ports])
+        midpoints, orientations = self._transform_ports(
+            midpoints, orientations, self.origin, self.rotation, self.x_reflection
+        )
+
+        for i, (name, port) in enumerate(zip(names, ports)):
+            local_port = local_ports.get(name)
+            if local_port is None:
+                local_port = port._copy(new_uid=True)
+                local_ports[name] = local_port
+            local_port._midpoint = midpoints[i]
+            local_port._orientation = orientations[i]
+            local_port.parent = self
+        local_ports.touch()
+
+    def _transform_ports(
+        self,
+        points: ndarray,
+        orientations: ndarray,
+        origin: Union[Tuple[int, int], ndarray] = (0, 0),
+        rotation: Optional[Union[float64, int, int64]] = None,
+        x_reflection: bool = False,
+    ) -> Tuple[ndarray, ndarray]:
+        """ Apply GDS-type transformations to (N, 2) points and N orientations """
+        new_points = np.array(points)
+        new_orientations = orientations
+
+        if x_reflection:
+            new_points[:, 1] = -new_points[:, 1]
+            new_orientations = -orientations
+        if rotation is not None:
+            new_points = _rotate_points(new_points, angle=rotation, center=[0, 0])
+            new_orientations = new_orientations + rotation
+        if origin is not None:
+            new_points = new_points + np.array(origin)
+        new_orientations = mod(new_orientations, 360)
+
+        return new_points, new_orientations
+
     @property
     def info(self) -> Dict[str, Union[float64, float]]:
         return self.parent.info
 
+    def _invalidate_owner(self) -> None:
+        owner = getattr(self, "owner", None)
+        if owner is not None:
+            owner._bb_valid = False
+
+    # the transformation attributes invalidate the owner bounding box when they change
+    @property
+    def origin(self):
+        return _reference_origin.__get__(self)
+
+    @origin.setter
+    def origin(self, origin) -> None:
+        _reference_origin.__set__(self, origin)
+        self._invalidate_owner()
+
+    @property
+    def rotation(self):
+        return _reference_rotation.__get__(self)
+
+    @rotation.setter
+    def rotation(self, rotation) -> None:
+        _reference_rotation.__set__(self, rotation)
+        self._invalidate_owner()
+
+    @property
+    def x_reflection(self):
+        return _reference_x_reflection.__get__(self)
+
+    @x_reflection.setter
+    def x_reflection(self, x_reflection) -> None:
+        _reference_x_reflection.__set__(self, x_reflection)
+        self._invalidate_owner()
+
+    @property
+    def magnification(self):
+        return _reference_magnification.__get__(self)
+
+    @magnification.setter
+    def magnification(self, magnification) -> None:
+        _reference_magnification.__set__(self, magnification)
+        self._invalidate_owner()
+
     @property
     def size_info(self) -> SizeInfo:
-        return SizeInfo(self.bbox)
-        # if self.__size_info__ == None:
-        # return self.__size_info__
+        """ size info of the reference
+        cached until the reference transformation or the parent geometry change
+        """
+        parent = self.parent
+        if not getattr(parent, "_bbox_is_cached", lambda: False)():
+            return SizeInfo(self.bbox)
+        origin = self.origin
+        key = (
+            None if origin is None else tuple(np.asarray(origin).tolist()),
+            self.rotation,
+            self.x_reflection,
+            self.magnification,
+            parent._geometry_version,
+        )
+        size_info_key = self.__dict__.get("_size_info_key")
+        if size_info_key != key:
+            self._size_info = SizeInfo(self.bbox)
+            self._size_info_key = key
+        return self._size_info
 
     def _transform_port(
         self,
@@ -377,7 +496,6 @@ class ComponentReference(DeviceReference):
         # This needs to be done in two steps otherwise floating point errors can accrue
         dxdy = np.array(d) - np.array(o)
         self.origin = np.array(self.origin) + dxdy
-        self._bb_valid = False
         return self
 
     def rotate(
@@ -397,7 +515,6 @@ class ComponentReference(DeviceReference):
         self.rotation += angle
         self.rotation = self.rotation % 360
         self.origin = _rotate_points(self.origin, angle, center)
-        self._bb_valid = False
         return self
 
     def reflect_h(self, port_name=None, x0=None):
@@ -454,7 +571,6 @@ class ComponentReference(DeviceReference):
         self.rotation = self.rotation % 360
         self.origin = self.origin + p1
 
-        self._bb_valid = False
         return self
 
     def connect(self, port: str, destination: Port, overlap: float = 0):
@@ -529,6 +645,7 @@ class Component(Device):
         self.info = {}
         self.aliases = {}
         self.uid = str(uuid.uuid4())[:8]
+        self._referrers = ReferrerSet()
 
         if "with_uuid" in kwargs or name == "Unnamed":
             name += "_" + self.uid
@@ -538,6 +655,128 @@ class Component(Device):
         self.name_long = None
         self.function_name = None
 
+    @property
+    def ports(self) -> Dict[str, Port]:
+        return self._ports
+
+    @ports.setter
+    def ports(self, ports: Dict[str, Port]) -> None:
+        self._ports = PortDict(ports)
+
+    @property
+    def _bb_valid(self) -> bool:
+        return self.__dict__.get("_bbox_valid", False)
+
+    @_bb_valid.setter
+    def _bb_valid(self, valid: bool) -> None:
+        """ marks the bounding box as valid or dirty
+        a dirty component also marks dirty the components that reference it
+        """
+        if valid:
+            self.__dict__["_bbox_valid"] = True
+            return
+
+        was_valid = self.__dict__.get("_bbox_valid", False)
+        self.__dict__["_bbox_valid"] = False
+        self.__dict__["_geometry_version"] = next(_geometry_versions)
+        self.__dict__["_size_info"] = None
+        self.__dict__["_bbox_tracked"] = False
+        if was_valid:
+            for reference in list(self.__dict__.get("_referrers", ())):
+                owner = getattr(reference, "owner", None)
+                if owner is not None:
+                    owner._bb_valid = False
+
+    @property
+    def _geometry_version(self) -> int:
+        """ changes every time the component (or one of its references) changes """
+        return self.__dict__.get("_geometry_version", 0)
+
+    def _bbox_is_cached(self) -> bool:
+        return self._bb_valid and self.__dict__.get("_bbox_tracked", False)
+
+    def get_bounding_box(self) -> Optional[ndarray]:
+        """ returns the bounding box [[xmin, ymin], [xmax, ymax]] or None if empty
+
+        The bounding box is cached and only computed again after the component changes.
+        References to components notify their owner when they change,
+        so the component does not need to check all its dependencies.
+        """
+        if not self._bbox_is_cached():
+            tracked = all(
+                isinstance(reference, ComponentReference)
+                and reference.owner is self
+                and isinstance(reference.parent, Component)
+                for reference in self.references
+            )
+            if not tracked:
+                # gdspy checks all the dependencies
+                self.__dict__["_bbox_tracked"] = False
+                return super().get_bounding_box()
+
+            polygons = [
+                points
+                for polygonset in self.polygons
+                for points in polygonset.polygons
+            ]
+            for path in self.paths:
+                polygons.extend(path.to_polygonset().polygons)
+            for reference in self.references:
+                bbox = reference.get_bounding_box()
+                if bbox is not None:
+                    polygons.append(bbox)
+            # a referenced component that does not cache its bounding box
+            # (for example it has arrays) does not notify this component
+            tracked = all(
+                reference.parent._bbox_is_cached() for reference in self.references
+            )
+            if polygons:
+                points = np.concatenate(polygons)
+                self._bounding_box = np.array(
+                    [points.min(axis=0), points.max(axis=0)], dtype=float
+                )
+            else:
+                self._bounding_box = None
+            self._bb_valid = True
+            self.__dict__["_bbox_tracked"] = tracked
+
+        if self._bounding_box is None:
+            return None
+        return np.array(self._bounding_box)
+
+    def add(self, element):
+        """ adds polygons, paths, labels or references
+        ComponentReferences are owned by the component
+        """
+        super().add(element)
+        elements = element if isinstance(element, (list, tuple)) else [element]
+        for e in elements:
+            if isinstance(e, ComponentReference) and e.owner is None:
+                e.owner = self
+        return self
+
+    def flatten(self, single_layer=None):
+        super().flatten(single_layer=single_layer)
+        self._bb_valid = False
+        return self
+
+    def remap_layers(self, layermap={}, include_labels=True):
+        super().remap_layers(layermap=layermap, include_labels=include_labels)
+        for component in list(self.get_dependencies(True)) + [self]:
+            if isinstance(component, Component):
+                component._bb_valid = False
+        return self
+
+    def remove_polygons(self, test):
+        super().remove_polygons(test)
+        self._bb_valid = False
+        return self
+
+    def remove_paths(self, test):
+        super().remove_paths(test)
+        self._bb_valid = False
+        return self
+
     def plot_netlist(
         self, label_index_end=1, with_labels=True, font_weight="normal",
     ):
@@ -567,9 +806,11 @@ class Component(Device):
         )
         plt.show()
 
-    def get_netlist(self, full_settings=False):
+    def get_netlist(self, full_settings=False, compiled=False):
         """returns netlist dict(instances, placements, connections)
         if full_settings: exports all the settings
+        if compiled: returns a CompiledNetlist (pp.compiled_netlist)
+        with integer instance ids and port tables
         """
         instances = {}
         placements = {}
@@ -598,13 +839,15 @@ class Component(Device):
             if src.split(",")[0] in instances:
                 connections_connected[src] = dst
 
-        netlist = OmegaConf.create(
-            dict(
-                instances=instances,
-                placements=placements,
-                connections=connections_connected,
-            )
+        netlist = dict(
+            instances=instances, placements=placements, connections=connections_connected,
         )
+        if compiled:
+            from pp.compiled_netlist import compile_netlist
+
+            return compile_netlist(netlist, strict=False)
+
+        netlist = OmegaConf.create(netlist)
         self.netlist = netlist
         return netlist
 
@@ -623,9 +866,14 @@ class Component(Device):
 
     def ports_on_grid(self) -> None:
         """ asserts if all ports ar eon grid """
-        for port in self.ports.values():
+        table = self.get_ports_table()
+        for port in table.select_list(table.off_grid_mask()):
             port.on_grid()
 
+    def get_ports_table(self) -> PortTable:
+        """ returns ports as a PortTable (struct of arrays) """
+        return get_ports_table(self.ports)
+
     def get_ports_dict(self, port_type="optical", prefix=None):
         """ returns a list of ports """
         return select_ports(self.ports, port_type=port_type, prefix=prefix)
@@ -639,20 +887,18 @@ class Component(Device):
     def get_ports_array(self) -> Dict[str, ndarray]:
         """ returns ports as a dict of np arrays"""
         self.ports_on_grid()
-        ports_array = {
-            port_name: np.array(
-                [
-                    port.x,
-                    port.y,
-                    int(port.orientation),
-                    port.width,
-                    port.layer[0],
-                    port.layer[1],
-                ]
-            )
-            for port_name, port in self.ports.items()
-        }
-        return ports_array
+        table = self.get_ports_table()
+        layers = np.array([table.layers[code] for code in table.layer_code])
+        rows = np.column_stack(
+            [
+                table.x,
+                table.y,
+                table.orientation.astype(int),
+                table.width,
+                layers.reshape(len(table), 2),
+            ]
+        )
+        return dict(zip(table.names, rows))
 
     def get_properties(self):
         """ returns name, uid, ports, aliases and numer of references """
@@ -817,8 +1063,10 @@ class Component(Device):
         return p
 
     def snap_ports_to_grid(self, nm=1):
-        for port in self.ports.values():
-            port.snap_to_grid(nm=nm)
+        table = self.get_ports_table()
+        midpoints = nm * np.round(table.midpoints * 1e3 / nm) / 1e3
+        for port, midpoint in zip(table.ports, midpoints):
+            port.midpoint = midpoint
 
     def get_json(self, **kwargs) -> Dict[str, Any]:
         """ returns JSON metadata """
@@ -871,6 +1119,7 @@ class Component(Device):
                 polygonset.datatypes = [
                     p for p, keep in zip(polygonset.datatypes, polygons_to_keep) if keep
                 ]
+            D._bb_valid = False
 
             if include_labels:
                 new_labels = []
@@ -891,10 +1140,10 @@ class Component(Device):
 
     @property
     def size_info(self) -> SizeInfo:
-        """ size info of the component """
-        # if self.__size_info__ == None:
-        # self.__size_info__  = SizeInfo(self.bbox)
-        return SizeInfo(self.bbox)  # self.__size_info__
+        """ size info of the component (cached until the component changes) """
+        if self.__dict__.get("_size_info") is None or not self._bbox_is_cached():
+            self.__dict__["_size_info"] = SizeInfo(self.bbox)
+        return self.__dict__["_size_info"]
 
     def add_ref(self, D, alias: Optional[str] = None) -> ComponentReference:
         """Takes a Component and adds it as a ComponentReference to the current
@@ -908,6 +1157,7 @@ class Component(Device):
                 )
             )
         d = ComponentReference(D)  # Create a ComponentReference (CellReference)
+        d.owner = self
         self.add(d)  # Add ComponentReference (CellReference) to Device (Cell)
 
         if alias is not None:
@@ -1032,6 +1282,10 @@ def test_netlist_simple():
     assert len(netlist["instances"]) == 2
     assert len(netlist["connections"]) == 1
 
+    netlist = c.get_netlist(compiled=True)
+    assert len(netlist) == 2
+    assert len(netlist.connections) == 1
+
 
 def test_netlist_complex():
     import pp
@@ -1043,6 +1297,95 @@ def test_netlist_complex():
     assert len(netlist["connections"]) == 18
 
 
+def test_reference_ports_cache():
+    c = Component()
+    c.add_port(name="W0", midpoint=(0, 0), orientation=180, width=0.5)
+    c.add_port(name="E0", midpoint=(10, 0), orientation=0, width=0.5)
+    ref = ComponentReference(c)
+    ports = ref.ports
+    assert ref.ports["E0"].midpoint is ports["E0"].midpoint
+
+    ref.rotate(90)
+    ref.movex(5)
+    assert np.allclose(ref.ports["E0"].midpoint, (5, 10))
+    assert ref.ports["E0"].orientation == 90
+
+    c.ports["E0"].midpoint = np.array((20, 0))
+    assert np.allclose(ref.ports["E0"].midpoint, (5, 20))
+
+    c.add_port(name="N0", midpoint=(5, 1), orientation=90)
+    assert np.allclose(ref.ports["N0"].midpoint, (4, 5))
+    c.ports.pop("N0")
+    assert "N0" not in ref.ports
+
+    # changes to the local ports are overwritten by the reference transformation
+    ref.ports["W0"].move((1, 1))
+    assert np.allclose(ref.ports["W0"].midpoint, (5, 0))
+    for name, port in ref.ports.items():
+        midpoint, orientation = ref._transform_port(
+            c.ports[name].midpoint,
+            c.ports[name].orientation,
+            ref.origin,
+            ref.rotation,
+            ref.x_reflection,
+        )
+        assert np.allclose(port.midpoint, midpoint)
+        assert port.orientation == orientation
+
+
+def test_bbox_cache():
+    import pp
+
+    c = Component()
+    ref = c << pp.c.rectangle(size=(4, 2))
+    top = Component()
+    top_ref = top << c
+    assert top.size_info.east == 4
+    assert top.size_info is top.size_info
+
+    ref.movex(10)
+    assert np.allclose(c.bbox, [(10, 0), (14, 2)])
+    assert top.size_info.east == 14
+    assert top_ref.size_info.east == 14
+
+    ref.rotation = 90
+    assert np.allclose(top.bbox, [(8, 0), (10, 4)])
+
+    top_ref.movey(5)
+    assert top.ymax == 9
+    assert top_ref.size_info.north == 9
+
+    # arrays do not notify their owner, so their owners do not cache
+    child = Component()
+    child.add_polygon([(0, 0), (1, 0), (1, 1)], layer=1)
+    mid = Component()
+    mid.add_array(child, columns=3, rows=1, spacing=(2.5, 0))
+    top = Component()
+    top << mid
+    assert np.allclose(top.bbox, [(0, 0), (6, 1)])
+    child.add_polygon([(0, 0), (1, 0), (1, 20)], layer=1)
+    assert np.allclose(top.bbox, [(0, 0), (6, 20)])
+
+
+def test_get_ports_array():
+    import pp
+
+    c = pp.c.mmi2x2()
+    ports_array = c.get_ports_array()
+    for port_name, port in c.ports.items():
+        expected = np.array(
+            [
+                port.x,
+                port.y,
+                int(port.orientation),
+                port.width,
+                port.layer[0],
+                port.layer[1],
+            ]
+        )
+        assert np.array_equal(ports_array[port_name], expected)
+
+
 def demo_component(port):
     c = Component()
     c.add_port(name="p1", port=port)
@@ -2,25 +2,14 @@
 
 """
 
-from typing import Union, IO, Any
+from typing import Union, IO, Any, Callable, Dict, List, Optional, Set, Tuple
 import pathlib
-import io
-from omegaconf import OmegaConf
-
-from pp.component import Component
-from pp.components import component_type2factory as component_type2factory_default
-from pp.routing import link_optical_ports
-
-valid_placements = ["x", "y", "rotation", "mirror"]
-valid_keys = [
-    "name",
-    "instances",
-    "placements",
-    "connections",
-    "ports",
-    "routes",
-    "bundle_routes",
-]
+import networkx as nx
+
+from pp.compiled_netlist import CompiledNetlist, compile_netlist, valid_keys
+from pp.component import Component, ComponentReference
+from pp.executor import fork_map, share_cells, share_components
+from pp.port import Port
 
 sample_mmis = """
 name:
@@ -112,8 +101,141 @@ connections:
 """
 
 
+def get_dependency_graph(netlist: CompiledNetlist) -> nx.DiGraph:
+    """ returns the graph of what depends on each instance of a YAML component
+
+    nodes are the instance names, `route:<route name>` and `port:<port name>`
+    an edge a -> b means that b changes when a changes: instances are connected
+    to (moved to) other instances, routes and ports depend on their instances
+    """
+    names = netlist.instance_names
+    ports = netlist.ports
+    graph = nx.DiGraph()
+    graph.add_nodes_from(names)
+    for src, dst in netlist.connections:
+        graph.add_edge(names[ports[dst][0]], names[ports[src][0]])
+    for route_name, (src, dst) in netlist.routes.items():
+        graph.add_edge(names[ports[src][0]], f"route:{route_name}")
+        graph.add_edge(names[ports[dst][0]], f"route:{route_name}")
+    for bundle_name, bundle in netlist.bundle_routes.items():
+        for src, dst in bundle:
+            graph.add_edge(names[ports[src][0]], f"route:{bundle_name}")
+            graph.add_edge(names[ports[dst][0]], f"route:{bundle_name}")
+    for port_name, port_id in netlist.exposed_ports.items():
+        graph.add_edge(names[ports[port_id][0]], f"port:{port_name}")
+    return graph
+
+
+def _build_component(factory: Callable, settings: Dict[str, Any]) -> Component:
+    return factory(**settings)
+
+
+def get_route_key(ports1: List[Port], ports2: List[Port]) -> Tuple:
+    """ returns the geometry of the ports of a route (or bundle) """
+    return tuple(
+        (
+            round(float(port.x), 6),
+            round(float(port.y), 6),
+            round(float(port.orientation), 6),
+            round(float(port.width), 6),
+            tuple(port.layer),
+        )
+        for port in ports1 + ports2
+    )
+
+
+def _copy_reference(reference: ComponentReference) -> ComponentReference:
+    return ComponentReference(
+        reference.parent,
+        origin=tuple(reference.origin),
+        rotation=reference.rotation,
+        magnification=reference.magnification,
+        x_reflection=reference.x_reflection,
+    )
+
+
+class RouteCache:
+    """ routes of the last component_from_yaml build, so that reloading an
+    edited YAML only reroutes the routes that depend on instances that changed
+    (settings, placement or connection), the other routes reuse their geometry
+
+    .. code::
+
+        route_cache = RouteCache()
+        c = component_from_yaml(yaml, route_cache=route_cache)
+        c = component_from_yaml(edited_yaml, route_cache=route_cache)
+        print(route_cache.rerouted)
+
+    Attributes:
+        graph: dependency graph of the last build (get_dependency_graph)
+        routes: {route name: (route key, references)}
+        rerouted: names of the routes computed (not reused) in the last build
+    """
+
+    def __init__(self) -> None:
+        self.graph = nx.DiGraph()
+        self.routes = {}
+        self.rerouted = []
+        self._instances = {}
+
+    def get_changed(
+        self, netlist: CompiledNetlist, graph: nx.DiGraph, **kwargs
+    ) -> Set[str]:
+        """ returns the nodes of the graph that changed since the last build
+        (changed instances and everything that depends on them)
+        """
+        connected_to = [[] for _ in range(len(netlist))]
+        for src, dst in netlist.connections:
+            connected_to[netlist.ports[src][0]].append(
+                (netlist.get_port_string(src), netlist.get_port_string(dst))
+            )
+        instances = {}
+        for instance_id, instance_name in enumerate(netlist.instance_names):
+            instances[instance_name] = (
+                netlist.component_types[instance_id],
+                netlist.settings[instance_id],
+                netlist.placements[instance_id],
+                connected_to[instance_id],
+                kwargs,
+            )
+        changed = {
+            instance_name
+            for instance_name, settings in instances.items()
+            if self._instances.get(instance_name) != settings
+        }
+        self._instances = instances
+        self.graph = graph
+
+        for instance_name in list(changed):
+            changed |= nx.descendants(graph, instance_name)
+        return changed
+
+    def get_routes(
+        self, route_name: str, key: Tuple, changed: Set[str]
+    ) -> Optional[List[ComponentReference]]:
+        """ returns new references to the cached route geometry
+        or None if the route needs to be computed
+        """
+        cached = self.routes.get(route_name)
+        if cached is None or f"route:{route_name}" in changed or cached[0] != key:
+            return None
+        return [_copy_reference(reference) for reference in cached[1]]
+
+    def update(
+        self,
+        routes: Dict[str, Tuple[Tuple, List[ComponentReference]]],
+        rerouted: List[str],
+    ) -> None:
+        self.routes = routes
+        self.rerouted = rerouted
+
+
 def component_from_yaml(
-    yaml: Union[str, pathlib.Path, IO[Any]], component_type2factory=None, **kwargs
+    yaml: Union[str, pathlib.Path, IO[Any]],
+    component_type2factory=None,
+    processes: int = 1,
+    route_cache: Optional[RouteCache] = None,
+    **kwargs,
 ) -> Component:
     """Returns a Component defined from YAML
 
@@ -131,178 +253,142 @@ def component_from_yaml(
     Args:
         yaml: YAML IO describing Component (instances, placements, routing, ports, connections)
         component_type2factory: dict of {factory_name: factory_function}
+        processes: distinct instances (component and settings) are built and
+            routes and bundle_routes are routed on a process pool
+            (1 builds and routes in this process, None uses all the CPUs)
+        route_cache: reuses the routes of the last build with this RouteCache
+            that do not depend on instances that changed
         kwargs: cache, pins ... to pass to all factories
 
     Returns:
         Component
 
     """
-    yaml = io.StringIO(yaml) if isinstance(yaml, str) and "\n" in yaml else yaml
-    component_type2factory = component_type2factory or component_type2factory_default
-
-    conf = OmegaConf.load(yaml)
-    for key in conf.keys():
-        assert key in valid_keys, f"{key} not in {list(valid_keys)}"
-
-    instances = {}
-    routes = {}
-    name = conf.get("name") or "Unnamed"
-    c = Component(name)
-    placements_conf = conf.get("placements")
-    routes_conf = conf.get("routes")
-    bundle_routes_conf = conf.get("bundle_routes")
-    ports_conf = conf.get("ports")
-    connections_conf = conf.get("connections")
-
-    for instance_name in conf.instances:
-        instance_conf = conf.instances[instance_name]
-        component_type = instance_conf["component"]
-        assert (
-            component_type in component_type2factory
-        ), f"{component_type} not in {list(component_type2factory.keys())}"
-        component_settings = instance_conf["settings"] or {}
-        component_settings.update(**kwargs)
-        ci = component_type2factory[component_type](**component_settings)
+    from pp.routing import link_optical_ports
+    from pp.routing.route_executor import route_bundles
+
+    netlist = compile_netlist(yaml, component_type2factory)
+    for key in netlist.keys:
+        if key not in valid_keys:
+            raise ValueError(f"{key} not in {list(valid_keys)}")
+
+    # build each distinct (component, settings) once, on a process pool
+    # (cache=False builds a new component for each instance)
+    builds = {}
+    build_ids = []
+    uncached_build_ids = set()
+    for instance_id, component_type in enumerate(netlist.component_types):
+        settings = dict(netlist.settings[instance_id], **kwargs)
+        key = (component_type, repr(sorted(settings.items())))
+        if settings.get("cache", True) is False:
+            key = instance_id
+            uncached_build_ids.add(len(builds))
+        if key not in builds:
+            builds[key] = (len(builds), netlist.factories[instance_id], settings)
+        build_ids.append(builds[key][0])
+    components = fork_map(
+        _build_component,
+        [(factory, settings) for _, factory, settings in builds.values()],
+        processes=processes,
+    )
+    if processes != 1 and len(components) > 1:
+        cells = {}
+        for build_id, component in enumerate(components):
+            if build_id in uncached_build_ids:
+                # one component per instance, only its sub-cells are shared
+                share_cells(component.references, cells)
+            else:
+                components[build_id] = share_components([component], cells)[0]
+
+    instances = []
+    c = Component(netlist.name or "Unnamed")
+
+    for instance_id, instance_name in enumerate(netlist.instance_names):
+        ci = components[build_ids[instance_id]]
         ci.name = instance_name
         ref = c << ci
-        instances[instance_name] = ref
-
-        if placements_conf:
-            placement_settings = placements_conf[instance_name] or {}
-            for k, v in placement_settings.items():
-                if k not in valid_placements:
-                    raise ValueError(
-                        f"`{k}` not valid placement {valid_placements} for"
-                        f" {instance_name}"
-                    )
-                elif k == "rotation":
-                    ref.rotate(v, (ci.x, ci.y))
-                elif k == "mirror":
-                    ref.mirror((v[0], v[1]), (v[2], v[3]))
-                else:
-                    setattr(ref, k, v)
-
-    if connections_conf:
-        for port_src_string, port_dst_string in connections_conf.items():
-            instance_src_name, port_src_name = port_src_string.split(",")
-            instance_dst_name, port_dst_name = port_dst_string.split(",")
-
-            instance_src_name = instance_src_name.strip()
-            instance_dst_name = instance_dst_name.strip()
-            port_src_name = port_src_name.strip()
-            port_dst_name = port_dst_name.strip()
-
-            assert (
-                instance_src_name in instances
-            ), f"{instance_src_name} not in {list(instances.keys())}"
-            assert (
-                instance_dst_name in instances
-            ), f"{instance_dst_name} not in {list(instances.keys())}"
-            instance_src = instances[instance_src_name]
-            instance_dst = instances[instance_dst_name]
-
-            assert port_src_name in instance_src.ports, (
-                f"{port_src_name} not in {list(instance_src.ports.keys())} for"
-                f" {instance_src_name} "
-            )
-            assert port_dst_name in instance_dst.ports, (
-                f"{port_dst_name} not in {list(instance_dst.ports.keys())} for"
-                f" {instance_dst_name}"
-            )
-            port_dst = instance_dst.ports[port_dst_name]
-            instance_src.connect(port=port_src_name, destination=port_dst)
-
-    if routes_conf:
-        for port_src_string, port_dst_string in routes_conf.items():
-            instance_src_name, port_src_name = port_src_string.split(",")
-            instance_dst_name, port_dst_name = port_dst_string.split(",")
-
-            instance_src_name = instance_src_name.strip()
-            instance_dst_name = instance_dst_name.strip()
-            port_src_name = port_src_name.strip()
-            port_dst_name = port_dst_name.strip()
-
-            assert (
-                instance_src_name in instances
-            ), f"{instance_src_name} not in {list(instances.keys())}"
-            assert (
-                instance_dst_name in instances
-            ), f"{instance_dst_name} not in {list(instances.keys())}"
-
-            instance_in = instances[instance_src_name]
-            instance_out = instances[instance_dst_name]
-
-            assert port_src_name in instance_in.ports, (
-                f"{port_src_name} not in {list(instance_in.ports.keys())} for"
-                f" {instance_src_name} "
-            )
-            assert port_dst_name in instance_out.ports, (
-                f"{port_dst_name} not in {list(instance_out.ports.keys())} for"
-                f" {instance_dst_name}"
-            )
+        instances.append(ref)
+        netlist.check_ports(instance_id, ref.ports)
+
+        placement_settings = netlist.placements[instance_id] or {}
+        for k, v in placement_settings.items():
+            if k == "rotation":
+                ref.rotate(v, (ci.x, ci.y))
+            elif k == "mirror":
+                ref.mirror((v[0], v[1]), (v[2], v[3]))
+            else:
+                setattr(ref, k, v)
+
+    def get_port(port_id: int) -> Port:
+        instance_id, port_name = netlist.ports[port_id]
+        return instances[instance_id].ports[port_name]
+
+    # each instance is connected after the instance it connects to
+    for src, dst in netlist.get_connections_sorted():
+        instance_id, port_name = netlist.ports[src]
+        instances[instance_id].connect(port=port_name, destination=get_port(dst))
+
+    route_names = []  # names of routes and bundle_routes
+    bundles = []  # (ports1, ports2) of each route and bundle route
+    for route_name, (src, dst) in netlist.routes.items():
+        route_names.append(route_name)
+        bundles.append(([get_port(src)], [get_port(dst)]))
+    nb_single_routes = len(route_names)
+    for bundle_name, bundle in netlist.bundle_routes.items():
+        route_names.append(bundle_name)
+        bundles.append(
+            ([get_port(src) for src, _ in bundle], [get_port(dst) for _, dst in bundle])
+        )
+
+    # routes do not depend on each other
+    route_keys = [get_route_key(*bundle) for bundle in bundles]
+    route_references = {}
+    if route_cache is not None:
+        changed = route_cache.get_changed(
+            netlist, get_dependency_graph(netlist), **kwargs
+        )
+        for route_name, key in zip(route_names, route_keys):
+            references = route_cache.get_routes(route_name, key, changed)
+            if references is not None:
+                route_references[route_name] = references
+
+    rerouted = [
+        route_name for route_name in route_names if route_name not in route_references
+    ]
+    bundles_to_route = [
+        bundle
+        for route_name, bundle in zip(route_names, bundles)
+        if route_name not in route_references
+    ]
+    for route_name, references in zip(
+        rerouted,
+        route_bundles(
+            bundles_to_route, routing_func=link_optical_ports, processes=processes
+        ),
+    ):
+        route_references[route_name] = references
 
-            port_src = instance_in.ports[port_src_name]
-            port_out = instance_out.ports[port_dst_name]
-
-            route = link_optical_ports([port_src], [port_out])
-            c.add(route)
-            routes[f"{port_src_string}:{port_dst_string}"] = route[0]
-
-    if bundle_routes_conf:
-        for route in bundle_routes_conf:
-            ports1 = []
-            ports2 = []
-            routes = bundle_routes_conf[route]
-            for port_src_string, port_dst_string in routes.items():
-                instance_src_name, port_src_name = port_src_string.split(",")
-                instance_dst_name, port_dst_name = port_dst_string.split(",")
-
-                instance_src_name = instance_src_name.strip()
-                instance_dst_name = instance_dst_name.strip()
-                port_src_name = port_src_name.strip()
-                port_dst_name = port_dst_name.strip()
-
-                assert (
-                    instance_src_name in instances
-                ), f"{instance_src_name} not in {list(instances.keys())}"
-                assert (
-                    instance_dst_name in instances
-                ), f"{instance_dst_name} not in {list(instances.keys())}"
-
-                instance_in = instances[instance_src_name]
-                instance_out = instances[instance_dst_name]
-
-                assert port_src_name in instance_in.ports, (
-                    f"{port_src_name} not in {list(instance_in.ports.keys())} for"
-                    f" {instance_src_name} "
-                )
-                assert port_dst_name in instance_out.ports, (
-                    f"{port_dst_name} not in {list(instance_out.ports.keys())} for"
-                    f" {instance_dst_name}"
-                )
-
-                ports1.append(instance_in.ports[port_src_name])
-                ports2.append(instance_out.ports[port_dst_name])
-            route = link_optical_ports(ports1, ports2)
-            c.add(route)
-
-    if ports_conf:
-        assert hasattr(ports_conf, "items"), f"{ports_conf} needs to be a dict"
-        for port_name, instance_comma_port in ports_conf.items():
-            instance_name, instance_port_name = instance_comma_port.split(",")
-            instance_name = instance_name.strip()
-            instance_port_name = instance_port_name.strip()
-            assert (
-                instance_name in instances
-            ), f"{instance_name} not in {list(instances.keys())}"
-            instance = instances[instance_name]
-            assert instance_port_name in instance.ports, (
-                f"{instance_port_name} not in {list(instance.ports.keys())} for"
-                f" {instance_name} "
-            )
-            c.add_port(port_name, port=instance.ports[instance_port_name])
-    c.instances = instances
+    routes = {}
+    for i, route_name in enumerate(route_names):
+        route = route_references[route_name]
+        c.add(route)
+        if i < nb_single_routes:
+            routes[route_name] = route[0]
+
+    if route_cache is not None:
+        route_cache.update(
+            {
+                route_name: (key, route_references[route_name])
+                for route_name, key in zip(route_names, route_keys)
+            },
+            rerouted,
+        )
+
+    for port_name, port_id in netlist.exposed_ports.items():
+        c.add_port(port_name, port=get_port(port_id))
+    c.instances = dict(zip(netlist.instance_names, instances))
     c.routes = routes
+    c.compiled_netlist = netlist
     return c
 
 
@@ -366,6 +452,13 @@ def test_connections_2x2_problem():
     return c
 
 
+def test_connections_2x2_problem_processes():
+    c = component_from_yaml(sample_2x2_connections_problem, cache=False, processes=2)
+    assert len(c.get_dependencies()) == 4
+    assert c.instances["mmi_bottom"].parent.name == "mmi_bottom"
+    assert c.instances["mmi_top"].parent.name == "mmi_top"
+
+
 sample_2x2_connections_solution = """
 name:
     connections_2x2_solution
@@ -402,6 +495,105 @@ def test_connections_2x2_solution():
     return c
 
 
+def test_routes_processes():
+    """ routes on a process pool are the same as routes in this process """
+    import numpy as np
+
+    c1 = component_from_yaml(sample_2x2_connections_solution)
+    c2 = component_from_yaml(sample_2x2_connections_solution, processes=2)
+    assert np.allclose(c1.bbox, c2.bbox)
+    assert len(c1.references) == len(c2.references)
+
+    c1 = component_from_yaml(sample_mmis)
+    c2 = component_from_yaml(sample_mmis, processes=2)
+    assert list(c1.routes) == list(c2.routes)
+    assert np.allclose(c1.bbox, c2.bbox)
+
+
+def test_instances_processes():
+    """ distinct instances are built once, connections follow dependencies """
+    import numpy as np
+
+    yaml = """
+instances:
+    wg1:
+      component: waveguide
+      settings:
+        length: 3.1
+        width: 0.6
+    wg2:
+      component: waveguide
+      settings:
+        length: 3.2
+        width: 0.6
+    wg3:
+      component: waveguide
+      settings:
+        length: 3.1
+        width: 0.6
+placements:
+    wg1:
+        x: 10
+connections:
+    wg3,W0: wg2,E0
+    wg2,W0: wg1,E0
+"""
+    c2 = component_from_yaml(yaml, processes=2)
+    c1 = component_from_yaml(yaml)
+    assert c1.instances["wg1"].parent is c1.instances["wg3"].parent
+    assert c2.instances["wg1"].parent is c2.instances["wg3"].parent
+    for c in [c1, c2]:
+        x = c.instances["wg1"].ports["E0"].x + 3.2 + 3.1
+        assert np.isclose(c.instances["wg3"].ports["E0"].x, x)
+    assert np.allclose(c1.bbox, c2.bbox)
+
+
+def test_route_cache():
+    """ moving one instance only reroutes the routes connected to it """
+    yaml = """
+instances:
+    mmi_left:
+      component: mmi1x2
+      settings:
+        length_mmi: 6
+    mmi_right:
+      component: mmi1x2
+      settings:
+        length_mmi: 7
+    mmi_top:
+      component: mmi1x2
+      settings:
+        length_mmi: 8
+placements:
+    mmi_right:
+        x: 100
+        rotation: 180
+    mmi_top:
+        x: 100
+        y: DY
+        rotation: 180
+routes:
+    mmi_left,E1: mmi_top,E1
+bundle_routes:
+    bottom:
+        mmi_left,E0: mmi_right,E0
+"""
+    route_cache = RouteCache()
+    c1 = component_from_yaml(yaml.replace("DY", "100"), route_cache=route_cache)
+    assert sorted(route_cache.rerouted) == ["bottom", "mmi_left,E1:mmi_top,E1"]
+    assert "route:bottom" in route_cache.graph.successors("mmi_right")
+
+    c2 = component_from_yaml(yaml.replace("DY", "150"), route_cache=route_cache)
+    assert route_cache.rerouted == ["mmi_left,E1:mmi_top,E1"]
+    assert len(c2.references) == len(c1.references)
+    bottom1 = [r for r in c1.references if r.parent.name.startswith("zz_conn")]
+    bottom2 = [r for r in c2.references if r.parent.name.startswith("zz_conn")]
+    assert bottom1[-1].parent is bottom2[-1].parent
+
+    component_from_yaml(yaml.replace("DY", "150"), route_cache=route_cache)
+    assert route_cache.rerouted == []
+
+
 if __name__ == "__main__":
 
     # c = test_connections_2x2_problem()
@@ -27,14 +27,14 @@ def _bend_euler(
     c.radius = radius
     c.add_port(
         name="in0",
-        midpoint=np.round(backbone[0].xy, 3),
+        midpoint=np.round(backbone[0], 3),
         orientation=180,
         layer=layer,
         width=width,
     )
     c.add_port(
         name="out0",
-        midpoint=np.round(backbone[-1].xy, 3),
+        midpoint=np.round(backbone[-1], 3),
         orientation=theta,
         layer=layer,
         width=width,
@@ -1,14 +1,15 @@
-from typing import List, Union
+from collections import OrderedDict
+from typing import Tuple, Union
 
 from scipy.special import fresnel
-from numpy import pi, sqrt
+from numpy import ndarray, pi, sqrt
 import numpy as np
-from pp.coord2 import Coord2
 
 DEG2RAD = np.pi / 180
 
-# Dict for caching Euler bend point lists
-__euler_bend_cache__ = dict()
+# LRU cache of Euler bend points, bounded to __euler_bend_cache_size__ entries
+__euler_bend_cache__ = OrderedDict()
+__euler_bend_cache_size__ = 256
 
 
 def euler_bend_points(
@@ -16,11 +17,14 @@ def euler_bend_points(
     radius: float = 10.0,
     resolution: float = 150.0,
     use_cache: bool = True,
-) -> List[Coord2]:
-    """ Base euler bend, no transformation, emerging from the origin."""
+) -> ndarray:
+    """ Base euler bend, no transformation, emerging from the origin.
+    returns numpy 2D array of shape (N, 2) (read only when it comes from the cache)
+    """
     # Check if we've calculated this already
     key = (angle_amount, radius, resolution)
-    if key in __euler_bend_cache__ and use_cache:
+    if use_cache and key in __euler_bend_cache__:
+        __euler_bend_cache__.move_to_end(key)
         return __euler_bend_cache__[key]
 
     if angle_amount < 0:
@@ -30,7 +34,7 @@ def euler_bend_points(
 
     # If bend is trivial, return a trivial shape
     if eth == 0.0:
-        return [Coord2(0, 0)]
+        return np.zeros((1, 2))
 
     # Curve min radius
     R = radius
@@ -45,57 +49,45 @@ def euler_bend_points(
     a = sqrt(R ** 2.0 * np.abs(th))
     sq2pi = sqrt(2.0 * pi)
 
-    # Function for computing curve coords
     (fasin, facos) = fresnel(sqrt(2.0 / pi) * R * th / a)
 
-    def _xy(s):
-        if th == 0:
-            return Coord2(0.0, 0.0)
-        elif s <= Ltot / 2:
-            (fsin, fcos) = fresnel(s / (sq2pi * a))
-            X = sq2pi * a * fcos
-            Y = sq2pi * a * fsin
-        else:
-            (fsin, fcos) = fresnel((Ltot - s) / (sq2pi * a))
-            X = (
-                sq2pi
-                * a
-                * (
-                    facos
-                    + np.cos(2 * th) * (facos - fcos)
-                    + np.sin(2 * th) * (fasin - fsin)
-                )
-            )
-            Y = (
-                sq2pi
-                * a
-                * (
-                    fasin
-                    - np.cos(2 * th) * (fasin - fsin)
-                    + np.sin(2 * th) * (facos - fcos)
-                )
-            )
-        return Coord2(X, Y)
-
     # Parametric step size
     step = Ltot / int(th * resolution)
-
-    # Generate points
-    points = []
-    for i in range(0, int(round(Ltot / step)) + 1):
-        points += [_xy(i * step)]
+    s = np.arange(int(round(Ltot / step)) + 1) * step
+
+    # first half of the curve is a clothoid from the start point
+    # second half is the mirrored clothoid from the end point
+    first_half = s <= Ltot / 2
+    (fsin, fcos) = fresnel(np.where(first_half, s, Ltot - s) / (sq2pi * a))
+    X = np.where(
+        first_half,
+        fcos,
+        facos + np.cos(2 * th) * (facos - fcos) + np.sin(2 * th) * (fasin - fsin),
+    )
+    Y = np.where(
+        first_half,
+        fsin,
+        fasin - np.cos(2 * th) * (fasin - fsin) + np.sin(2 * th) * (facos - fcos),
+    )
+    points = sq2pi * a * np.column_stack((X, Y))
 
     # Cache calculated points
     if use_cache:
-        __euler_bend_cache__[(angle_amount, radius, resolution)] = points
+        points.flags.writeable = False
+        __euler_bend_cache__[key] = points
+        while len(__euler_bend_cache__) > __euler_bend_cache_size__:
+            __euler_bend_cache__.popitem(last=False)
 
     return points
 
 
 def euler_end_pt(
-    start_point=(0.0, 0.0), radius=10.0, input_angle=0.0, angle_amount=90.0
-):
-    """Gives the end point of a simple Euler bend as a Coord2"""
+    start_point: Tuple[float, float] = (0.0, 0.0),
+    radius: float = 10.0,
+    input_angle: float = 0.0,
+    angle_amount: float = 90.0,
+) -> ndarray:
+    """Gives the end point of a simple Euler bend as a numpy array (x, y)"""
 
     th = abs(angle_amount) * DEG2RAD / 2.0
     R = radius
@@ -111,11 +103,26 @@ def euler_end_pt(
     if clockwise:
         Y *= -1
 
-    pt = Coord2(X, Y) + start_point
-    pt.rotate(rotation_center=start_point, rotation=input_angle)
-    return pt
+    angle = input_angle * DEG2RAD
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([c * X - s * Y, s * X + c * Y]) + start_point
 
 
 def euler_length(radius: Union[int, float] = 10.0, angle_amount: int = 90.0) -> float:
     th = abs(angle_amount) * DEG2RAD / 2
     return 4 * radius * th
+
+
+def test_euler_bend_points():
+    points = euler_bend_points(90, radius=10, resolution=150, use_cache=False)
+    assert points.shape == (len(points), 2)
+    assert np.allclose(points[0], (0, 0))
+    assert np.allclose(points[-1], euler_end_pt(radius=10, angle_amount=90))
+
+    length = np.sum(np.hypot(*np.diff(points, axis=0).T))
+    assert np.isclose(length, euler_length(10, 90), rtol=1e-4)
+
+    assert euler_bend_points(90) is euler_bend_points(90)
+    for radius in range(__euler_bend_cache_size__ + 1):
+        euler_bend_points(90, radius=radius + 1)
+    assert len(__euler_bend_cache__) == __euler_bend_cache_size__
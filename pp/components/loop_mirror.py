@@ -2,7 +2,7 @@
 """
 
 import pp
-from pp.routing import route_manhattan
+from pp.routing.manhattan import route_manhattan
 from pp.components.mmi1x2 import mmi1x2
 from pp.components.euler.bend_euler import bend_euler90
 from pp.components.spiral_external_io import spiral_external_io
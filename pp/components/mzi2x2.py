@@ -5,7 +5,7 @@ from pp.components import waveguide
 from pp.components import coupler
 from pp.netlist_to_gds import netlist_to_component
 from pp.name import autoname
-from pp.routing import route_elec_ports_to_side
+from pp.routing.route_ports_to_side import route_elec_ports_to_side
 from pp.port import select_electrical_ports
 
 from pp.components.extension import line
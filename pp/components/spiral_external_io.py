@@ -7,7 +7,7 @@ import pp
 from pp.components.bend_circular import bend_circular
 from pp.components.bend_circular import bend_circular180
 from pp.components import waveguide
-from pp.routing import round_corners
+from pp.routing.manhattan import round_corners
 from numpy import float64
 from pp.component import Component
 from typing import Callable, Optional, Tuple
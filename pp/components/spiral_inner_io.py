@@ -8,7 +8,7 @@ from pp.components.bend_circular import bend_circular
 from pp.components.bend_circular import bend_circular180
 from pp.components.euler.bend_euler import bend_euler90, bend_euler180
 from pp.components.waveguide import waveguide
-from pp.routing import round_corners
+from pp.routing.manhattan import round_corners
 from pp.config import TAPER_LENGTH
 from pp.component import Component
 from typing import Callable, Optional, Tuple
@@ -9,7 +9,8 @@
 """
 
 __version__ = "1.4.2"
-from typing import Any
+from typing import Any, Optional
+import functools
 import os
 import io
 import json
@@ -20,7 +21,6 @@ import logging
 
 import numpy as np
 from omegaconf import OmegaConf
-from git import Repo
 
 
 connections = {}  # global variable to store connections in a dict
@@ -49,6 +49,14 @@ tech:
     grid_unit: 1e-6
     grid_resolution: 1e-9
     bend_radius: 10.0
+cache:
+    max_entries: 100000
+    max_bytes: 4000000000
+    disk: False
+    disk_directory:
+    connectors: False
+routing:
+    straight_polygons: False
 """
     )
 )
@@ -66,10 +74,22 @@ except Exception:
 conf = OmegaConf.merge(config_base, config_home, config_cwd)
 conf.version = __version__
 
-try:
-    conf["git_hash"] = Repo(repo_path).head.object.hexsha
-except Exception:
-    conf["git_hash"] = None
+
+@functools.lru_cache(maxsize=None)
+def get_repo_hash(*args) -> Optional[str]:
+    """ returns the git hash of the pp repo (None if it is not a git repo)
+    conf.git_hash resolves it (and imports GitPython) the first time it is read
+    """
+    try:
+        from git import Repo
+
+        return Repo(repo_path).head.object.hexsha
+    except Exception:
+        return None
+
+
+OmegaConf.register_resolver("pp_git_hash", get_repo_hash)
+conf["git_hash"] = "${pp_git_hash:}"
 
 
 CONFIG = dict(
@@ -101,8 +121,17 @@ CONFIG["gdslib"] = conf.gdslib or repo_path / "gdslib"
 CONFIG["sp"] = CONFIG["gdslib"] / "sp"
 CONFIG["gds"] = CONFIG["gdslib"] / "gds"
 CONFIG["gdslib_test"] = home_path / "gdslib_test"
+CONFIG["component_cache_directory"] = (
+    pathlib.Path(conf.cache.disk_directory)
+    if conf.cache.disk_directory
+    else home_path / "cache" / "components"
+)
 
 CONFIG["build_directory"] = build_directory
+# build profile records survive `pf mask clean` (outside build_directory)
+CONFIG["build_profile"] = (
+    mask_config_directory if conf.get("mask") else home_path
+) / "build_profile.jsonl"
 CONFIG["gds_directory"] = build_directory / "devices"
 CONFIG["cache_doe_directory"] = build_directory / "cache_doe"
 CONFIG["doe_directory"] = build_directory / "doe"
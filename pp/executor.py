@@ -0,0 +1,154 @@
+""" run functions that return components on a forked process pool
+
+Workers are forked, so the functions and their arguments do not need to be
+pickled. The results come back pickled and in the order of the arguments, so
+they do not depend on which worker finishes first. Cells that were in memory
+before forking are pickled by name and not copied.
+
+Results built in different workers do not share cells, `share_cells` and
+`share_components` merge the cells with the same name into one cell (a layout
+can only have one cell per name), reusing the cells already in memory
+(pp.cache.NAME_TO_DEVICE).
+"""
+
+import copyreg
+import io
+import multiprocessing
+import os
+import pickle
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pp.cache import NAME_TO_DEVICE, get_cached_cell, share_references
+from pp.component import Component, ComponentReference
+
+# tasks run by fork_map workers and cells in memory before forking
+# (inherited when forking)
+_tasks = []
+_cells_before_fork = {}
+
+
+def _get_cell_before_fork(name: str) -> Any:
+    return _cells_before_fork[name]
+
+
+def _reduce_component(component: Component) -> Any:
+    """ pickles the cells that the parent process has by name """
+    if _cells_before_fork.get(component.name) is component:
+        return _get_cell_before_fork, (component.name,)
+    return component.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+
+
+def _run_task(index: int) -> bytes:
+    function, args, kwargs = _tasks[index]
+    result = function(*args, **kwargs)
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[Component] = _reduce_component
+    pickler.dump(result)
+    return f.getvalue()
+
+
+def can_fork() -> bool:
+    """ returns True if this process can fork a pool of workers """
+    return (
+        "fork" in multiprocessing.get_all_start_methods()
+        and not multiprocessing.current_process().daemon
+    )
+
+
+def fork_map(
+    function: Callable,
+    args: List[Tuple],
+    processes: Optional[int] = None,
+    **kwargs,
+) -> List[Any]:
+    """ returns [function(*a, **kwargs) for a in args] computed on a forked pool
+
+    when forking is not possible (or processes=1) it runs in this process
+
+    Args:
+        function: function to call
+        args: list of positional arguments tuples, one per call
+        processes: number of worker processes (defaults to the number of CPUs)
+        kwargs: for all the calls
+
+    Returns:
+        list of results (components do not share cells, see share_cells)
+    """
+    global _tasks, _cells_before_fork
+
+    if not args:
+        return []
+    processes = processes or os.cpu_count() or 1
+    processes = min(processes, len(args))
+
+    if processes == 1 or not can_fork():
+        return [function(*a, **kwargs) for a in args]
+
+    _tasks = [(function, a, kwargs) for a in args]
+    _cells_before_fork = dict(NAME_TO_DEVICE.items())
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes) as pool:
+            results = pool.map(_run_task, range(len(args)))
+        return [pickle.loads(data) for data in results]
+    finally:
+        _tasks = []
+        _cells_before_fork = {}
+
+
+def share_cells(
+    references: List[ComponentReference], cells: Dict[str, Any]
+) -> List[ComponentReference]:
+    """ makes references to cells with the same name point to one cell
+
+    Args:
+        references: references that come from another process
+        cells: dict of cells by name that are already shared (updated)
+
+    Returns:
+        references
+    """
+
+    def get_shared(cell):
+        cell = get_cached_cell(cell)
+        name = cell.name
+        if name not in cells:
+            cells[name] = NAME_TO_DEVICE[name] if name in NAME_TO_DEVICE else cell
+        return cells[name]
+
+    share_references(SimpleNamespace(references=references), get_shared)
+    return references
+
+
+def share_components(
+    components: List[Component], cells: Dict[str, Any]
+) -> List[Component]:
+    """ returns the components (and their cells) shared with the cells
+    with the same name (see share_cells)
+    """
+    references = share_cells([ComponentReference(c) for c in components], cells)
+    return [reference.parent for reference in references]
+
+
+def test_fork_map():
+    import pp
+
+    def waveguide(length):
+        return pp.c.waveguide(length=length, width=0.6)
+
+    args = [(11.1,), (12.2,), (11.1,)]
+    cells = {}
+    parallel = share_components(fork_map(waveguide, args, processes=2), cells)
+    assert parallel[0] is parallel[2]
+    assert parallel[0] is not parallel[1]
+
+    # built components are in the cache, so the next build reuses them
+    serial = fork_map(waveguide, args, processes=1)
+    assert all(c1 is c2 for c1, c2 in zip(serial, parallel))
+
+
+if __name__ == "__main__":
+    test_fork_map()
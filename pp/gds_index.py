@@ -0,0 +1,219 @@
+""" index of the cells of a GDS file, to load only some cells of a large GDS
+
+GdsIndex scans the record headers of a GDS file (memory mapped) and stores for
+each cell (structure) its byte range and the names of the cells it references,
+without decoding polygons or references.
+
+`read_gds` builds a small GDS stream with the library header, the requested
+cells and their dependencies, and reads it with gdspy.
+"""
+
+import functools
+import io
+import mmap
+import os
+import pathlib
+import struct
+from typing import List, Union
+
+import gdspy
+
+# GDS record types
+ENDLIB = 0x04
+BGNSTR = 0x05
+STRNAME = 0x06
+ENDSTR = 0x07
+BOUNDARY = 0x08
+PATH = 0x09
+SNAME = 0x12
+BOX = 0x2D
+
+_record_header = struct.Struct(">HB")
+_endlib = b"\x00\x04\x04\x00"
+
+
+def _decode_name(data: bytes) -> str:
+    return data.rstrip(b"\0").decode("ascii")
+
+
+class GdsIndex:
+    """ byte offsets of the cells of a GDS file
+
+    Args:
+        gdspath: GDS file
+
+    Attributes:
+        header: (start, end) bytes of the library header (HEADER to UNITS)
+        cells: dict of cell name to (start, end) bytes (BGNSTR to ENDSTR)
+        references: dict of cell name to names of the cells it references
+        polygons: dict of cell name to number of polygons (boundaries, paths and boxes)
+
+    """
+
+    def __init__(self, gdspath: Union[str, pathlib.Path]) -> None:
+        self.gdspath = pathlib.Path(gdspath)
+        self.header = (0, 0)
+        self.cells = {}
+        self.references = {}
+        self.polygons = {}
+        self._scan()
+
+    def _scan(self) -> None:
+        with open(self.gdspath, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"{self.gdspath} is empty")
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                unpack = _record_header.unpack_from
+                size = len(data)
+                offset = 0
+                start = None
+                name = None
+                references = None
+                polygons = 0
+
+                while offset + 4 <= size:
+                    length, record_type = unpack(data, offset)
+                    if length < 4:
+                        raise ValueError(
+                            f"{self.gdspath} invalid GDS record at byte {offset}"
+                        )
+                    if record_type == BGNSTR:
+                        if not self.header[1]:
+                            self.header = (0, offset)
+                        start = offset
+                        references = {}
+                        polygons = 0
+                    elif record_type == STRNAME:
+                        name = _decode_name(data[offset + 4 : offset + length])
+                    elif record_type == SNAME:
+                        references[
+                            _decode_name(data[offset + 4 : offset + length])
+                        ] = None
+                    elif record_type in (BOUNDARY, PATH, BOX):
+                        polygons += 1
+                    elif record_type == ENDSTR:
+                        self.cells[name] = (start, offset + length)
+                        self.references[name] = list(references)
+                        self.polygons[name] = polygons
+                        start = None
+                    elif record_type == ENDLIB:
+                        break
+                    offset += length
+
+    def __contains__(self, cellname: str) -> bool:
+        return cellname in self.cells
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    @property
+    def cellnames(self) -> List[str]:
+        return list(self.cells)
+
+    def top_level(self) -> List[str]:
+        """ returns the names of the cells that are not referenced by other cells """
+        referenced = {
+            name for references in self.references.values() for name in references
+        }
+        return [name for name in self.cells if name not in referenced]
+
+    def count_polygons(self) -> int:
+        """ returns the number of polygons of all the cells (not flattened) """
+        return sum(self.polygons.values())
+
+    def get_dependencies(self, cellname: str) -> List[str]:
+        """ returns the names of the cells referenced by a cell (recursively) """
+        dependencies = []
+        seen = {cellname}
+        stack = [cellname]
+        while stack:
+            for name in self.references.get(stack.pop(), []):
+                if name not in seen:
+                    seen.add(name)
+                    dependencies.append(name)
+                    stack.append(name)
+        return dependencies
+
+    def get_stream(self, cellname: str) -> bytes:
+        """ returns a GDS stream with a cell and its dependencies """
+        if cellname not in self.cells:
+            raise ValueError(
+                f"{cellname} is not present in {self.gdspath} with cells {self.cellnames}"
+            )
+        cellnames = [cellname] + self.get_dependencies(cellname)
+        missing = [name for name in cellnames if name not in self.cells]
+        if missing:
+            raise ValueError(f"{self.gdspath} has no cells {missing}")
+
+        # keep the file order, so the stream is a subset of the file
+        ranges = sorted(self.cells[name] for name in cellnames)
+        with open(self.gdspath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                chunks = [data[slice(*self.header)]]
+                chunks += [data[start:end] for start, end in ranges]
+        chunks.append(_endlib)
+        return b"".join(chunks)
+
+    def read_gds(self, cellname: str) -> gdspy.GdsLibrary:
+        """ returns a gdspy library with only a cell and its dependencies """
+        gdsii_lib = gdspy.GdsLibrary()
+        gdsii_lib.read_gds(io.BytesIO(self.get_stream(cellname)))
+        return gdsii_lib
+
+
+@functools.lru_cache(maxsize=16)
+def _get_gds_index(gdspath: str, mtime_ns: int, size: int) -> GdsIndex:
+    return GdsIndex(gdspath)
+
+
+def get_gds_index(gdspath: Union[str, pathlib.Path]) -> GdsIndex:
+    """ returns the cell index of a GDS file
+    the index is cached until the file changes
+    """
+    gdspath = pathlib.Path(gdspath).resolve()
+    stat = gdspath.stat()
+    return _get_gds_index(str(gdspath), stat.st_mtime_ns, stat.st_size)
+
+
+def test_gds_index(tmp_path):
+    import numpy as np
+    import pp
+
+    c = pp.c.mzi2x2()
+    gdspath = pp.write_gds(c, gdspath=tmp_path / "mzi2x2.gds")
+    index = GdsIndex(gdspath)
+
+    gdsii_lib = gdspy.GdsLibrary()
+    gdsii_lib.read_gds(str(gdspath))
+    assert sorted(index.cellnames) == sorted(gdsii_lib.cells)
+    assert index.top_level() == [c.name for c in gdsii_lib.top_level()]
+
+    cell = gdsii_lib.cells[c.name]
+    dependencies = cell.get_dependencies(True)
+    assert sorted(index.get_dependencies(c.name)) == sorted(
+        d.name for d in dependencies
+    )
+
+    # loading a sub-cell only loads its dependencies
+    name = sorted(dependencies, key=lambda d: len(d.get_dependencies(True)))[-1].name
+    lib = index.read_gds(name)
+    assert sorted(lib.cells) == sorted([name] + index.get_dependencies(name))
+    assert np.allclose(
+        lib.cells[name].get_bounding_box(), gdsii_lib.cells[name].get_bounding_box()
+    )
+    assert lib.cells[name].area(True) == gdsii_lib.cells[name].area(True)
+    assert index.count_polygons() == sum(
+        len(cell.polygons) + len(cell.paths) for cell in gdsii_lib.cells.values()
+    )
+    assert get_gds_index(gdspath) is get_gds_index(gdspath)
+
+
+if __name__ == "__main__":
+    import pp
+
+    c = pp.c.mzi2x2()
+    gdspath = pp.write_gds(c)
+    index = GdsIndex(gdspath)
+    print(index.cells)
+    print(index.top_level())
@@ -1,20 +1,32 @@
 import sys
 import collections
-from multiprocessing import Process
+import multiprocessing
+import multiprocessing.connection
 import time
+import traceback
 from pprint import pprint
 from omegaconf import OmegaConf
 
+from pp.build_profile import BuildProfile, get_max_rss_mb, get_outputs_stats
+from pp.build_profile import get_variant_seconds
+from pp.executor import can_fork
 from pp.placer import save_doe
+from pp.placer import save_doe_content
+from pp.placer import save_doe_manifest
 from pp.placer import doe_exists
+from pp.placer import get_cached_variants
+from pp.placer import get_variant_hash
 from pp.placer import _gen_components
 from pp.placer import _gen_components_from_generator
 from pp.placer import load_doe_component_names
+from pp.placer import load_doe_variant_sources
 
 from pp.config import CONFIG
 from pp.components import component_type2factory
 from pp.write_doe import write_doe_metadata
+from pp.write_component import write_components
 from pp.doe import get_settings_list
+from pp.name import get_dependency_sources
 
 from pp.config import logging
 
@@ -124,6 +136,172 @@ def _generate_doe(
     )
 
 
+def _build_doe_variant(
+    doe,
+    index,
+    component_type2factory=component_type2factory,
+    component_filter=default_component_filter,
+    doe_root_path=None,
+    precision=1e-9,
+):
+    """ builds and writes one component of a DOE
+
+    Returns:
+        component name
+        sources of the factories of its cells (get_dependency_sources)
+    """
+    list_settings = doe["list_settings"] or [{}]
+    component = _gen_components(
+        doe["component"],
+        [list_settings[index]],
+        component_type2factory=component_type2factory,
+    )[0]
+    component = component_filter(component)
+    write_components(
+        [component],
+        dirpath=doe_root_path / doe["name"],
+        precision=precision,
+        processes=1,
+    )
+    return component.name, get_dependency_sources(component)
+
+
+class DoeTask:
+    """ build of a DOE (index=None) or of one of its variants
+
+    Args:
+        doe_name: DOE name
+        function: builds the DOE or the variant
+        args: for function
+        kwargs: for function
+        index: variant index
+        estimate: expected build time (s)
+    """
+
+    def __init__(self, doe_name, function, args, kwargs, index=None, estimate=1.0):
+        self.doe_name = doe_name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.index = index
+        self.estimate = estimate
+
+
+# tasks run by the DOE workers (inherited when forking)
+_doe_tasks = []
+
+
+def _run_doe_task(task_id):
+    """ returns (task_id, result, error traceback or None, build time,
+    peak memory of the process in MB)
+    """
+    task = _doe_tasks[task_id]
+    t0 = time.time()
+    try:
+        result = task.function(*task.args, **task.kwargs)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    return task_id, result, error, time.time() - t0, get_max_rss_mb()
+
+
+def _doe_worker(conn):
+    """ runs the task ids received until it receives None """
+    while True:
+        task_id = conn.recv()
+        if task_id is None:
+            break
+        conn.send(_run_doe_task(task_id))
+    conn.close()
+
+
+class _DoeWorker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_doe_worker, args=(child_conn,), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.task_id = None
+
+    def send(self, task_id):
+        self.task_id = task_id
+        self.conn.send(task_id)
+
+
+def run_doe_tasks(tasks, on_done, n_cores=4):
+    """ runs tasks longest first (task.estimate) on a pool of n_cores workers
+    each worker takes the next task as soon as it is done
+
+    Workers are forked, when forking is not possible (or n_cores=1)
+    tasks run in this process.
+
+    Args:
+        tasks: list of DoeTask
+        on_done: function(task_id, result, error, build_time, max_rss_mb)
+            called as tasks finish, error is the traceback of the failed tasks
+            (or the worker exit code) and max_rss_mb the peak memory of the
+            worker so far
+        n_cores: number of worker processes
+
+    Returns:
+        exit codes of the workers
+    """
+    global _doe_tasks
+
+    # pop() takes the longest task first
+    pending = sorted(range(len(tasks)), key=lambda i: tasks[i].estimate)
+    n_cores = min(n_cores, len(tasks))
+    _doe_tasks = tasks
+    workers = []
+    try:
+        if n_cores <= 1 or not can_fork():
+            while pending:
+                on_done(*_run_doe_task(pending.pop()))
+            return []
+
+        context = multiprocessing.get_context("fork")
+        workers += [_DoeWorker(context) for _ in range(n_cores)]
+        for worker in workers:
+            worker.send(pending.pop())
+
+        exit_codes = []
+        while workers:
+            ready = multiprocessing.connection.wait(
+                [w.conn for w in workers] + [w.process.sentinel for w in workers]
+            )
+            for worker in list(workers):
+                if worker.conn in ready and worker.task_id is not None:
+                    try:
+                        result = worker.conn.recv()
+                    except EOFError:
+                        result = None
+                    if result is not None:
+                        worker.task_id = None
+                        on_done(*result)
+                        worker.send(pending.pop() if pending else None)
+
+                if worker.process.sentinel in ready:
+                    worker.process.join()
+                    worker.conn.close()
+                    workers.remove(worker)
+                    exit_codes.append(worker.process.exitcode)
+                    if worker.task_id is not None:
+                        error = f"worker exited with code {worker.process.exitcode}"
+                        on_done(worker.task_id, None, error, 0.0, None)
+                        if pending:
+                            replacement = _DoeWorker(context)
+                            replacement.send(pending.pop())
+                            workers.append(replacement)
+        return exit_codes
+    finally:
+        for worker in workers:
+            worker.process.terminate()
+        _doe_tasks = []
+
+
 def load_does(filepath, defaults={"do_permutation": True, "settings": {}}):
     does = {}
     data = OmegaConf.load(filepath)
@@ -149,10 +327,14 @@ def generate_does(
     logger=logging,
     regenerate_report_if_doe_exists=False,
     precision=1e-9,
+    build_profile=None,
 ):
     """ Generates a DOEs of components specified in a yaml file
     allows for each DOE to have its own x and y spacing (more flexible than method1)
     similar to write_doe
+
+    The build of each DOE is recorded in build_profile (defaults to BuildProfile())
+    and the previous builds are used to start the longest DOEs first.
     """
 
     doe_root_path.mkdir(parents=True, exist_ok=True)
@@ -197,100 +379,312 @@ def generate_does(
 
         list_args += [doe]
 
-    does_running = []
-    start_times = {}
-    finish_times = {}
-    doe_name_to_process = {}
-    while list_args:
-        while len(does_running) < n_cores:
-            if not list_args:
-                break
-            doe = list_args.pop()
-            doe_name = doe["name"]
+    build_profile = build_profile or BuildProfile()
+    build_times = build_profile.get_latest("doe")
+    variant_times = [get_variant_seconds(t) for t in build_times.values()]
+    default_variant_time = (
+        sum(variant_times) / len(variant_times) if variant_times else 1.0
+    )
 
+    tasks = []
+    doe_variants = {}  # {doe_name: hash of each variant}
+    cached_variants = {}  # {doe_name: {variant index: component name}}
+    for doe in list_args:
+        doe_name = doe["name"]
+
+        """
+        Only launch a build process if we do not use the cache
+        Or if the DOE is not built
+        """
+
+        list_settings = doe["list_settings"]
+
+        use_cached_does = default_use_cached_does if "cache" not in doe else doe["cache"]
+
+        _doe_exists = False
+        cached = {}
+        variant_hashes = None
+        if "generator" not in doe:
+            component_factory = component_type2factory[doe["component"]]
+            variant_hashes = [
+                get_variant_hash(component_factory, settings, component_filter, precision)
+                for settings in list_settings or [{}]
+            ]
+            doe_variants[doe_name] = variant_hashes
+
+        if "doe_template" in doe:
             """
-            Only launch a build process if we do not use the cache
-            Or if the DOE is not built
+            In that case, the DOE is not built: this DOE points to another existing component
             """
-
-            list_settings = doe["list_settings"]
-
-            use_cached_does = (
-                default_use_cached_does if "cache" not in doe else doe["cache"]
+            _doe_exists = True
+            logger.info("Using template - {}".format(doe_name))
+            save_doe_use_template(doe)
+
+        elif use_cached_does:
+            _doe_exists = doe_exists(
+                doe_name,
+                list_settings,
+                doe_root_path=doe_root_path,
+                variant_hashes=variant_hashes,
             )
+            if _doe_exists:
+                logger.info("Cached - {}".format(doe_name))
+                if regenerate_report_if_doe_exists:
+                    component_names = load_doe_component_names(
+                        doe_name, doe_root_path=doe_root_path
+                    )
+
+                    write_doe_metadata(
+                        doe_name=doe["name"],
+                        cell_names=component_names,
+                        list_settings=doe["list_settings"],
+                        doe_metadata_path=doe_metadata_path,
+                    )
+            elif variant_hashes:
+                # variants with the same hash reuse their GDS
+                cached = get_cached_variants(doe_name, variant_hashes, doe_root_path)
+                cached_variants[doe_name] = cached
+
+        if _doe_exists:
+            continue
+
+        variants = max(len(list_settings), 1)
+        if doe_name in build_times:
+            variant_time = get_variant_seconds(build_times[doe_name])
+        else:
+            variant_time = default_variant_time
+
+        if "generator" in doe:
+            tasks.append(
+                DoeTask(
+                    doe_name,
+                    _generate_doe,
+                    (doe, component_type2factory),
+                    dict(
+                        component_filter=component_filter,
+                        doe_root_path=doe_root_path,
+                        doe_metadata_path=doe_metadata_path,
+                        regenerate_report_if_doe_exists=regenerate_report_if_doe_exists,
+                        precision=precision,
+                        logger=logger,
+                    ),
+                    estimate=variant_time * variants,
+                )
+            )
+        else:
+            # one task per variant, so big DOEs are spread over all the cores
+            logger.info(
+                "Building - {} ({} of {} variants) ...".format(
+                    doe_name, variants - len(cached), variants
+                )
+            )
+            for index in range(variants):
+                if index in cached:
+                    continue
+                tasks.append(
+                    DoeTask(
+                        doe_name,
+                        _build_doe_variant,
+                        (doe, index, component_type2factory),
+                        dict(
+                            component_filter=component_filter,
+                            doe_root_path=doe_root_path,
+                            precision=precision,
+                        ),
+                        index=index,
+                        estimate=variant_time,
+                    )
+                )
 
-            _doe_exists = False
-
-            if "doe_template" in doe:
-                """
-                In that case, the DOE is not built: this DOE points to another existing component
-                """
-                _doe_exists = True
-                logger.info("Using template - {}".format(doe_name))
-                save_doe_use_template(doe)
-
-            elif use_cached_does:
-                _doe_exists = doe_exists(doe_name, list_settings)
-                if _doe_exists:
-                    logger.info("Cached - {}".format(doe_name))
-                    if regenerate_report_if_doe_exists:
-                        component_names = load_doe_component_names(doe_name)
-
-                        write_doe_metadata(
-                            doe_name=doe["name"],
-                            cell_names=component_names,
-                            list_settings=doe["list_settings"],
-                            doe_metadata_path=doe_metadata_path,
-                        )
-
-            if not _doe_exists:
-                start_times[doe_name] = time.time()
-                p = Process(
-                    target=_generate_doe,
-                    args=(doe, component_type2factory),
-                    kwargs={
-                        "component_filter": component_filter,
-                        "doe_root_path": doe_root_path,
-                        "doe_metadata_path": doe_metadata_path,
-                        "regenerate_report_if_doe_exists": regenerate_report_if_doe_exists,
-                        "precision": precision,
-                        "logger": logger,
-                    },
+    does = {doe["name"]: doe for doe in list_args}
+    remaining = collections.Counter(task.doe_name for task in tasks)
+    built = remaining.copy()
+    component_names = {doe_name: {} for doe_name in remaining}
+    component_sources = {doe_name: {} for doe_name in remaining}
+    seconds = collections.Counter()
+    max_rss = {}
+    errors = {}
+
+    def on_done(task_id, result, error, build_time, max_rss_mb):
+        task = tasks[task_id]
+        doe_name = task.doe_name
+        remaining[doe_name] -= 1
+        seconds[doe_name] += build_time
+        if max_rss_mb is not None:
+            max_rss[doe_name] = max(max_rss.get(doe_name, 0), max_rss_mb)
+        if error:
+            errors.setdefault(doe_name, []).append(error)
+            logger.error("Failed - {}\n{}".format(doe_name, error))
+        elif task.index is not None:
+            name, sources = result
+            component_names[doe_name][task.index] = name
+            component_sources[doe_name][task.index] = sources
+
+        if remaining[doe_name] == 0 and doe_name in errors:
+            build_profile.add("doe", doe_name, seconds[doe_name], ok=False)
+
+        elif remaining[doe_name] == 0:
+            doe = does[doe_name]
+            if task.index is None:
+                names = load_doe_component_names(doe_name, doe_root_path=doe_root_path)
+                built_variants = len(names)
+            else:
+                built_variants = built[doe_name]
+                names = dict(cached_variants.get(doe_name, {}))
+                names.update(component_names[doe_name])
+                variant_hashes = doe_variants[doe_name]
+                names = [names[i] for i in range(len(variant_hashes))]
+                sources = load_doe_variant_sources(doe_name, doe_root_path)
+                variant_sources = [
+                    component_sources[doe_name].get(i) or sources.get(variant_hash)
+                    for i, variant_hash in enumerate(variant_hashes)
+                ]
+                save_doe_content(doe_name, names, doe_root_path=doe_root_path)
+                save_doe_manifest(
+                    doe_name,
+                    names,
+                    variant_hashes,
+                    doe_root_path=doe_root_path,
+                    variant_sources=variant_sources,
                 )
-                doe_name_to_process[doe_name] = p
-                does_running += [doe_name]
-                try:
-                    p.start()
-                except Exception:
-                    print("Issue starting process for {}".format(doe_name))
-                    print(type(component_type2factory))
-                    raise
+                write_doe_metadata(
+                    doe_name=doe_name,
+                    cell_names=names,
+                    list_settings=doe["list_settings"],
+                    doe_settings={},
+                    doe_metadata_path=doe_metadata_path,
+                )
+            build_profile.add(
+                "doe",
+                doe_name,
+                seconds[doe_name],
+                variants=len(names),
+                built_variants=built_variants,
+                max_rss_mb=max_rss.get(doe_name),
+                **get_outputs_stats(
+                    doe_root_path / doe_name / f"{name}.gds" for name in names
+                ),
+            )
+            logger.info("Done - {} ({:.1f}s)".format(doe_name, seconds[doe_name]))
+
+    exit_codes = run_doe_tasks(tasks, on_done, n_cores=n_cores)
+
+    failed_workers = [code for code in exit_codes if code]
+    if errors or failed_workers:
+        message = "\n".join(
+            "{}:\n{}".format(doe_name, "\n".join(doe_errors))
+            for doe_name, doe_errors in errors.items()
+        )
+        raise RuntimeError(
+            f"DOEs {list(errors.keys())} failed "
+            f"(worker exit codes {failed_workers}):\n{message}"
+        )
+    return {doe_name: seconds[doe_name] for doe_name in remaining}
+
+
+def test_generate_does(tmp_path):
+    import pytest
+
+    filepath = tmp_path / "does.yml"
+    filepath.write_text(
+        """
+mask:
+  name: does
+
+waveguides:
+  component: waveguide
+  settings:
+    length: [1.11, 2.22, 3.33]
+    width: 0.61
+
+wrong_setting:
+  component: waveguide
+  settings:
+    length_typo: 1
+"""
+    )
+    doe_root_path = tmp_path / "cache_doe"
+    build_profile = BuildProfile(tmp_path / "build_profile.jsonl")
+    kwargs = dict(
+        doe_root_path=doe_root_path,
+        doe_metadata_path=tmp_path / "doe",
+        build_profile=build_profile,
+    )
+
+    # failures are raised after the other DOEs are built
+    with pytest.raises(RuntimeError, match="wrong_setting"):
+        generate_does(filepath, n_cores=2, **kwargs)
+    component_names = load_doe_component_names(
+        "waveguides", doe_root_path=doe_root_path
+    )
+    assert [name.split("_")[1] for name in component_names] == [
+        "L1p11",
+        "L2p22",
+        "L3p33",
+    ]
+    assert list(build_profile.get_latest("doe")) == ["waveguides"]
+    record = build_profile.get_latest("doe")["waveguides"]
+    assert record["polygons"] > 0 and record["size_bytes"] > 0
+    failed = [r for r in build_profile.load() if r["name"] == "wrong_setting"]
+    assert not failed[0]["ok"]
+    assert (tmp_path / "doe" / "waveguides.json").exists()
+
+
+def test_generate_does_cache(tmp_path):
+    """ only the variants that changed are built again """
+    import json
+
+    does = """
+mask:
+  name: does
+  cache: true
+
+waveguides:
+  component: waveguide
+  settings:
+    length: [1.41, LENGTH]
+    width: 0.62
+"""
+    filepath = tmp_path / "does.yml"
+    doe_root_path = tmp_path / "cache_doe"
+    build_profile = BuildProfile(tmp_path / "build_profile.jsonl")
+    kwargs = dict(
+        doe_root_path=doe_root_path,
+        doe_metadata_path=tmp_path / "doe",
+        build_profile=build_profile,
+    )
 
-        to_rm = []
-        for i, doe_name in enumerate(does_running):
-            _p = doe_name_to_process[doe_name]
-            if not _p.is_alive():
-                to_rm += [i]
-                finish_times[doe_name] = time.time()
-                dt = finish_times[doe_name] - start_times[doe_name]
-                line = "Done - {} ({:.1f}s)".format(doe_name, dt)
-                logger.info(line)
-
-        for i in to_rm[::-1]:
-            does_running.pop(i)
-
-        time.sleep(0.001)
-
-    while does_running:
-        to_rm = []
-        for i, _doe_name in enumerate(does_running):
-            _p = doe_name_to_process[_doe_name]
-            if not _p.is_alive():
-                to_rm += [i]
-        for i in to_rm[::-1]:
-            does_running.pop(i)
-
-        time.sleep(0.05)
+    filepath.write_text(does.replace("LENGTH", "2.42"))
+    assert list(generate_does(filepath, n_cores=1, **kwargs)) == ["waveguides"]
+    names = load_doe_component_names("waveguides", doe_root_path=doe_root_path)
+    gdspath = doe_root_path / "waveguides" / f"{names[0]}.gds"
+    mtime = gdspath.stat().st_mtime_ns
+    assert generate_does(filepath, n_cores=1, **kwargs) == {}
+
+    filepath.write_text(does.replace("LENGTH", "2.43"))
+    assert list(generate_does(filepath, n_cores=1, **kwargs)) == ["waveguides"]
+    names2 = load_doe_component_names("waveguides", doe_root_path=doe_root_path)
+    assert names2[0] == names[0] and names2[1] != names[1]
+    assert gdspath.stat().st_mtime_ns == mtime
+    records = build_profile.load("doe")
+    assert [r["built_variants"] for r in records] == [2, 1]
+    assert [r["variants"] for r in records] == [2, 2]
+    # polygons and size of all the variants, cached or built
+    assert records[1]["polygons"] == records[0]["polygons"]
+    assert records[1]["size_bytes"] > 0.9 * records[0]["size_bytes"]
+
+    # a variant is built again when the source of a factory it uses changed
+    manifest_path = doe_root_path / "waveguides" / "manifest.json"
+    manifest = json.loads(manifest_path.read_text())
+    variant_hash = list(manifest["variants"])[0]
+    sources = manifest["sources"][variant_hash]
+    assert "pp.components.waveguide.waveguide" in sources
+    sources["pp.components.waveguide.waveguide"] = "edited"
+    manifest_path.write_text(json.dumps(manifest))
+    assert list(generate_does(filepath, n_cores=1, **kwargs)) == ["waveguides"]
+    assert build_profile.load("doe")[-1]["built_variants"] == 1
+    assert gdspath.stat().st_mtime_ns != mtime
+    assert generate_does(filepath, n_cores=1, **kwargs) == {}
 
 
 if __name__ == "__main__":
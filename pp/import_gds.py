@@ -5,6 +5,7 @@ from phidl.device_layout import DeviceReference
 
 import pp
 from pp.component import Component
+from pp.gds_index import get_gds_index
 from pp.name import NAME_TO_DEVICE
 from pp.port import read_port_markers, auto_rename_ports
 from pp.layers import port_layer2type, port_type2layer
@@ -155,27 +156,34 @@ def import_gds(
         overwrite_cache: overwrites device cache (caching by name)
         snap_to_grid_nm: snap
 
+    When `cellname` is given, only that cell and its dependencies are read
+    (see pp.gds_index), instead of the whole library
     """
     gdspath = str(gdspath)
-    gdsii_lib = gdspy.GdsLibrary()
-    gdsii_lib.read_gds(gdspath)
-    top_level_cells = gdsii_lib.top_level()
-    cellnames = [c.name for c in top_level_cells]
 
     if cellname is not None:
-        if cellname not in cellnames:
+        index = get_gds_index(gdspath)
+        if cellname not in index:
             raise ValueError(
-                f"import_gds() The requested cell {cellname} is not present in file {gdspath} with cells {cellnames}"
+                f"import_gds() The requested cell {cellname} is not present in file {gdspath} with cells {index.cellnames}"
             )
+        gdsii_lib = index.read_gds(cellname)
         topcell = gdsii_lib.cells[cellname]
-    elif cellname is None and len(top_level_cells) == 1:
-        topcell = top_level_cells[0]
-    elif cellname is None and len(top_level_cells) > 1:
-        raise ValueError(
-            "import_gds() There are multiple top-level cells in {}, you must specify `cellname` to select of one of them among {}".format(
-                gdspath, [_c.name for _c in top_level_cells]
+    else:
+        gdsii_lib = gdspy.GdsLibrary()
+        gdsii_lib.read_gds(gdspath)
+        top_level_cells = gdsii_lib.top_level()
+
+        if len(top_level_cells) == 1:
+            topcell = top_level_cells[0]
+        elif not top_level_cells:
+            raise ValueError(f"import_gds() There are no top-level cells in {gdspath}")
+        else:
+            raise ValueError(
+                "import_gds() There are multiple top-level cells in {}, you must specify `cellname` to select of one of them among {}".format(
+                    gdspath, [_c.name for _c in top_level_cells]
+                )
             )
-        )
 
     if flatten:
         D = pp.Component()
@@ -264,6 +272,29 @@ def test_import_gds_hierarchy():
     assert len(c.get_dependencies()) == 3
 
 
+def test_import_gds_cellname():
+    c0 = pp.c.mzi2x2()
+    gdspath = pp.write_gds(c0)
+    c = import_gds(gdspath)
+    cells = {cell.name: cell for cell in c.get_dependencies(True)}
+    name = max(cells, key=lambda name: len(cells[name].get_dependencies(True)))
+    c1 = import_gds(gdspath, cellname=name)
+    assert c1.name == name
+    assert sorted(d.name for d in c1.get_dependencies(True)) == sorted(
+        d.name for d in cells[name].get_dependencies(True)
+    )
+    assert len(c1.get_polygons()) == len(cells[name].get_polygons())
+
+
+def test_import_gds_empty(tmp_path):
+    import pytest
+
+    gdspath = tmp_path / "empty.gds"
+    gdspy.GdsLibrary().write_gds(gdspath)
+    with pytest.raises(ValueError, match="no top-level cells"):
+        import_gds(gdspath)
+
+
 def test_import_gds_with_port_markers_optical():
     """ """
     # c  =  pp.c.mmi1x2()
@@ -59,7 +59,7 @@ def merge_json(
         json_version=json_version,
         cells=cells,
         does=does,
-        config=OmegaConf.to_container(config),
+        config=OmegaConf.to_container(config, resolve=True),
     )
 
     write_config(metadata, jsonpath)
@@ -68,6 +68,13 @@ def merge_json(
     return metadata
 
 
+def test_merge_json(tmp_path):
+    jsonpath = tmp_path / "metadata.json"
+    merge_json(doe_directory=tmp_path, extra_directories=[], jsonpath=jsonpath)
+    metadata = json.loads(jsonpath.read_text())
+    assert metadata["config"]["git_hash"] == conf.git_hash
+
+
 if __name__ == "__main__":
     d = merge_json()
     print(d)
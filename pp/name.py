@@ -2,17 +2,19 @@
 """
 import uuid
 import functools
+import importlib
+import inspect
 from inspect import signature
 import hashlib
-from typing import Any, Callable
+from typing import Any, Callable, Dict, Optional
 import numpy as np
 from phidl import Device
 from pp.add_pins import add_pins_and_outline
+from pp.cache import NAME_TO_DEVICE, DISK_CACHE
+from pp.config import conf
 
 MAX_NAME_LENGTH = 32
 
-NAME_TO_DEVICE = {}
-
 
 def join_first_letters(name: str) -> str:
     """ join the first letter of a name separated with underscores (taper_length -> TL) """
@@ -39,6 +41,10 @@ def autoname(component_function: Callable) -> Callable:
     You can always over-ride this with `cache = False`
     This is helpful when you are changing the code inside the function that is being cached.
 
+    If `conf.cache.disk` is True, components are also pickled into `CONFIG["component_cache_directory"]`
+    so other processes can load them instead of building them.
+    The disk key combines the function name, the settings and the function source (see get_disk_cache_key)
+
     Args:
         name (str):
         cache (bool): caches functions with same name
@@ -96,39 +102,122 @@ def autoname(component_function: Callable) -> Callable:
                     key in sig.parameters.keys()
                 ), f"`{key}` key not in {list(sig.parameters.keys())} for {component_type}"
 
-        if cache and name in NAME_TO_DEVICE:
-            return NAME_TO_DEVICE[name]
-        else:
-            component = component_function(**kwargs)
-            component.name = name
-            component.module = component_function.__module__
-            component.function_name = component_function.__name__
-
-            if len(name) > MAX_NAME_LENGTH:
-                component.name_long = name
-                component.name = (
-                    f"{component_type}_{hashlib.md5(name.encode()).hexdigest()[:8]}"
-                )
-
-            if not hasattr(component, "settings"):
-                component.settings = {}
-            component.settings.update(
-                **{
-                    p.name: p.default
-                    for p in sig.parameters.values()
-                    if not callable(p.default)
-                }
-            )
-            component.settings.update(**kwargs)
-            component.settings_changed = kwargs.copy()
-            if pins:
-                pins_function(component)
-            NAME_TO_DEVICE[name] = component
+        component = NAME_TO_DEVICE.get(name) if cache else None
+        if component is not None:
             return component
 
+        disk_key = None
+        if cache and conf.cache.disk and not uid:
+            disk_key = get_disk_cache_key(
+                component_function, name=name, pins=pins, **kwargs
+            )
+            component = DISK_CACHE.load(
+                disk_key, check=lambda sources: not sources_changed(sources)
+            )
+            if component is not None:
+                NAME_TO_DEVICE[name] = component
+                return component
+
+        component = component_function(**kwargs)
+        component.name = name
+        component.module = component_function.__module__
+        component.function_name = component_function.__name__
+
+        if len(name) > MAX_NAME_LENGTH:
+            component.name_long = name
+            component.name = (
+                f"{component_type}_{hashlib.md5(name.encode()).hexdigest()[:8]}"
+            )
+
+        if not hasattr(component, "settings"):
+            component.settings = {}
+        component.settings.update(
+            **{
+                p.name: p.default
+                for p in sig.parameters.values()
+                if not callable(p.default)
+            }
+        )
+        component.settings.update(**kwargs)
+        component.settings_changed = kwargs.copy()
+        if pins:
+            pins_function(component)
+        NAME_TO_DEVICE[name] = component
+        if disk_key:
+            DISK_CACHE.save(
+                disk_key, component, metadata=get_dependency_sources(component)
+            )
+        return component
+
     return _autoname
 
 
+@functools.lru_cache(maxsize=None)
+def get_source_hash(function: Callable) -> str:
+    """ returns a hash of the function source code and the gdsfactory version """
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        source = getattr(function, "__qualname__", "")
+    h = hashlib.sha256(f"{conf.version}{source}".encode())
+    return h.hexdigest()
+
+
+def _get_function(module_name: str, function_name: str) -> Optional[Callable]:
+    try:
+        module = importlib.import_module(module_name)
+    except Exception:
+        return None
+    return getattr(module, function_name, None)
+
+
+def get_dependency_sources(component: Any) -> Dict[str, str]:
+    """ returns {module.function: source hash} of the factories (autoname)
+    of a component and of all the cells it depends on
+    """
+    sources = {}
+    for cell in [component] + list(component.get_dependencies(True)):
+        module_name = getattr(cell, "module", None)
+        function_name = getattr(cell, "function_name", None)
+        if module_name and function_name:
+            function = _get_function(module_name, function_name)
+            if function is not None:
+                key = f"{module_name}.{function_name}"
+                sources[key] = get_source_hash(function)
+    return sources
+
+
+def sources_changed(sources: Optional[Dict[str, str]]) -> bool:
+    """ returns True if the source of a factory in sources (get_dependency_sources)
+    changed, or if there are no sources to check
+    """
+    if sources is None:
+        return True
+    for key, source_hash in sources.items():
+        module_name, function_name = key.rsplit(".", 1)
+        function = _get_function(module_name, function_name)
+        if function is None or get_source_hash(function) != source_hash:
+            return True
+    return False
+
+
+def get_disk_cache_key(component_function: Callable, **kwargs) -> str:
+    """ returns the disk cache key of a component
+    combines function name, settings hash and function source hash
+    callable settings (factories) also contribute their source
+    and the other settings their full precision repr (dict2hash rounds floats)
+    """
+    h = hashlib.sha256(get_source_hash(component_function).encode())
+    h.update(dict2hash(**kwargs).encode())
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        if callable(value):
+            h.update(f"{key}{get_source_hash(value)}".encode())
+        else:
+            h.update(f"{key}{value!r}".encode())
+    return f"{component_function.__name__}_{h.hexdigest()[:16]}"
+
+
 def dict2hash(**kwargs) -> str:
     ignore_from_name = kwargs.pop("ignore_from_name", [])
     h = hashlib.sha256()
@@ -285,6 +374,39 @@ def test_autoname():
     print(name_float)
 
 
+def test_autoname_disk_cache(tmp_path):
+    import pp
+    from pp.compare_cells import hash_cells
+
+    dirpath = DISK_CACHE.dirpath
+    DISK_CACHE.dirpath = tmp_path
+    conf.cache.disk = True
+    try:
+        c1 = pp.c.waveguide(length=13.37)
+        assert len(list(tmp_path.glob("waveguide_*.pkl"))) == 1
+        NAME_TO_DEVICE.pop(c1.name)
+        c2 = pp.c.waveguide(length=13.37)
+    finally:
+        conf.cache.disk = False
+        DISK_CACHE.dirpath = dirpath
+    assert c2 is not c1
+    assert c2.name == c1.name
+    assert hash_cells(c2, {})[c2.name] == hash_cells(c1, {})[c1.name]
+
+
+def test_dependency_sources():
+    import pp
+
+    c = pp.c.mzi(L0=1.23)
+    sources = get_dependency_sources(c)
+    assert "pp.components.bend_circular.bend_circular" in sources
+    assert not sources_changed(sources)
+
+    sources["pp.components.bend_circular.bend_circular"] = "edited"
+    assert sources_changed(sources)
+    assert sources_changed(None)
+
+
 def test_clean_value():
     assert clean_value(0.5) == "500m"
     assert clean_value(5) == "5"
@@ -11,11 +11,9 @@ Deprecated! use pp/component_from_yaml instead!
 
 from typing import Union, IO, Any
 import pathlib
-import io
-from omegaconf import OmegaConf
 
+from pp.compiled_netlist import compile_netlist
 from pp.component import Component
-from pp.components import component_type2factory as component_type2factory_default
 from pp.netlist_to_gds import netlist_to_component
 
 
@@ -125,26 +123,22 @@ def netlist_from_yaml(
 
     """
 
-    yaml = io.StringIO(yaml) if isinstance(yaml, str) and "\n" in yaml else yaml
-    conf = OmegaConf.load(yaml)
-    component_type2factory = component_type2factory or component_type2factory_default
+    netlist = compile_netlist(yaml, component_type2factory)
 
     instances = {}
-    for instance_name in conf.instances:
-        instance_conf = conf.instances[instance_name]
-        component_type = instance_conf["component"]
-        component_settings = instance_conf["settings"] or {}
-        instance = component_type2factory[component_type](**component_settings)
-        instance_transformations = instance_conf["transformations"] or "None"
-        instance_properties = instance_conf["properties"] or {}
-        for k, v in instance_properties.items():
+    for instance_id, instance_name in enumerate(netlist.instance_names):
+        instance = netlist.factories[instance_id](**netlist.settings[instance_id])
+        for k, v in netlist.properties[instance_id].items():
             setattr(instance, k, v)
         instance.name = instance_name
+        instance_transformations = netlist.transformations[instance_id] or "None"
         instances[instance_name] = (instance, instance_transformations)
 
-    connections = conf.connections
-    ports_map = conf.ports_map
-    return netlist_to_component(instances, connections, ports_map)
+    ports_map = {
+        port_name: netlist.get_port_string(port_id).split(",")
+        for port_name, port_id in netlist.exposed_ports.items()
+    }
+    return netlist_to_component(instances, netlist.get_connections(), ports_map)
 
 
 def test_netlist_from_yaml():
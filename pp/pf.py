@@ -5,6 +5,7 @@ import os
 import re
 import shlex
 import subprocess
+import sys
 import time
 import pathlib
 import click
@@ -25,6 +26,7 @@ from pp.mask.merge_test_metadata import merge_test_metadata
 from pp.mask.write_labels import write_labels
 
 import pp.build as pb
+from pp.build_profile import BuildProfile
 
 from pp.tests.test_factory import lock_components_with_changes
 
@@ -191,9 +193,12 @@ def build_clean(force):
 
 @click.command(name="build_devices")
 @click.argument("regex", required=False, default=".*")
-def build_devices(regex):
+@click.option(
+    "--warm", default=False, is_flag=True, help="Run scripts in warm pp workers"
+)
+def build_devices(regex, warm):
     """ Build all devices described in devices/"""
-    pb.build_devices(regex)
+    pb.build_devices(regex, warm=warm)
 
 
 @click.command(name="build_does")
@@ -229,6 +234,39 @@ def write_mask_labels(gdspath, label_layer):
     write_labels(gdspath=gdspath, label_layer=label_layer)
 
 
+def _format_metric(value, fmt):
+    return "-" if value is None else format(value, fmt)
+
+
+@click.command(name="profile")
+@click.option("--top", default=10, help="Number of slowest builds to show")
+@click.option(
+    "--threshold", default=0.2, help="Relative increase reported as regression"
+)
+@click.option(
+    "--fail", default=False, help="Exit with code 1 on regressions", is_flag=True
+)
+def mask_profile(top, threshold, fail):
+    """ Show the slowest devices/DOEs and the regressions since the previous build"""
+    profile = BuildProfile()
+    latest = sorted(profile.get_latest().values(), key=lambda r: -r["seconds"])
+    click.echo(f"{len(latest)} devices and DOEs in {profile.path}")
+    click.echo(f"{'kind':6} {'name':40} {'seconds':>8} {'RSS MB':>8} {'polygons':>9}")
+    for record in latest[:top]:
+        click.echo(
+            f"{record['kind']:6} {record['name']:40} {record['seconds']:8.2f} "
+            f"{_format_metric(record.get('max_rss_mb'), '8.1f'):>8} "
+            f"{_format_metric(record.get('polygons'), '9d'):>9}"
+        )
+
+    regressions = profile.get_regressions(threshold=threshold)
+    click.echo(f"{len(regressions)} regressions (>{threshold:.0%})")
+    for regression in regressions:
+        click.echo(str(regression))
+    if fail and regressions:
+        sys.exit(1)
+
+
 """
 EXTRA
 """
@@ -278,6 +316,7 @@ mask.add_command(build_devices)
 mask.add_command(build_does)
 mask.add_command(mask_merge)
 mask.add_command(write_mask_labels)
+mask.add_command(mask_profile)
 
 cli.add_command(config_get)
 cli.add_command(library)
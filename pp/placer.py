@@ -29,16 +29,18 @@ YAML defines component DOE settings and placement
         A-B1-2: doe1
 """
 
+import hashlib
+import json
 import os
 import sys
 from omegaconf import OmegaConf
 
 import pp
 from pp.doe import get_settings_list, load_does
-from pp.config import CONFIG
+from pp.config import CONFIG, conf
 from pp.components import component_type2factory
-from pp.write_component import write_gds
-from pp.write_component import write_component_report
+from pp.name import get_disk_cache_key, get_source_hash, sources_changed
+from pp.write_component import write_components
 
 
 def _print(*args, **kwargs):
@@ -287,9 +289,30 @@ def load_placer_with_does(filepath, defaults={"do_permutation": True}):
 CONTENT_SEP = " , "
 
 
-def save_doe(doe_name, components, doe_root_path=None, precision=1e-9):
+def save_doe(doe_name, components, doe_root_path=None, precision=1e-9, processes=None):
     """
     Save all components from this DOE in a tmp cache folder
+    GDS, ports and JSON files are written in parallel (see write_components)
+    on `processes` workers, or sequentially when called from a daemonic process
+    (the generate_does workers) that can not start a pool
+
+    Returns:
+        time spent writing each file {path: seconds}
+    """
+    doe_dir = save_doe_content(
+        doe_name, [c.name for c in components], doe_root_path=doe_root_path
+    )
+    return write_components(
+        components, dirpath=doe_dir, precision=precision, processes=processes
+    )
+
+
+def save_doe_content(doe_name, component_names, doe_root_path=None):
+    """
+    Write the list of component names of a DOE (content.txt), order matters
+
+    Returns:
+        DOE directory
     """
     if doe_root_path is None:
         doe_root_path = CONFIG["cache_doe_directory"]
@@ -297,16 +320,10 @@ def save_doe(doe_name, components, doe_root_path=None, precision=1e-9):
     if not os.path.exists(doe_dir):
         os.makedirs(doe_dir)
 
-    # Store list of component names - order matters
-    component_names = [c.name for c in components]
     content_file = os.path.join(doe_dir, "content.txt")
     with open(content_file, "w") as fw:
         fw.write(CONTENT_SEP.join(component_names))
-
-    for c in components:
-        gdspath = os.path.join(doe_dir, c.name + ".gds")
-        write_gds(c, gdspath=gdspath, precision=precision)
-        write_component_report(c, json_path=gdspath[:-4] + ".json")
+    return doe_dir
 
 
 def load_doe_from_cache(doe_name, doe_root_path=None):
@@ -336,10 +353,13 @@ def load_doe_component_names(doe_name, doe_root_path=None):
     return component_names
 
 
-def doe_exists(doe_name, list_settings, doe_root_path=None):
+def doe_exists(doe_name, list_settings, doe_root_path=None, variant_hashes=None):
     """
     Check whether the folder exists and that the number of items in content.txt
     matches the number of items in list_settings
+
+    with variant_hashes (get_variant_hash of each variant) it checks that the
+    DOE manifest has the same hashes and that all the GDS files exist
     """
     if doe_root_path is None:
         doe_root_path = CONFIG["cache_doe_directory"]
@@ -350,7 +370,14 @@ def doe_exists(doe_name, list_settings, doe_root_path=None):
     with open(content_file) as f:
         component_names = f.read().split(CONTENT_SEP)
 
-    if len(component_names) == len(list_settings) or (
+    if variant_hashes is not None:
+        cached = get_cached_variants(doe_name, variant_hashes, doe_root_path)
+        if len(cached) == len(variant_hashes) and [
+            cached[i] for i in range(len(variant_hashes))
+        ] == component_names:
+            return True
+
+    elif len(component_names) == len(list_settings) or (
         len(list_settings) == 0 and len(component_names) == 1
     ):
         return True
@@ -365,6 +392,89 @@ def doe_exists(doe_name, list_settings, doe_root_path=None):
     return False
 
 
+def get_variant_hash(component_factory, settings, *args):
+    """
+    Returns a hash of a DOE variant: the settings, the factory source,
+    the tech config and args (precision, component filter ...)
+    callable args contribute their source
+
+    the sources of the factories of the cells that the variant depends on
+    are only known once it is built, so they are saved in the manifest
+    and checked by get_cached_variants
+    """
+    h = hashlib.sha256(get_disk_cache_key(component_factory, **settings).encode())
+    h.update(OmegaConf.to_yaml(conf.tech).encode())
+    for arg in args:
+        arg = get_source_hash(arg) if callable(arg) else repr(arg)
+        h.update(arg.encode())
+    return h.hexdigest()
+
+
+def load_doe_manifest(doe_name, doe_root_path=None):
+    """
+    Returns {variant hash: component name} of the variants built in a DOE
+    """
+    if doe_root_path is None:
+        doe_root_path = CONFIG["cache_doe_directory"]
+    manifest_file = os.path.join(doe_root_path, doe_name, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)["variants"]
+
+
+def load_doe_variant_sources(doe_name, doe_root_path=None):
+    """
+    Returns {variant hash: {module.function: source hash}} of the factories
+    of all the cells of each variant built in a DOE (get_dependency_sources)
+    """
+    if doe_root_path is None:
+        doe_root_path = CONFIG["cache_doe_directory"]
+    manifest_file = os.path.join(doe_root_path, doe_name, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f).get("sources", {})
+
+
+def save_doe_manifest(
+    doe_name, component_names, variant_hashes, doe_root_path=None, variant_sources=None
+):
+    """
+    Write the hash of each variant of a DOE (manifest.json)
+    and the sources of the factories of its cells (variant_sources)
+    """
+    if doe_root_path is None:
+        doe_root_path = CONFIG["cache_doe_directory"]
+    manifest_file = os.path.join(doe_root_path, doe_name, "manifest.json")
+    variants = dict(zip(variant_hashes, component_names))
+    sources = dict(zip(variant_hashes, variant_sources or []))
+    with open(manifest_file, "w") as fw:
+        json.dump(dict(variants=variants, sources=sources), fw, indent=2)
+
+
+def get_cached_variants(doe_name, variant_hashes, doe_root_path=None):
+    """
+    Returns {variant index: component name} of the variants of a DOE
+    that have the same hash in the manifest, a GDS file and no changes in the
+    sources of the factories of their cells
+    """
+    if doe_root_path is None:
+        doe_root_path = CONFIG["cache_doe_directory"]
+    manifest = load_doe_manifest(doe_name, doe_root_path)
+    sources = load_doe_variant_sources(doe_name, doe_root_path)
+    cached = {}
+    for index, variant_hash in enumerate(variant_hashes):
+        name = manifest.get(variant_hash)
+        if (
+            name
+            and os.path.exists(os.path.join(doe_root_path, doe_name, name + ".gds"))
+            and not sources_changed(sources.get(variant_hash))
+        ):
+            cached[index] = name
+    return cached
+
+
 def component_grid_from_yaml(filepath, precision=1e-9):
     """ Returns a Component composed of DOEs/components given in a yaml file
     allows for each DOE to have its own x and y spacing (more flexible than method1)
@@ -1,6 +1,8 @@
 from typing import Callable
 from typing import Any, List, Optional, Tuple, Dict, Union
 import functools
+import itertools
+import weakref
 from copy import deepcopy
 import csv
 import numpy as np
@@ -11,6 +13,68 @@ from pp.drc import snap_to_grid
 
 port_types = ["optical", "rf", "dc", "heater"]
 
+_versions = itertools.count(1)
+
+
+class PortDict(dict):
+    """ ports dictionary {port name: port} that keeps track of its changes
+
+    `version` changes every time a port is added or removed,
+    and every time one of its ports changes midpoint, orientation, width, layer or port_type.
+    Versions are unique across dicts, so (dict version) identifies the ports state.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__()
+        self.update(*args, **kwargs)
+        self.touch()
+
+    def touch(self) -> None:
+        self.version = next(_versions)
+
+    def __setitem__(self, name, port) -> None:
+        super().__setitem__(name, port)
+        register = getattr(port, "_register", None)
+        if register is not None:
+            register(self)
+        self.touch()
+
+    def __delitem__(self, name) -> None:
+        super().__delitem__(name)
+        self.touch()
+
+    def pop(self, *args):
+        port = super().pop(*args)
+        self.touch()
+        return port
+
+    def popitem(self):
+        item = super().popitem()
+        self.touch()
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        self.touch()
+
+    def setdefault(self, name, port=None):
+        if name not in self:
+            self[name] = port
+        return self[name]
+
+    def update(self, *args, **kwargs) -> None:
+        for name, port in dict(*args, **kwargs).items():
+            self[name] = port
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.pop("_table", None)
+        return state
+
 
 class Port(PortPhidl):
     """Extends phidl port with layer and port_type (optical, dc, rf)
@@ -52,6 +116,74 @@ class Port(PortPhidl):
             raise ValueError("[PHIDL] Port creation error: width must be >=0")
         self._next_uid += 1
 
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.pop("_dicts", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+
+    def _register(self, ports: PortDict) -> None:
+        """ keeps track of the PortDicts that contain this port """
+        dicts = self.__dict__.setdefault("_dicts", [])
+        for ref in dicts:
+            if ref() is ports:
+                return
+        dicts.append(weakref.ref(ports))
+
+    def _touch(self) -> None:
+        """ changes the version of the PortDicts that contain this port """
+        for ref in self.__dict__.get("_dicts", ()):
+            ports = ref()
+            if ports is not None:
+                ports.touch()
+
+    @property
+    def midpoint(self):
+        return self._midpoint
+
+    @midpoint.setter
+    def midpoint(self, midpoint) -> None:
+        self._midpoint = midpoint
+        self._touch()
+
+    @property
+    def orientation(self):
+        return self._orientation
+
+    @orientation.setter
+    def orientation(self, orientation) -> None:
+        self._orientation = orientation
+        self._touch()
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, width) -> None:
+        self._width = width
+        self._touch()
+
+    @property
+    def layer(self):
+        return self._layer
+
+    @layer.setter
+    def layer(self, layer) -> None:
+        self._layer = layer
+        self._touch()
+
+    @property
+    def port_type(self):
+        return self._port_type
+
+    @port_type.setter
+    def port_type(self, port_type) -> None:
+        self._port_type = port_type
+        self._touch()
+
     def __repr__(self) -> str:
         return (
             "Port (name {}, midpoint {}, width {}, orientation {}, layer {},"
@@ -135,6 +267,115 @@ class Port(PortPhidl):
             )
 
 
+def _intern(values: List[Any]) -> Tuple[List[Any], np.ndarray]:
+    """ returns unique values (in order of appearance) and the code of each value """
+    codes = {}
+    uniques = []
+    value_codes = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        key = tuple(value) if isinstance(value, (list, np.ndarray)) else value
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(uniques)
+            uniques.append(value)
+        value_codes[i] = code
+    return uniques, value_codes
+
+
+class PortTable:
+    """ struct-of-arrays (columnar) view of ports
+
+    Ports are still stored as Port objects, the table keeps contiguous numpy columns
+    (x, y, orientation, width) and interned layer and port_type codes
+    so port queries run as vectorized column operations.
+
+    Args:
+        ports: dict {port name: port} or list of ports
+
+    """
+
+    def __init__(self, ports: Union[Dict[str, Port], List[Port]]) -> None:
+        self.version = getattr(ports, "version", None)
+        if isinstance(ports, dict):
+            self.names = list(ports.keys())
+            self.ports = list(ports.values())
+        else:
+            self.ports = list(ports)
+            self.names = [port.name for port in self.ports]
+
+        n = len(self.ports)
+        midpoints = np.array([port.midpoint for port in self.ports], dtype=float)
+        self.midpoints = midpoints.reshape(n, 2)
+        self.x = self.midpoints[:, 0]
+        self.y = self.midpoints[:, 1]
+        self.orientation = np.array(
+            [port.orientation for port in self.ports], dtype=float
+        )
+        self.width = np.array([port.width for port in self.ports], dtype=float)
+        self.layers, self.layer_code = _intern([port.layer for port in self.ports])
+        self.port_types, self.port_type_code = _intern(
+            [port.port_type for port in self.ports]
+        )
+
+    def __len__(self) -> int:
+        return len(self.ports)
+
+    def layer_mask(self, layer: Any) -> np.ndarray:
+        codes = [i for i, value in enumerate(self.layers) if value == layer]
+        return np.isin(self.layer_code, codes)
+
+    def port_type_mask(self, port_type: Any) -> np.ndarray:
+        codes = [i for i, value in enumerate(self.port_types) if value == port_type]
+        return np.isin(self.port_type_code, codes)
+
+    def prefix_mask(self, prefix: str) -> np.ndarray:
+        return np.array(
+            [name.startswith(prefix) for name in self.names], dtype=bool
+        ).reshape(len(self))
+
+    def direction_mask(self, direction: str) -> np.ndarray:
+        """ returns a mask of the ports facing a direction (E, N, W, S) """
+        angle = self.orientation % 360
+        east = (angle <= 45) | (angle >= 315)
+        north = ~east & (angle <= 135) & (angle >= 45)
+        west = ~east & ~north & (angle <= 225) & (angle >= 135)
+        south = ~east & ~north & ~west
+        return dict(E=east, N=north, W=west, S=south)[direction]
+
+    def off_grid_mask(self, nm: int = 1) -> np.ndarray:
+        """ returns a mask of the ports with an off-grid edge point
+        or an orientation that is not a multiple of 90
+        """
+        horizontal = np.isin(self.orientation, [0, 180])
+        vertical = np.isin(self.orientation, [90, 270])
+        edge = np.where(horizontal, self.y, self.x) + self.width / 2
+        on_grid = np.isclose(snap_to_grid(edge, nm=nm), edge)
+        return ~((horizontal | vertical) & on_grid)
+
+    def select(self, mask: np.ndarray) -> Dict[str, Port]:
+        """ returns the ports of a mask as a dict {port name: port} """
+        names = self.names
+        ports = self.ports
+        return {names[i]: ports[i] for i in np.flatnonzero(mask)}
+
+    def select_list(self, mask: np.ndarray) -> List[Port]:
+        ports = self.ports
+        return [ports[i] for i in np.flatnonzero(mask)]
+
+
+def get_ports_table(ports: Union[Dict[str, Port], List[Port]]) -> PortTable:
+    """ returns the PortTable of ports
+    the table of a PortDict is cached until the PortDict changes
+    """
+    if isinstance(ports, PortDict):
+        table = ports.__dict__.get("_table")
+        if table is None or table.version != ports.version:
+            table = PortTable(ports)
+            ports._table = table
+        return table
+    return PortTable(ports)
+
+
 def read_port_markers(gdspath, layers=[(69, 0)]):
     """loads a GDS and returns the extracted device for a particular layer
 
@@ -184,14 +425,11 @@ def select_ports(
     if isinstance(ports, Component) or isinstance(ports, ComponentReference):
         ports = ports.ports
 
-    ports = {
-        p_name: p
-        for p_name, p in ports.items()
-        if p.port_type == port_type or p.layer == port_type
-    }
+    table = get_ports_table(ports)
+    mask = table.port_type_mask(port_type) | table.layer_mask(port_type)
     if prefix:
-        ports = {p_name: p for p_name, p in ports.items() if p_name.startswith(prefix)}
-    return ports
+        mask &= table.prefix_mask(prefix)
+    return table.select(mask)
 
 
 def select_optical_ports(ports: Dict[str, Port], prefix=None) -> Dict[str, Port]:
@@ -219,25 +457,11 @@ def move_copy(port, x=0, y=0):
 def get_ports_facing(ports, direction="W"):
     from pp.component import Component, ComponentReference
 
-    if isinstance(ports, dict):
-        ports = list(ports.values())
-    elif isinstance(ports, Component) or isinstance(ports, ComponentReference):
-        ports = list(ports.ports.values())
-
-    direction_ports = {x: [] for x in ["E", "N", "W", "S"]}
-
-    for p in ports:
-        angle = p.orientation % 360
-        if angle <= 45 or angle >= 315:
-            direction_ports["E"].append(p)
-        elif angle <= 135 and angle >= 45:
-            direction_ports["N"].append(p)
-        elif angle <= 225 and angle >= 135:
-            direction_ports["W"].append(p)
-        else:
-            direction_ports["S"].append(p)
+    if isinstance(ports, Component) or isinstance(ports, ComponentReference):
+        ports = ports.ports
 
-    return direction_ports[direction]
+    table = get_ports_table(ports)
+    return table.select_list(table.direction_mask(direction))
 
 
 def get_non_optical_ports(ports):
@@ -394,6 +618,28 @@ def test_select_ports_type():
     assert len(ports) == 3
 
 
+def test_ports_table():
+    import pp
+
+    c = pp.Component()
+    for i, orientation in enumerate([0, 45, 90, 135, 180, 225, 270, 315, 360]):
+        c.add_port(name=f"P{i}", midpoint=(i, 0), orientation=orientation)
+    c.add_port(name="D0", midpoint=(0, 1), orientation=90, port_type="dc")
+
+    table = c.get_ports_table()
+    assert table is c.get_ports_table()
+    assert [p.name for p in get_ports_facing(c, "E")] == ["P0", "P1", "P7", "P8"]
+    assert [p.name for p in get_ports_facing(c, "N")] == ["P2", "P3", "D0"]
+    assert [p.name for p in get_ports_facing(c, "W")] == ["P4", "P5"]
+    assert [p.name for p in get_ports_facing(c, "S")] == ["P6"]
+    assert list(select_ports(c, port_type="dc")) == ["D0"]
+
+    c.ports["D0"].port_type = "optical"
+    assert c.get_ports_table() is not table
+    assert select_ports(c, port_type="dc") == {}
+    assert len(select_ports(c, port_type=(1, 0), prefix="P")) == 9
+
+
 if __name__ == "__main__":
     test_select_ports_type()
 
@@ -2,18 +2,23 @@
 Route optical and electrical waveguides
 """
 
+# pp.components first: some components import pp.routing.connect
+import pp.components  # noqa: F401
 from pp.routing.add_electrical_pads import add_electrical_pads
 from pp.routing.add_electrical_pads_shortest import add_electrical_pads_shortest
 from pp.routing.add_electrical_pads_top import add_electrical_pads_top
 from pp.routing.add_fiber_array import add_fiber_array
 from pp.routing.add_fiber_single import add_fiber_single
+from pp.routing.astar import route_astar
 from pp.routing.connect import connect_strip, connect_strip_way_points
 from pp.routing.connect_bundle import connect_bundle
 from pp.routing.connect_bundle import connect_bundle_path_length_match
 from pp.routing.connect_bundle import link_electrical_ports
 from pp.routing.connect_bundle import link_optical_ports
-from pp.routing.manhattan import round_corners, route_manhattan
+from pp.routing.manhattan import round_corners, round_corners_bundle, route_manhattan
+from pp.routing.obstacle_index import ObstacleIndex
 from pp.routing.repackage import package_optical2x2
+from pp.routing.route_executor import route_bundles
 from pp.routing.route_fiber_single import route_fiber_single
 from pp.routing.route_ports_to_side import route_elec_ports_to_side, route_ports_to_side
 
@@ -30,8 +35,12 @@ __all__ = [
     "connect_strip_way_points",
     "link_electrical_ports",
     "link_optical_ports",
+    "ObstacleIndex",
     "package_optical2x2",
     "round_corners",
+    "round_corners_bundle",
+    "route_astar",
+    "route_bundles",
     "route_elec_ports_to_side",
     "route_fiber_single",
     "route_manhattan",
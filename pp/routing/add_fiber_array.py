@@ -3,7 +3,6 @@ from pp.components.grating_coupler.elliptical_trenches import grating_coupler_te
 from pp.components.grating_coupler.elliptical_trenches import grating_coupler_tm
 
 import pp
-from pp.add_tapers import add_tapers
 from pp.components.taper import taper
 from pp.container import container
 
@@ -94,6 +93,8 @@ def add_fiber_array(
     port_width_component = optical_ports[0].width
 
     if port_width_component != port_width_gc:
+        from pp.add_tapers import add_tapers  # pp.add_tapers imports pp.components
+
         c = add_tapers(
             c,
             taper_factory(
@@ -12,7 +12,6 @@ from pp.components import waveguide
 from pp.components.grating_coupler.elliptical_trenches import grating_coupler_te
 from pp.container import container
 from pp.components.taper import taper
-from pp.add_tapers import add_tapers
 
 
 @container
@@ -82,6 +81,8 @@ def add_fiber_single(
     port_width_component = optical_ports[0].width
 
     if port_width_component != port_width_gc:
+        from pp.add_tapers import add_tapers  # pp.add_tapers imports pp.components
+
         component = add_tapers(
             component,
             taper_factory(
@@ -0,0 +1,510 @@
+""" obstacle-avoiding manhattan router (A* search)
+
+The search graph is the grid of lines through the edges of the keep-out boxes
+(obstacle bounding boxes grown by the separation), the start and the end
+points. A path can only turn after going straight long enough for the bends
+(bend_radius after the port, 2 * bend_radius between two turns) and the
+square where each bend goes has to be free. Straight runs jump from node to
+node where the route may turn or end (see _Grid), so an expansion covers
+a whole run instead of one grid line.
+
+The search only looks at obstacles within `margin` of the ports and stops
+after `max_iterations` expanded nodes, so it stays fast on large layouts.
+The waypoints can be used directly by `round_corners`.
+"""
+
+import bisect
+import heapq
+import itertools
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+from numpy import ndarray
+
+from pp.component import Component
+from pp.config import conf
+from pp.port import Port
+from pp.routing.connect import connect_strip_way_points
+from pp.routing.obstacle_index import ObstacleIndex
+
+Bbox = Tuple[float, float, float, float]
+DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]  # East, North, West, South
+TOLERANCE = 1e-6
+
+
+def _get_direction(orientation: float) -> int:
+    """ returns the index in DIRECTIONS of a manhattan port orientation"""
+    return int(round(orientation / 90)) % 4
+
+
+def _get_bboxes(obstacles: Union[ObstacleIndex, Component, List[Bbox]]) -> ndarray:
+    """ returns (N, 4) array of (xmin, ymin, xmax, ymax)"""
+    if isinstance(obstacles, Component):
+        obstacles = ObstacleIndex.from_component(obstacles)
+    if isinstance(obstacles, ObstacleIndex):
+        obstacles = [obstacle.bbox for obstacle in obstacles.obstacles]
+    return np.array(obstacles, dtype=float).reshape(-1, 4)
+
+
+class _Grid:
+    """ grid of lines through the keep-out box edges, with the nodes where
+    a straight run may stop in each row and column (computed as the search
+    reaches them)
+
+    A run stops on the lines of the ports bends, at the end, before an
+    obstacle and on both sides of a change of the bends that fit. Between
+    these nodes a route can only go straight, so the search jumps over them.
+    """
+
+    def __init__(
+        self,
+        xs: ndarray,
+        ys: ndarray,
+        bboxes: ndarray,
+        bend_radius: float,
+        port_ixs: List[int],
+        port_iys: List[int],
+        end: Tuple[int, int],
+    ) -> None:
+        self.xs = xs
+        self.ys = ys
+        bboxes = np.round(bboxes, 6)
+        self.bboxes = bboxes
+        self.bend_radius = bend_radius
+        self.ix = np.searchsorted(xs, np.clip(bboxes[:, [0, 2]], xs[0], xs[-1]))
+        self.iy = np.searchsorted(ys, np.clip(bboxes[:, [1, 3]], ys[0], ys[-1]))
+        self.port_ixs = port_ixs
+        self.port_iys = port_iys
+        self.end = end
+        self._turns = {}
+        self._stops = {}
+
+    @staticmethod
+    def _get_blocked(
+        coordinate: float, bounds: ndarray, indices: ndarray, n: int
+    ) -> ndarray:
+        inside = (bounds[:, 0] < coordinate - TOLERANCE) & (
+            bounds[:, 1] > coordinate + TOLERANCE
+        )
+        blocked = np.zeros(n + 1, dtype=int)
+        np.add.at(blocked, indices[inside, 0], 1)
+        np.add.at(blocked, indices[inside, 1], -1)
+        return np.cumsum(blocked[:-1]) > 0
+
+    def get_turns_blocked(
+        self, line: int, direction: int, new_direction: int
+    ) -> List[bool]:
+        """ returns for each node of a row (direction East or West) or of a
+        column (North or South) if the square of a bend from direction to
+        new_direction at the node overlaps a keep-out box
+        """
+        key = (line, direction, new_direction)
+        blocked = self._turns.get(key)
+        if blocked is not None:
+            return blocked
+
+        r = self.bend_radius
+        dx, dy = DIRECTIONS[direction]
+        tx, ty = DIRECTIONS[new_direction]
+        if dx:
+            along, coordinate, sign, side = self.xs, self.ys[line], dx, ty
+            bounds_along, bounds_across = self.bboxes[:, [0, 2]], self.bboxes[:, [1, 3]]
+        else:
+            along, coordinate, sign, side = self.ys, self.xs[line], dy, tx
+            bounds_along, bounds_across = self.bboxes[:, [1, 3]], self.bboxes[:, [0, 2]]
+
+        # the square spans r to the side of the line and r back along it
+        band = (coordinate, coordinate + r) if side > 0 else (coordinate - r, coordinate)
+        in_band = (bounds_across[:, 0] < band[1] - TOLERANCE) & (
+            bounds_across[:, 1] > band[0] + TOLERANCE
+        )
+        low, high = bounds_along[in_band, 0], bounds_along[in_band, 1]
+        if sign > 0:
+            high = high + r
+        else:
+            low = low - r
+        start = np.searchsorted(along, low + TOLERANCE, side="right")
+        stop = np.searchsorted(along, high - TOLERANCE, side="left")
+        valid = stop > start
+        counts = np.zeros(len(along) + 1, dtype=int)
+        np.add.at(counts, start[valid], 1)
+        np.add.at(counts, stop[valid], -1)
+        blocked = (np.cumsum(counts[:-1]) > 0).tolist()
+        self._turns[key] = blocked
+        return blocked
+
+    def get_stops(self, line: int, direction: int) -> Tuple[List[int], List[int]]:
+        """ returns the sorted indices along a row or column of
+        the nodes before an obstacle (or the window edge) in direction,
+        and of all the nodes where a run stops
+        """
+        key = (line, direction)
+        stops = self._stops.get(key)
+        if stops is not None:
+            return stops
+
+        dx, dy = DIRECTIONS[direction]
+        if dx:
+            blocked = self._get_blocked(
+                self.ys[line], self.bboxes[:, [1, 3]], self.ix, len(self.xs) - 1
+            )
+            ports = self.port_ixs + ([self.end[0]] if line == self.end[1] else [])
+        else:
+            blocked = self._get_blocked(
+                self.xs[line], self.bboxes[:, [0, 2]], self.iy, len(self.ys) - 1
+            )
+            ports = self.port_iys + ([self.end[1]] if line == self.end[0] else [])
+        n = len(blocked) + 1
+
+        # blocked[i]: edge between nodes i and i + 1
+        if dx + dy > 0:
+            obstacles = np.append(np.flatnonzero(blocked), n - 1)
+        else:
+            obstacles = np.insert(np.flatnonzero(blocked) + 1, 0, 0)
+
+        changes = np.zeros(n - 1, dtype=bool)
+        for new_direction in ((direction + 1) % 4, (direction - 1) % 4):
+            turns = np.array(self.get_turns_blocked(line, direction, new_direction))
+            changes |= turns[1:] != turns[:-1]
+        changes = np.flatnonzero(changes)
+
+        nodes = np.unique(np.concatenate((obstacles, changes, changes + 1, ports)))
+        stops = (obstacles.tolist(), nodes.tolist())
+        self._stops[key] = stops
+        return stops
+
+
+def generate_astar_waypoints(
+    input_port: Port,
+    output_port: Port,
+    obstacles: Union[ObstacleIndex, Component, List[Bbox]],
+    bend_radius: float = conf.tech.bend_radius,
+    separation: float = 3.0,
+    start_straight: float = 0.01,
+    end_straight: float = 0.01,
+    bend_penalty: Optional[float] = None,
+    margin: Optional[float] = None,
+    grid: Optional[float] = None,
+    max_iterations: int = 100000,
+    heuristic_weight: float = 1.2,
+) -> ndarray:
+    """ returns the waypoints of the shortest manhattan route between two
+    ports that keeps `separation` from the obstacles
+
+    Args:
+        input_port: start port (the route leaves in the port direction)
+        output_port: end port (the route arrives facing the port)
+        obstacles: ObstacleIndex, Component (uses its references bounding boxes
+            and polygons) or list of (xmin, ymin, xmax, ymax)
+        bend_radius: of the bends that round_corners adds at each waypoint
+        separation: minimum distance between the waveguide edge and obstacles
+        start_straight: minimum straight after the input port
+        end_straight: minimum straight before the output port
+        bend_penalty: extra cost of each bend (um), defaults to 2 * bend_radius
+        margin: the route stays within the ports bounding box grown by margin
+            (defaults to 20 * bend_radius), obstacles outside are ignored
+        grid: adds grid lines every `grid` um (None only uses the lines through
+            the obstacle edges and the ports)
+        max_iterations: search budget (number of expanded nodes)
+        heuristic_weight: values > 1 find a route expanding less nodes,
+            at most heuristic_weight times longer than the shortest one.
+            1.0 finds the shortest route, but can run out of iterations
+            on layouts with thousands of obstacles
+
+    Returns:
+        (N, 2) waypoints from the input port to the output port
+    """
+    bend_penalty = 2 * bend_radius if bend_penalty is None else bend_penalty
+    margin = 20 * bend_radius if margin is None else margin
+    clearance = separation + 0.5 * max(input_port.width, output_port.width)
+
+    p_in = np.array(input_port.midpoint, dtype=float)
+    p_out = np.array(output_port.midpoint, dtype=float)
+    d_in = _get_direction(input_port.orientation)
+    d_out = (_get_direction(output_port.orientation) + 2) % 4  # arrival direction
+
+    xmin, ymin = np.minimum(p_in, p_out) - margin
+    xmax, ymax = np.maximum(p_in, p_out) + margin
+
+    bboxes = _get_bboxes(obstacles)
+    if len(bboxes):
+        inside = (
+            (bboxes[:, 2] > xmin)
+            & (bboxes[:, 0] < xmax)
+            & (bboxes[:, 3] > ymin)
+            & (bboxes[:, 1] < ymax)
+        )
+        bboxes = bboxes[inside]
+
+    # boxes that hold the ports (the devices that the route connects) are not
+    # grown, the route leaves them from their edge
+    grown = bboxes + np.array([-clearance, -clearance, clearance, clearance])
+    for p in (p_in, p_out):
+        holds_port = (
+            (grown[:, 0] < p[0])
+            & (p[0] < grown[:, 2])
+            & (grown[:, 1] < p[1])
+            & (p[1] < grown[:, 3])
+        )
+        grown[holds_port] = bboxes[holds_port]
+
+    # leave the ports with a straight, and reach the end straight
+    lead_in = max(start_straight, clearance)
+    lead_out = max(end_straight, clearance)
+    start = p_in + lead_in * np.array(DIRECTIONS[d_in])
+    end = p_out - lead_out * np.array(DIRECTIONS[d_out])
+
+    # lines through the keep-out edges, and one bend radius outside them
+    # where a bend around the box fits
+    port_xs = [start[0], end[0]]
+    port_ys = [start[1], end[1]]
+    for p in (p_in, p_out):  # first and last bends
+        for offset in (-2 * bend_radius, -bend_radius, bend_radius, 2 * bend_radius):
+            port_xs.append(p[0] + offset)
+            port_ys.append(p[1] + offset)
+    port_xs = np.clip(np.round(port_xs, 6), xmin, xmax)
+    port_ys = np.clip(np.round(port_ys, 6), ymin, ymax)
+    xs = [xmin, xmax] + list(port_xs)
+    ys = [ymin, ymax] + list(port_ys)
+    for offset in (0, bend_radius):
+        xs += list(grown[:, 0] - offset) + list(grown[:, 2] + offset)
+        ys += list(grown[:, 1] - offset) + list(grown[:, 3] + offset)
+    if grid:
+        xs += list(np.arange(xmin, xmax, grid))
+        ys += list(np.arange(ymin, ymax, grid))
+    xs = np.unique(np.clip(np.round(xs, 6), xmin, xmax))
+    ys = np.unique(np.clip(np.round(ys, 6), ymin, ymax))
+    i_start = (
+        int(np.searchsorted(xs, round(start[0], 6))),
+        int(np.searchsorted(ys, round(start[1], 6))),
+    )
+    i_end = (
+        int(np.searchsorted(xs, round(end[0], 6))),
+        int(np.searchsorted(ys, round(end[1], 6))),
+    )
+    # a straight run always stops on the lines of the ports bends
+    port_ixs = np.searchsorted(xs, port_xs).tolist()
+    port_iys = np.searchsorted(ys, port_ys).tolist()
+    grid_edges = _Grid(xs, ys, grown, bend_radius, port_ixs, port_iys, i_end)
+    xs = xs.tolist()
+    ys = ys.tolist()
+
+    def point(node: Tuple[int, int]) -> Tuple[float, float]:
+        return xs[node[0]], ys[node[1]]
+
+    def heuristic(node: Tuple[int, int], direction: int) -> float:
+        """ manhattan distance to the end and the bends that are still needed"""
+        x, y = point(node)
+        dx, dy = DIRECTIONS[direction]
+        if direction == d_out:
+            ahead = (end[0] - x) * dx + (end[1] - y) * dy
+            aside = abs((end[0] - x) * dy) + abs((end[1] - y) * dx)
+            bends = 0 if aside < TOLERANCE and ahead > -TOLERANCE else 2
+        elif direction == (d_out + 2) % 4:
+            bends = 2
+        else:
+            bends = 1
+        return abs(x - end[0]) + abs(y - end[1]) + bends * bend_penalty
+
+    # run: straight length since the last bend. A bend needs a 2 * bend_radius
+    # run before it, counting bend_radius of room before the input port, and
+    # the last bend needs bend_radius of straight before the output port
+    run_required = round(2 * bend_radius, 6)
+    run_end = bend_radius - lead_out
+
+    counter = itertools.count()
+    queue = []
+    parents = {}
+    costs = {}
+
+    def push(node, direction, run, cost, parent) -> None:
+        state = (node, direction, round(min(run, run_required), 6))
+        if cost < costs.get(state, np.inf) - TOLERANCE:
+            costs[state] = cost
+            priority = cost + heuristic_weight * heuristic(node, direction)
+            # on ties, expand the deepest node first
+            heapq.heappush(queue, (priority, -cost, next(counter), state, parent))
+
+    def get_turns_blocked(node, direction, turns) -> Tuple[bool, bool]:
+        line = node[1] if direction % 2 == 0 else node[0]
+        index = node[0] if direction % 2 == 0 else node[1]
+        return tuple(
+            grid_edges.get_turns_blocked(line, direction, new_direction)[index]
+            for new_direction in turns
+        )
+
+    def jump(node, direction, run, cost, state) -> None:
+        """ goes straight from node to the next node where the route may turn
+        or end: the end, the lines of the ports bends, the node where the run
+        becomes long enough for a bend, the nodes before and after a change
+        of the bends that fit, or the last node before an obstacle
+        """
+        dx, dy = DIRECTIONS[direction]
+        line, index = (node[1], node[0]) if dx else (node[0], node[1])
+        coordinates = xs if dx else ys
+        obstacles, stops = grid_edges.get_stops(line, direction)
+        forward = dx + dy > 0
+
+        # the obstacles (and window edges) are always ahead, or at the node
+        if forward:
+            obstacle = obstacles[bisect.bisect_left(obstacles, index)]
+            if obstacle == index:
+                return
+            new_index = stops[bisect.bisect_right(stops, index)]
+        else:
+            obstacle = obstacles[bisect.bisect_right(obstacles, index) - 1]
+            if obstacle == index:
+                return
+            new_index = stops[bisect.bisect_left(stops, index) - 1]
+
+        if run < run_required - TOLERANCE:
+            # only the end or the ports lines before the run is long enough
+            room = run_required - run - TOLERANCE
+            if forward:
+                crossing = bisect.bisect_left(coordinates, coordinates[index] + room)
+                if crossing < new_index:
+                    new_index = crossing
+            else:
+                crossing = bisect.bisect_right(coordinates, coordinates[index] - room)
+                crossing -= 1
+                if crossing > new_index:
+                    new_index = crossing
+            if (new_index - obstacle) * (1 if forward else -1) > 0:
+                return
+
+        new_node = (new_index, line) if dx else (line, new_index)
+        length = abs(coordinates[new_index] - coordinates[index])
+        push(new_node, direction, run + length, cost + length, state)
+
+    push(i_start, d_in, lead_in + bend_radius, 0.0, None)
+
+    for _ in range(max_iterations):
+        if not queue:
+            break
+        _, cost, _, state, parent = heapq.heappop(queue)
+        if state in parents:
+            continue
+        parents[state] = parent
+        cost = -cost
+        node, direction, run = state
+
+        if node == i_end and direction == d_out and run >= run_end - TOLERANCE:
+            return _get_waypoints(state, parents, point, p_in, p_out)
+
+        jump(node, direction, run, cost, state)
+
+        if run < run_required - TOLERANCE:
+            continue
+
+        turns = ((direction + 1) % 4, (direction - 1) % 4)
+        for new_direction, blocked in zip(
+            turns, get_turns_blocked(node, direction, turns)
+        ):
+            if not blocked:
+                push(node, new_direction, 0.0, cost + bend_penalty, state)
+
+    raise ValueError(
+        f"No route found from {input_port} to {output_port} "
+        f"within {max_iterations} iterations and margin {margin}"
+    )
+
+
+def _get_waypoints(state, parents, point, p_in: ndarray, p_out: ndarray) -> ndarray:
+    """ returns the corners of the path that ends in state"""
+    nodes = []
+    while state is not None:
+        nodes.append(state)
+        state = parents[state]
+    nodes.reverse()
+
+    points = [p_in]
+    for previous, current in zip(nodes[:-1], nodes[1:]):
+        if current[1] != previous[1]:
+            points.append(point(previous[0]))
+    points.append(p_out)
+    return np.array(points)
+
+
+def route_astar(
+    input_port: Port,
+    output_port: Port,
+    obstacles: Union[ObstacleIndex, Component, List[Bbox]],
+    route_filter: Callable = connect_strip_way_points,
+    bend_radius: float = conf.tech.bend_radius,
+    **kwargs,
+):
+    """ returns a route between two ports that avoids obstacles
+
+    Args:
+        input_port:
+        output_port:
+        obstacles: ObstacleIndex, Component or list of bounding boxes
+        route_filter: turns the waypoints into a route
+        bend_radius:
+        kwargs: for generate_astar_waypoints
+    """
+    waypoints = generate_astar_waypoints(
+        input_port, output_port, obstacles, bend_radius=bend_radius, **kwargs
+    )
+    return route_filter(waypoints, bend_radius=bend_radius)
+
+
+def test_astar_waypoints():
+    import pp
+    import pytest
+    from pp.routing.manhattan import round_corners
+
+    c = pp.Component()
+    obstacle = c << pp.c.rectangle(size=(40, 200), layer=pp.LAYER.WG)
+    obstacle.move((50, -100))
+    p1 = Port("in", (0, 0), 0.5, 0)
+    p2 = Port("out", (150, 0), 0.5, 180)
+    obstacles = ObstacleIndex.from_component(c)
+
+    points = generate_astar_waypoints(p1, p2, obstacles, bend_radius=10, separation=3)
+    assert np.allclose(points[0], p1.midpoint)
+    assert np.allclose(points[-1], p2.midpoint)
+    # the route goes around the obstacle
+    assert points[:, 1].max() >= 100 + 3 or points[:, 1].min() <= -100 - 3
+
+    route = round_corners(points, pp.c.bend_circular(radius=10), pp.c.waveguide)
+    assert obstacles.check_route(route) == []
+    assert np.allclose(route.ports["output"].midpoint, p2.midpoint)
+
+    # the obstacle blocks the route within margin=50
+    with pytest.raises(ValueError):
+        generate_astar_waypoints(p1, p2, obstacles, margin=50)
+
+
+def test_astar_waypoints_many_obstacles():
+    rng = np.random.RandomState(0)
+    xy = rng.uniform(0, 2000, size=(2000, 2))
+    bboxes = np.column_stack((xy, xy + 10))
+    p1 = Port("in", (-50, 1000), 0.5, 0)
+    p2 = Port("out", (2050, 1005), 0.5, 180)
+    points = generate_astar_waypoints(p1, p2, bboxes, separation=3)
+    assert np.allclose(points[0], p1.midpoint)
+    assert np.allclose(points[-1], p2.midpoint)
+
+    # no segment goes through an obstacle grown by the separation
+    grown = bboxes + np.array([-3.25, -3.25, 3.25, 3.25])
+    for start, end in zip(points[:-1], points[1:]):
+        low, high = np.minimum(start, end), np.maximum(start, end)
+        assert not np.any(
+            (grown[:, 0] < high[0] - TOLERANCE)
+            & (grown[:, 2] > low[0] + TOLERANCE)
+            & (grown[:, 1] < high[1] - TOLERANCE)
+            & (grown[:, 3] > low[1] + TOLERANCE)
+        )
+
+
+if __name__ == "__main__":
+    import pp
+
+    c = pp.Component()
+    obstacle = c << pp.c.rectangle(size=(40, 200), layer=pp.LAYER.WG)
+    obstacle.move((50, -100))
+    p1 = Port("in", (0, 0), 0.5, 0)
+    p2 = Port("out", (150, 0), 0.5, 180)
+    c.add(route_astar(p1, p2, c))
+    pp.show(c)
@@ -5,6 +5,7 @@ from phidl.device_layout import Port as PortPhidl
 from pp.routing.manhattan import route_manhattan
 from pp.routing.manhattan import generate_manhattan_waypoints
 from pp.routing.manhattan import round_corners
+from pp.routing.manhattan import round_corners_bundle
 from pp.components.bend_circular import bend_circular
 from pp.components import waveguide
 from pp.components import taper as taper_factory
@@ -62,22 +63,8 @@ def connect_strip(
     return connector
 
 
-def connect_strip_way_points(
-    way_points=[],
-    bend_factory=bend_circular,
-    straight_factory=waveguide,
-    taper_factory=taper_factory,
-    bend_radius=10.0,
-    wg_width=0.5,
-    layer=LAYER.WG,
-    **kwargs
-):
-    """
-    Returns a deep-etched route formed by the given way_points with
-    bends instead of corners and optionally tapers in straight sections.
-
-    taper_factory: can be either a taper component or a factory
-    """
+def _get_strip_bend_taper(bend_factory, taper_factory, bend_radius, wg_width, layer):
+    """ returns the bend and the optional taper of a deep-etched route """
     bend90 = bend_factory(radius=bend_radius, width=wg_width)
 
     if taper_factory:
@@ -93,15 +80,60 @@ def connect_strip_way_points(
             taper = taper_factory
     else:
         taper = None
+    return bend90, taper
 
+
+def connect_strip_way_points(
+    way_points=[],
+    bend_factory=bend_circular,
+    straight_factory=waveguide,
+    taper_factory=taper_factory,
+    bend_radius=10.0,
+    wg_width=0.5,
+    layer=LAYER.WG,
+    **kwargs
+):
+    """
+    Returns a deep-etched route formed by the given way_points with
+    bends instead of corners and optionally tapers in straight sections.
+
+    taper_factory: can be either a taper component or a factory
+    """
+    bend90, taper = _get_strip_bend_taper(
+        bend_factory, taper_factory, bend_radius, wg_width, layer
+    )
     connector = round_corners(way_points, bend90, straight_factory, taper)
     return connector
 
 
+def connect_strip_way_points_bundle(
+    waypoints,
+    bend_factory=bend_circular,
+    straight_factory=waveguide,
+    taper_factory=taper_factory,
+    bend_radius=10.0,
+    wg_width=0.5,
+    layer=LAYER.WG,
+    **kwargs
+):
+    """ returns an iterator over the connect_strip_way_points routes of a bundle
+
+    waypoints: Waypoints or a list of way_points, one per route
+    """
+    bend90, taper = _get_strip_bend_taper(
+        bend_factory, taper_factory, bend_radius, wg_width, layer
+    )
+    return round_corners_bundle(waypoints, bend90, straight_factory, taper)
+
+
 def connect_strip_way_points_no_taper(*args, **kwargs):
     return connect_strip_way_points(*args, taper_factory=None, **kwargs)
 
 
+# bulk version of each route_filter, link_ports uses it for all the routes at once
+route_filter_bundles = {connect_strip_way_points: connect_strip_way_points_bundle}
+
+
 def connect_elec_waypoints(
     way_points=[],
     bend_factory=corner,
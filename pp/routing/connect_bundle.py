@@ -7,7 +7,11 @@ import numpy as np
 from pp.routing.connect import connect_strip
 from pp.routing.connect import connect_elec_waypoints
 from pp.routing.connect import connect_strip_way_points
+from pp.routing.connect import route_filter_bundles
+from pp.routing.manhattan import Waypoints
 from pp.routing.manhattan import generate_manhattan_waypoints
+from pp.routing.manhattan import generate_manhattan_waypoints_bundle
+from pp.routing.obstacle_index import ObstacleIndex
 
 from pp.routing.u_groove_bundle import u_bundle_indirect
 from pp.routing.u_groove_bundle import u_bundle_direct
@@ -29,6 +33,7 @@ def connect_bundle(
     separation=5.0,
     bend_radius=BEND_RADIUS,
     extension_length=0,
+    obstacles: Optional[ObstacleIndex] = None,
     **kwargs,
 ):
     """ Connects bundle of ports using river routing.
@@ -41,6 +46,10 @@ def connect_bundle(
         separation: waveguide separation
         bend_radius: for the routes
         extension_length: adds waveguide extension
+        obstacles: ObstacleIndex, reports the collisions of each route with
+            the obstacles and the previous routes as it is generated, and adds
+            it to the index. The references of the ports are ignored
+            (ObstacleIndex.ignore_port_instances)
 
     """
     # Accept dict ot list
@@ -66,11 +75,24 @@ def connect_bundle(
         len(set([p.angle for p in end_ports])) <= 1
     ), "All end port angles should be the same"
 
+    route_filter_bundle = route_filter_bundles.get(route_filter)
+    if obstacles is not None:
+        ports = start_ports + end_ports
+        route_filter = obstacles.wrap(route_filter, ports=ports)
+        if route_filter_bundle:
+            route_filter_bundle = obstacles.wrap(
+                route_filter_bundle, ports=ports, bundle=True
+            )
+
     # Ensure the correct bend radius is used
     def _route_filter(*args, **kwargs):
         kwargs["bend_radius"] = bend_radius
         return route_filter(*args, **kwargs)
 
+    def _route_filter_bundle(*args, **kwargs):
+        kwargs["bend_radius"] = bend_radius
+        return route_filter_bundle(*args, **kwargs)
+
     params = {
         "start_ports": start_ports,
         "end_ports": end_ports,
@@ -106,20 +128,27 @@ def connect_bundle(
             and end_angle == 90
             and y_start > y_end
         ):
-            return link_ports(**params, **kwargs)
+            routes = link_ports(
+                **params,
+                route_filter_bundle=_route_filter_bundle
+                if route_filter_bundle
+                else None,
+                **kwargs,
+            )
 
         elif start_angle == end_angle:
-            return u_bundle_direct(**params, **kwargs)
+            routes = u_bundle_direct(**params, **kwargs)
 
         elif end_angle == (start_angle + 180) % 360:
             params["extension_length"] = extension_length
-            return u_bundle_indirect(**params, **kwargs)
+            routes = u_bundle_indirect(**params, **kwargs)
         else:
             raise NotImplementedError("This should never happen")
 
     else:
-        return corner_bundle(**params, **kwargs)
-        raise NotImplementedError("Routing along different axis not implemented yet")
+        routes = corner_bundle(**params, **kwargs)
+
+    return routes
 
 
 def get_port_x(port: Port) -> float64:
@@ -135,13 +164,8 @@ def get_port_width(port):
 
 
 def are_decoupled(x1, x1p, x2, x2p, sep=METAL_MIN_SEPARATION):
-    if x2p + sep > x1:
-        return False
-    if x2 < x1p + sep:
-        return False
-    if x2 < x1p - sep:
-        return False
-    return True
+    """ works with floats or numpy arrays """
+    return np.logical_not((x2p + sep > x1) | (x2 < x1p + sep) | (x2 < x1p - sep))
 
 
 def link_ports(
@@ -149,6 +173,7 @@ def link_ports(
     end_ports: List[Port],
     separation: float = 5.0,
     route_filter: Callable = connect_strip_way_points,
+    route_filter_bundle: Optional[Callable] = None,
     **routing_params,
 ) -> List[ComponentReference]:
     """Semi auto-routing for two lists of ports.
@@ -163,6 +188,9 @@ def link_ports(
         bend_radius: If unspecified, attempts to get it from the waveguide definition of the first port in ports1
         route_filter: filter to apply to the manhattan waypoints
             e.g `connect_strip_way_points` for deep etch strip waveguide
+        route_filter_bundle: bulk version of route_filter, called once with
+            the Waypoints of all the routes. Defaults to
+            `route_filter_bundles[route_filter]` when there is one
         end_straight_offset: offset to add at the end of each waveguide
         sort_ports: * True -> sort the ports according to the axis.
                     * False -> no sort applied
@@ -213,6 +241,12 @@ def link_ports(
         **routing_params,
     )
 
+    route_filter_bundle = route_filter_bundle or route_filter_bundles.get(
+        route_filter
+    )
+    if route_filter_bundle:
+        waypoints = Waypoints.from_routes(routes)
+        return list(route_filter_bundle(waypoints, **routing_params))
     return [route_filter(route, **routing_params) for route in routes]
 
 
@@ -256,14 +290,6 @@ def link_ports_routes(
             )
         ]
 
-    elems = []
-
-    ## Contains end_straight of tracks which need to be adjusted together
-    end_straights_in_group = []
-
-    ## Once a group is finished, all the lengths are appended to end_straights
-    end_straights = []
-
     ## Axis along which we sort the ports
     if axis in ["X", "x"]:
         f_key1 = get_port_y
@@ -276,94 +302,48 @@ def link_ports_routes(
         ports1.sort(key=f_key1)
         ports2.sort(key=f_key2)
 
-    ## Keep track of how many ports should be routed together
-    number_o_connectors_in_group = 0
+    midpoints1 = np.array([p.midpoint for p in ports1], dtype=float)
+    midpoints2 = np.array([p.midpoint for p in ports2], dtype=float)
+    widths = np.array([get_port_width(p) for p in ports1], dtype=float)
 
     if axis in ["X", "x"]:
-        x1_prev = get_port_y(ports1[0])
-        x2_prev = get_port_y(ports2[0])
-        y0 = get_port_x(ports2[0])
-        y1 = get_port_x(ports1[0])
-    else:  # X axis
-        x1_prev = get_port_x(ports1[0])
-        x2_prev = get_port_x(ports2[0])
-        y0 = get_port_y(ports2[0])
-        y1 = get_port_y(ports1[0])
+        x1s, x2s, ys = midpoints1[:, 1], midpoints2[:, 1], midpoints2[:, 0]
+        y1 = midpoints1[0, 0]
+    else:
+        x1s, x2s, ys = midpoints1[:, 0], midpoints2[:, 0], midpoints2[:, 1]
+        y1 = midpoints1[0, 1]
+    y0 = ys[0]
 
     s = sign(y0 - y1)
-    curr_end_straight = 0
 
     end_straight_offset = end_straight_offset or 15.0
 
     Le = end_straight_offset
 
-    has_close_x_ports = False
     close_ports_thresh = 2 * bend_radius + 1.0
+    dxs = np.abs(x2s - x1s)
+    has_close_x_ports = bool(np.any(dxs < close_ports_thresh))
 
-    ## First pass - loop on all the ports to find the tentative end_straights
+    ## First pass - find the tentative end_straights of all the ports
 
-    _w = get_port_width
+    # metal separation to use, depends on the adjacent metal track widths
+    seps = np.empty(len(ports1))
+    seps[1:-1] = 0.5 * (widths[1:-1] + np.maximum(widths[2:], widths[:-2])) + separation
+    seps[0] = separation + 0.5 * (widths[0] + widths[1])
+    seps[-1] = separation + 0.5 * (widths[-2] + widths[-1])
 
-    for i in range(len(ports1)):
-        if axis in ["X", "x"]:
-            x1 = get_port_y(ports1[i])
-            x2 = get_port_y(ports2[i])
-            y = get_port_x(ports2[i])
-        else:
-            x1 = get_port_x(ports1[i])
-            x2 = get_port_x(ports2[i])
-            y = get_port_y(ports2[i])
-
-        dx = abs(x2 - x1)
-        if dx < close_ports_thresh:
-            has_close_x_ports = True
-
-        """
-        Compute the metal separation to use. This depends on the adjacent
-        metal track widths
-        """
-        if i != len(ports1) - 1 and i != 0:
-            # Deal with any track which is not on the edge
-            max_width = max(_w(ports1[i + 1]), _w(ports1[i - 1]))
-            curr_sep = 0.5 * (_w(ports1[i]) + max_width) + separation
-
-        elif i == 0:
-            # Deal with start edge case
-            curr_sep = separation + 0.5 * (_w(ports1[0]) + _w(ports1[1]))
-
-        elif i == len(ports1) - 1:
-            # Deal with end edge case
-            curr_sep = separation + 0.5 * (_w(ports1[-2]) + _w(ports1[-1]))
-
-        if are_decoupled(x2, x2_prev, x1, x1_prev, sep=curr_sep):
-            """
-            If this metal track does not impact the previous one, then
-            start a new group.
-            """
-            L = min(end_straights_in_group)
-            end_straights += [max(x - L, 0) + Le for x in end_straights_in_group]
-
-            # Start new group
-            end_straights_in_group = []
-            curr_end_straight = 0
-            number_o_connectors_in_group = 0
-
-        else:
-            if x2 >= x1:
-                curr_end_straight += curr_sep
-            else:
-                curr_end_straight -= curr_sep
+    # a track that does not impact the previous one starts a new group
+    x1s_prev = np.concatenate(([x1s[0]], x1s[:-1]))
+    x2s_prev = np.concatenate(([x2s[0]], x2s[:-1]))
+    decoupled = are_decoupled(x2s, x2s_prev, x1s, x1s_prev, sep=seps)
+    steps = np.where(decoupled, 0.0, np.where(x2s >= x1s, seps, -seps))
+    starts = np.concatenate(([0], np.flatnonzero(decoupled), [len(ports1)]))
 
-        end_straights_in_group.append(curr_end_straight + (y - y0) * s)
-        number_o_connectors_in_group += 1
-
-        x1_prev = x1
-        x2_prev = x2
-
-    # Append the last group
-    L = min(end_straights_in_group)
-
-    end_straights += [max(x - L, 0) + Le for x in end_straights_in_group]
+    end_straights = []
+    for start, end in zip(starts[:-1], starts[1:]):
+        end_straights_in_group = np.cumsum(steps[start:end]) + (ys[start:end] - y0) * s
+        L = min(end_straights_in_group)
+        end_straights += [max(x - L, 0) + Le for x in end_straights_in_group]
 
     if compute_array_separation_only:
         # If there is no port too close to each other in x, then there are
@@ -373,20 +353,33 @@ def link_ports_routes(
         else:
             return max(end_straights) + 4 * bend_radius
 
+    if routing_func is generate_manhattan_waypoints:
+        # compute the routes that do not need to step aside all at once
+        batch = np.flatnonzero((dxs < tol) | (dxs >= close_ports_thresh))
+        waypoints = generate_manhattan_waypoints_bundle(
+            [ports1[i] for i in batch],
+            [ports2[i] for i in batch],
+            bend_radius=bend_radius,
+            start_straight=np.where(dxs[batch] < tol, 0, 0.05),
+            end_straight=np.array(end_straights)[batch],
+            **kwargs,
+        )
+        batch_routes = dict(zip(batch, waypoints))
+    else:
+        batch_routes = {}
+
+    elems = []
+
     ## Second pass - route the ports pairwise
     N = len(ports1)
     for i in range(N):
-        if axis in ["X", "x"]:
-            x1 = get_port_y(ports1[i])
-            x2 = get_port_y(ports2[i])
-        else:
-            x1 = get_port_x(ports1[i])
-            x2 = get_port_x(ports2[i])
+        dx = dxs[i]
 
-        dx = abs(x2 - x1)
+        if i in batch_routes:
+            elems += [batch_routes[i]]
 
         # If both ports are aligned, we just need a straight line
-        if dx < tol:
+        elif dx < tol:
             elems += [
                 routing_func(
                     ports1[i],
@@ -765,13 +758,6 @@ def link_optical_ports_no_grouping(
     else:
         axis = "Y"
 
-    elems = []
-    j = 0
-
-    # min and max offsets needed for avoiding collisions between waveguides
-    min_j = 0
-    max_j = 0
-
     if sort_ports:
         # Sort ports according to X or Y
         if axis in ["X", "x"]:
@@ -781,23 +767,16 @@ def link_optical_ports_no_grouping(
             ports1.sort(key=get_port_x)
             ports2.sort(key=get_port_x)
 
-    # Compute max_j and min_j
-    for i in range(len(ports1)):
-        if axis in ["X", "x"]:
-            x1 = ports1[i].position.y
-            x2 = ports2[i].position.y
-        else:
-            x1 = ports1[i].position.x
-            x2 = ports2[i].position.x
-        if x2 >= x1:
-            j += 1
-        else:
-            j -= 1
-        if j < min_j:
-            min_j = j
-        if j > max_j:
-            max_j = j
-    j = 0
+    k = 1 if axis in ["X", "x"] else 0
+    x1s = np.array([p.position[k] for p in ports1])
+    x2s = np.array([p.position[k] for p in ports2])
+
+    # j: offset index of each waveguide, +1 for each port going up, -1 down
+    # min and max offsets needed for avoiding collisions between waveguides
+    js = np.cumsum(np.where(x2s >= x1s, 1, -1))
+    min_j = min(js.min(), 0)
+    max_j = max(js.max(), 0)
+    js = np.concatenate(([0], js[:-1]))
 
     if start_straight is None:
         start_straight = 0.2
@@ -808,26 +787,27 @@ def link_optical_ports_no_grouping(
     start_straight += max_j * sep
     end_straight += -min_j * sep
 
-    # Do case with wire direct if the ys are close to each other
-    for i in range(len(ports1)):
+    s_straights = start_straight - js * sep
+    e_straights = js * sep + end_straight
 
-        if axis in ["X", "x"]:
-            x1 = ports1[i].position.y
-            x2 = ports2[i].position.y
-        else:
-            x1 = ports1[i].position.x
-            x2 = ports2[i].position.x
-
-        s_straight = start_straight - j * sep
-        e_straight = j * sep + end_straight
+    if routing_func is generate_manhattan_waypoints and radius is not None:
+        return generate_manhattan_waypoints_bundle(
+            ports1,
+            ports2,
+            bend_radius=radius,
+            start_straight=s_straights,
+            end_straight=e_straights,
+        ).to_list()
 
+    elems = []
+    for i in range(len(ports1)):
         if radius is None:
             elems += [
                 routing_func(
                     ports1[i],
                     ports2[i],
-                    start_straight=s_straight,
-                    end_straight=e_straight,
+                    start_straight=s_straights[i],
+                    end_straight=e_straights[i],
                 )
             ]
         else:
@@ -835,16 +815,11 @@ def link_optical_ports_no_grouping(
                 routing_func(
                     ports1[i],
                     ports2[i],
-                    start_straight=s_straight,
-                    end_straight=e_straight,
+                    start_straight=s_straights[i],
+                    end_straight=e_straights[i],
                     bend_radius=radius,
                 )
             ]
-
-        if x2 >= x1:
-            j += 1
-        else:
-            j -= 1
     return elems
 
 
@@ -1048,6 +1023,27 @@ def test_facing_ports():
     return top_cell
 
 
+def test_link_ports_bundle():
+    def get_ports():
+        xs1 = [-100, -90, -80, -55, 200, 210, 240]
+        xs2 = [-20, -10, 0, 10, 400, 410, 420]
+        ports1 = [Port(f"top_{i}", (x, 0), 0.5, 90) for i, x in enumerate(xs1)]
+        ports2 = [Port(f"bottom_{i}", (x, 200), 0.5, 270) for i, x in enumerate(xs2)]
+        return ports1, ports2
+
+    def route_filter(waypoints, **kwargs):
+        return connect_strip_way_points(waypoints, **kwargs)
+
+    routes = link_ports(*get_ports(), route_filter=connect_strip_way_points)
+    routes_expected = link_ports(*get_ports(), route_filter=route_filter)
+    assert len(routes) == len(routes_expected)
+    for route, route_expected in zip(routes, routes_expected):
+        for port_name, port in route.ports.items():
+            assert np.allclose(
+                port.midpoint, route_expected.ports[port_name].midpoint
+            )
+
+
 def demo_connect_bundle():
     """ combines all the connect_bundle tests """
 
@@ -77,6 +77,7 @@ def connect_bundle_waypoints(
     bend_factory=bend_circular,
     bend_radius=10.0,
     auto_sort=True,
+    obstacles=None,
     **kwargs
 ):
     """
@@ -84,6 +85,10 @@ def connect_bundle_waypoints(
         start_ports: list of ports
         end_ports: list of ports
         way_points: list of points defining a route
+        obstacles: ObstacleIndex, reports the collisions of each route with
+            the obstacles and the previous routes as it is generated, and adds
+            it to the index. The references of the ports are ignored
+            (ObstacleIndex.ignore_port_instances)
 
     """
     if len(end_ports) != len(start_ports):
@@ -158,8 +163,11 @@ def connect_bundle_waypoints(
             taper = taper_factory
     else:
         taper = None
+    route_filter = round_corners
+    if obstacles is not None:
+        route_filter = obstacles.wrap(round_corners, ports=start_ports + end_ports)
     connections = [
-        round_corners(pts, bend90, straight_factory, taper=taper)
+        route_filter(pts, bend90, straight_factory, taper=taper)
         for pts, bend90 in zip(routes, bends90)
     ]
     return connections
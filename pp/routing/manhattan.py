@@ -1,14 +1,22 @@
 import uuid
+import functools
+import hashlib
+import itertools
+import sys
+import weakref
+from collections import OrderedDict
 import numpy as np
 from pp.components import waveguide
 from pp.name import clean_name
 from pp.component import Component, ComponentReference
+from pp.cache import NAME_TO_DEVICE
+from pp.config import conf
 
 import pp
 from pp.geo_utils import angles_deg
 from numpy import bool_, float64, ndarray
-from typing import Callable, Dict, List, Optional, Tuple
-from pp.port import Port
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from pp.port import Port, PortTable
 
 TOLERANCE = 0.0001
 DEG2RAD = np.pi / 180
@@ -402,6 +410,178 @@ def make_ref(component_factory: Callable) -> Callable:
     return _make_ref
 
 
+class Waypoints:
+    """ ragged array with the waypoints of many routes
+
+    the points of route i are `points[offsets[i]:offsets[i + 1]]`
+
+    Args:
+        points: (M, 2) waypoints of all the routes
+        offsets: (N + 1,) index of the first point of each route in points
+    """
+
+    def __init__(self, points: ndarray, offsets: ndarray) -> None:
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_routes(cls, routes: List[ndarray]) -> "Waypoints":
+        """ returns Waypoints from a list of (n, 2) arrays """
+        routes = [np.asarray(route, dtype=float).reshape(-1, 2) for route in routes]
+        offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(route) for route in routes])
+        points = np.concatenate(routes) if routes else np.zeros((0, 2))
+        return cls(points, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> ndarray:
+        if i < 0:
+            i += len(self)
+        return self.points[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self) -> Iterator[ndarray]:
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.points[start:end]
+
+    @property
+    def sizes(self) -> ndarray:
+        """ number of points of each route """
+        return np.diff(self.offsets)
+
+    def to_list(self) -> List[ndarray]:
+        return list(self)
+
+
+class StraightTemplate:
+    """ polygons and ports of a straight, that can be stretched to any length
+
+    The straight is built once with the factory and its polygons are moved so
+    the west port is at (0, 0). A straight of another length is made by moving
+    the points in the east half of the template.
+
+    Args:
+        component: straight with the west port facing West and the east port East
+        straight_ports: (west, east) port names
+    """
+
+    def __init__(
+        self, component: Component, straight_ports: Optional[List[str]] = None
+    ) -> None:
+        if straight_ports is None:
+            straight_ports = [p.name for p in _get_straight_ports(component)]
+        pname_west, pname_east = straight_ports
+        west = component.ports[pname_west]
+        east = component.ports[pname_east]
+        self.length = east.x - west.x
+        self.polygons = [
+            (layer, [np.array(points) - west.midpoint for points in polygons])
+            for layer, polygons in sorted(component.get_polygons(by_spec=True).items())
+        ]
+        self.ports = [west._copy(), east._copy()]
+        self.ports[0].midpoint = (0, 0)
+        self.ports[1].midpoint = (self.length, 0)
+
+    def get_polygons(self, length: float) -> List[Tuple[Tuple[int, int], ndarray]]:
+        """ returns list of (layer, polygons) for a straight of `length` """
+        polygons = []
+        for layer, layer_polygons in self.polygons:
+            stretched = []
+            for points in layer_polygons:
+                points = points.copy()
+                points[points[:, 0] >= self.length / 2, 0] += length - self.length
+                stretched.append(points)
+            polygons.append((layer, stretched))
+        return polygons
+
+    def is_stretchable(self, component: Component) -> bool:
+        """ True if stretching the template gives the polygons of `component` """
+        other = StraightTemplate(component, [p.name for p in self.ports])
+        polygons = self.get_polygons(other.length)
+        if [layer for layer, _ in polygons] != [layer for layer, _ in other.polygons]:
+            return False
+        for (_, a), (_, b) in zip(polygons, other.polygons):
+            if len(a) != len(b):
+                return False
+            if not all(p.shape == q.shape and np.allclose(p, q) for p, q in zip(a, b)):
+                return False
+        return True
+
+    def add_to(
+        self,
+        cell: Component,
+        length: float,
+        origin: ndarray,
+        angle: float,
+        mirror: bool = False,
+    ) -> Dict[str, Port]:
+        """ adds the polygons of a straight of `length` to a cell
+        with the west port at `origin` and rotated by `angle`
+
+        Returns:
+            dict of the (west, east) ports of the straight
+        """
+        c, s = _cos_sin(angle)
+        rotation = np.array([[c, s], [-s, c]])
+        if length > 0:
+            for layer, polygons in self.get_polygons(length):
+                for points in polygons:
+                    if mirror:
+                        points[:, 1] *= -1
+                    cell.add_polygon(points @ rotation + origin, layer=layer)
+
+        ports = {}
+        for port, midpoint in zip(self.ports, [(0, 0), (length, 0)]):
+            port = port._copy()
+            port.midpoint = np.array(midpoint) @ rotation + origin
+            port.orientation = (port.orientation + angle) % 360
+            ports[port.name] = port
+        return ports
+
+
+# LRU cache of straight templates, bounded to _straight_templates_size entries
+_straight_templates = OrderedDict()
+_straight_templates_size = 256
+
+
+def _cos_sin(angle: float) -> Tuple[float, float]:
+    """ returns exact cos and sin for manhattan angles """
+    angle = angle % 360
+    if angle in (0, 90, 180, 270):
+        return {0: (1, 0), 90: (0, 1), 180: (-1, 0), 270: (0, -1)}[angle]
+    return np.cos(angle * DEG2RAD), np.sin(angle * DEG2RAD)
+
+
+def get_straight_template(
+    straight_factory: Callable,
+    width: float,
+    straight_ports: Optional[List[str]] = None,
+    length: float = 7.0,
+) -> Optional[StraightTemplate]:
+    """ returns a cached StraightTemplate for a straight factory and width
+    or None if the straights of the factory can not be stretched
+    (checked against a straight of twice the length)
+
+    `length` is not the default straight length, so the template does not
+    depend on whatever cell is cached under the default name
+    """
+    key = (_get_factory_key(straight_factory), width, str(straight_ports))
+    if key in _straight_templates:
+        _straight_templates.move_to_end(key)
+        return _straight_templates[key]
+
+    template = StraightTemplate(
+        straight_factory(length=length, width=width), straight_ports
+    )
+    if not template.is_stretchable(straight_factory(length=2 * length, width=width)):
+        template = None
+    _straight_templates[key] = template
+    while len(_straight_templates) > _straight_templates_size:
+        _straight_templates.popitem(last=False)
+    return template
+
+
 def remove_flat_angles(points: ndarray) -> ndarray:
     a = angles_deg(np.vstack(points))
     da = a - np.roll(a, 1)
@@ -423,7 +603,134 @@ def remove_flat_angles(points: ndarray) -> ndarray:
     return points
 
 
-@make_ref
+# serial numbers of the factories that their name does not identify
+# (lambdas, closures, methods ...), never reused while the factory exists
+_factory_serials = weakref.WeakKeyDictionary()
+# factories that do not support weak references: LRU bounded to
+# _factory_serials_strong_size entries, keeping a reference to each factory so
+# its id is not reused while it is in the mapping. An evicted factory gets a
+# new serial (a cache miss, never a wrong hit)
+_factory_serials_strong = OrderedDict()
+_factory_serials_strong_size = 256
+_factory_serial_count = itertools.count()
+
+
+def _get_qualified(module: Optional[str], qualname: Optional[str]) -> Any:
+    """ returns the object named module.qualname (None if there is none) """
+    obj = sys.modules.get(module or "")
+    for attribute in (qualname or "").split("."):
+        obj = getattr(obj, attribute, None)
+    return obj
+
+
+def _get_factory_key(factory: Optional[Callable]) -> str:
+    """ returns a string that identifies a component factory
+
+    module-level functions are identified by their name, other callables
+    by their name and a serial number of the object
+    """
+    if isinstance(factory, functools.partial):
+        keywords = sorted(factory.keywords.items())
+        return f"{_get_factory_key(factory.func)}{factory.args}{keywords}"
+    if isinstance(factory, Component):
+        return factory.name
+    if factory is None:
+        return "None"
+    module = getattr(factory, "__module__", None)
+    qualname = getattr(factory, "__qualname__", None)
+    name = f"{module}.{qualname}"
+    if _get_qualified(module, qualname) is factory:
+        return name
+
+    try:
+        serial = _factory_serials.get(factory)
+        if serial is None:
+            serial = _factory_serials[factory] = next(_factory_serial_count)
+    except TypeError:
+        key = id(factory)
+        if key in _factory_serials_strong:
+            _factory_serials_strong.move_to_end(key)
+            serial = _factory_serials_strong[key][1]
+        else:
+            serial = next(_factory_serial_count)
+            _factory_serials_strong[key] = (factory, serial)
+            while len(_factory_serials_strong) > _factory_serials_strong_size:
+                _factory_serials_strong.popitem(last=False)
+    return f"{name}#{serial}"
+
+
+def get_connector_key(
+    points: ndarray,
+    bend90: Component,
+    straight_factory: Callable,
+    taper: Optional[Component] = None,
+    straight_factory_fall_back_no_taper: Optional[Callable] = None,
+    mirror_straight: bool = False,
+    straight_ports: Optional[List[str]] = None,
+    straight_polygons: bool = False,
+    precision: float = TOLERANCE,
+) -> Tuple[str, ndarray, ndarray, int]:
+    """ returns the canonical key of a route
+
+    The route is translated so it starts at (0, 0) and rotated so its first
+    segment points East.
+
+    Returns:
+        key: hash of the canonical waypoints and the factories
+        canonical_points: waypoints relative to the start
+        origin: first waypoint
+        angle: orientation of the first segment (0, 90, 180, 270)
+    """
+    points = np.array(points, dtype=float)
+    origin = points[0]
+    dx, dy = points[1] - origin
+    angle = int(np.round(np.arctan2(dy, dx) * RAD2DEG / 90) * 90) % 360
+    c, s = {0: (1, 0), 90: (0, 1), 180: (-1, 0), 270: (0, -1)}[angle]
+    x, y = (points - origin).T
+    canonical_points = np.round(np.column_stack((c * x + s * y, c * y - s * x)) / precision)
+
+    h = hashlib.sha1(canonical_points.astype(np.int64).tobytes())
+    h.update(
+        _get_factories_key(
+            bend90,
+            straight_factory,
+            taper,
+            straight_factory_fall_back_no_taper,
+            mirror_straight,
+            straight_ports,
+            straight_polygons,
+        )
+    )
+    return h.hexdigest(), canonical_points * precision, origin, angle
+
+
+def _get_factories_key(
+    bend90: Component,
+    straight_factory: Callable,
+    taper: Optional[Component] = None,
+    straight_factory_fall_back_no_taper: Optional[Callable] = None,
+    mirror_straight: bool = False,
+    straight_ports: Optional[List[str]] = None,
+    straight_polygons: bool = False,
+) -> bytes:
+    """ returns the part of the connector key that depends on the factories """
+    factories = (bend90, straight_factory, taper, straight_factory_fall_back_no_taper)
+    key = "".join(_get_factory_key(factory) for factory in factories)
+    key += f"{mirror_straight}{straight_ports}{straight_polygons}"
+    return key.encode()
+
+
+def _get_connector(key: str, canonical_points: ndarray, **kwargs) -> Component:
+    """ returns the connector cell of a route shape (cached by key) """
+    name = f"zz_conn_{key[:16]}"
+    cell = NAME_TO_DEVICE.get(name)
+    if cell is None:
+        cell = _round_corners(canonical_points, **kwargs)
+        cell.name = name
+        NAME_TO_DEVICE[name] = cell
+    return cell
+
+
 def round_corners(
     points,
     bend90,
@@ -432,9 +739,148 @@ def round_corners(
     straight_factory_fall_back_no_taper=None,
     mirror_straight=False,
     straight_ports=None,
+    dedupe=None,
+    straight_polygons=None,
+):
+    """
+    returns a reference to a rounded waveguide route from a list of manhattan points
+
+    Args:
+        points: manhattan route defined by waypoints
+        bend90: the bend to use for 90Deg turns
+        straight_factory: the straight factory to use to generate straight portions
+        taper: taper for straight portions. If None, no tapering
+        straight_factory_fall_back_no_taper: factory to use for straights in case there is no space to put a pair of tapers
+        straight_ports: port names for straights. If not specified, will use some heuristic to find them
+        dedupe: routes with the same shape (relative to their start) and factories
+            share one connector cell, placed with a transformed reference.
+            Defaults to conf.cache.connectors
+        straight_polygons: adds the straight sections as polygons in the
+            connector (stretched from one straight of the factory) instead of
+            referencing one straight component per length, bends are still
+            references. Factories with straights that can not be stretched
+            fall back to references. Defaults to conf.routing.straight_polygons
+    """
+    dedupe = conf.cache.connectors if dedupe is None else dedupe
+    if straight_polygons is None:
+        straight_polygons = conf.routing.straight_polygons
+    kwargs = dict(
+        bend90=bend90,
+        straight_factory=straight_factory,
+        taper=taper,
+        straight_factory_fall_back_no_taper=straight_factory_fall_back_no_taper,
+        mirror_straight=mirror_straight,
+        straight_ports=straight_ports,
+        straight_polygons=straight_polygons,
+    )
+    if not dedupe:
+        return _round_corners(points, **kwargs).ref()
+
+    points = remove_flat_angles(np.array(points, dtype=float))
+    key, canonical_points, origin, angle = get_connector_key(points, **kwargs)
+    cell = _get_connector(key, canonical_points, **kwargs)
+    return ComponentReference(cell, origin=tuple(origin), rotation=angle)
+
+
+def _remove_flat_angles_bundle(waypoints: Waypoints) -> Waypoints:
+    """ returns the waypoints without flat angles (remove_flat_angles)
+    for all the routes at once
+    """
+    points = waypoints.points
+    starts, ends = waypoints.offsets[:-1], waypoints.offsets[1:] - 1
+    if len(points) < 2:
+        return waypoints
+    d = points[1:] - points[:-1]
+    a = np.arctan2(d[:, 1], d[:, 0]) * RAD2DEG
+    # angle change at each point (between the segments before and after it)
+    da = np.ones(len(points))
+    da[1:-1] = np.mod(np.round(a[1:] - a[:-1], 3), 180)
+    da[starts] = 1
+    da[ends] = 1
+    keep = da != 0
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    return Waypoints(points[keep], kept[waypoints.offsets])
+
+
+def round_corners_bundle(
+    waypoints: Union[Waypoints, List[ndarray]],
+    bend90: Component,
+    straight_factory: Callable,
+    taper: Optional[Component] = None,
+    straight_factory_fall_back_no_taper: Optional[Callable] = None,
+    mirror_straight: bool = False,
+    straight_ports: Optional[List[str]] = None,
+    dedupe: Optional[bool] = None,
+    straight_polygons: Optional[bool] = None,
+    precision: float = TOLERANCE,
+) -> Iterator[ComponentReference]:
+    """ yields a reference to a rounded waveguide route for each route
+    of waypoints, same as round_corners for each route
+
+    The flat angles of all the routes are removed, the routes are moved to
+    their canonical frame (start at (0, 0), first segment East) and the
+    factories are hashed at once with numpy. Each connector is built when
+    the first route with its shape is reached, so routes can be checked
+    as they are yielded.
+
+    Args:
+        waypoints: Waypoints (or list of routes)
+        others: see round_corners
+    """
+    dedupe = conf.cache.connectors if dedupe is None else dedupe
+    if straight_polygons is None:
+        straight_polygons = conf.routing.straight_polygons
+    kwargs = dict(
+        bend90=bend90,
+        straight_factory=straight_factory,
+        taper=taper,
+        straight_factory_fall_back_no_taper=straight_factory_fall_back_no_taper,
+        mirror_straight=mirror_straight,
+        straight_ports=straight_ports,
+        straight_polygons=straight_polygons,
+    )
+    if not isinstance(waypoints, Waypoints):
+        waypoints = Waypoints.from_routes(waypoints)
+    if not dedupe:
+        for points in waypoints:
+            yield _round_corners(points, **kwargs).ref()
+        return
+
+    waypoints = _remove_flat_angles_bundle(waypoints)
+    sizes = waypoints.sizes
+    starts = waypoints.offsets[:-1]
+    origins = waypoints.points[starts]
+    d = waypoints.points[starts + 1] - origins
+    angles = np.round(np.arctan2(d[:, 1], d[:, 0]) * RAD2DEG / 90).astype(int)
+    angles = angles * 90 % 360
+    c = np.repeat(np.array([1, 0, -1, 0])[angles // 90], sizes)
+    s = np.repeat(np.array([0, 1, 0, -1])[angles // 90], sizes)
+    x, y = (waypoints.points - np.repeat(origins, sizes, axis=0)).T
+    canonical = Waypoints(
+        np.round(np.column_stack((c * x + s * y, c * y - s * x)) / precision),
+        waypoints.offsets,
+    )
+
+    factories_key = _get_factories_key(**kwargs)
+    for points, origin, angle in zip(canonical, origins, angles):
+        h = hashlib.sha1(points.astype(np.int64).tobytes())
+        h.update(factories_key)
+        cell = _get_connector(h.hexdigest(), points * precision, **kwargs)
+        yield ComponentReference(cell, origin=tuple(origin), rotation=int(angle))
+
+
+def _round_corners(
+    points,
+    bend90,
+    straight_factory,
+    taper=None,
+    straight_factory_fall_back_no_taper=None,
+    mirror_straight=False,
+    straight_ports=None,
+    straight_polygons=False,
 ):
     """
-    returns a rounded waveguide route from a list of manhattan points
+    returns a rounded waveguide route component from a list of manhattan points
     Args:
         points: manhattan route defined by waypoints
         bend90: the bend to use for 90Deg turns
@@ -442,6 +888,7 @@ def round_corners(
         taper: taper for straight portions. If None, no tapering
         straight_factory_fall_back_no_taper: factory to use for straights in case there is no space to put a pair of tapers
         straight_ports: port names for straights. If not specified, will use some heuristic to find them
+        straight_polygons: adds straights as polygons instead of references
     """
     ## If there is a taper, make sure its length is known
     if taper:
@@ -513,7 +960,7 @@ def round_corners(
         (p0_straight, a0, get_straight_distance(p0_straight, points[-1]))
     ]
 
-    wg_refs = []
+    wg_ports = []  # ports of each taper and straight
     for straight_origin, angle, length in straight_sections:
         with_taper = False
         wg_width = list(bend90.ports.values())[0].width
@@ -538,55 +985,65 @@ def round_corners(
             wg_width = taper.ports[pname_east].width
 
             cell.add(taper_ref)
-            wg_refs += [taper_ref]
+            wg_ports += [taper_ref.ports]
 
             # Update start straight position
             straight_origin = taper_ref.ports[pname_east].midpoint
 
         # Straight waveguide
         if with_taper or taper is None:
-            wg = straight_factory(length=length, width=wg_width)
+            factory = straight_factory
         else:
-            wg = straight_factory_fall_back_no_taper(length=length, width=wg_width)
+            factory = straight_factory_fall_back_no_taper
 
-        if straight_ports is None:
-            straight_ports = [p.name for p in _get_straight_ports(wg)]
-        pname_west, pname_east = straight_ports
+        template = None
+        if straight_polygons:
+            template = get_straight_template(factory, wg_width, straight_ports)
+
+        if template is not None:
+            pname_west, pname_east = [p.name for p in template.ports]
+            ports = template.add_to(
+                cell, length, straight_origin, angle, mirror=mirror_straight
+            )
+        else:
+            wg = factory(length=length, width=wg_width)
 
-        wg.move(wg.ports[pname_west], (0, 0))
-        wg_ref = pp.ComponentReference(wg)
-        if mirror_straight:
-            wg_ref.reflect_v(list(wg_ref.ports.values())[0].name)
+            if straight_ports is None:
+                straight_ports = [p.name for p in _get_straight_ports(wg)]
+            pname_west, pname_east = straight_ports
 
-        wg_ref.rotate(angle)
-        wg_ref.move(straight_origin)
-        cell.add(wg_ref)
-        wg_refs += [wg_ref]
+            wg.move(wg.ports[pname_west], (0, 0))
+            wg_ref = pp.ComponentReference(wg)
+            if mirror_straight:
+                wg_ref.reflect_v(list(wg_ref.ports.values())[0].name)
+
+            wg_ref.rotate(angle)
+            wg_ref.move(straight_origin)
+            cell.add(wg_ref)
+            ports = wg_ref.ports
+        wg_ports += [ports]
 
         port_index_out = 1
         if with_taper:
             # Second taper:
             # Origin at end of straight waveguide, starting from east side of taper
 
-            taper_origin = wg_ref.ports[pname_east]
+            taper_origin = ports[pname_east]
             pname_west, pname_east = [p.name for p in _get_straight_ports(taper)]
             taper_ref = taper.ref(
                 position=taper_origin, port_id=pname_east, rotation=angle + 180
             )
 
             cell.add(taper_ref)
-            wg_refs += [taper_ref]
+            wg_ports += [taper_ref.ports]
             port_index_out = 0
 
-    cell.add_port(name="input", port=list(wg_refs[0].ports.values())[0])
-    cell.add_port(name="output", port=list(wg_refs[-1].ports.values())[port_index_out])
+    cell.add_port(name="input", port=list(wg_ports[0].values())[0])
+    cell.add_port(name="output", port=list(wg_ports[-1].values())[port_index_out])
 
     """
-    # Update name with uuid - too expensive to compute geometrical hash every time
+    # Update name with uuid, round_corners(dedupe=True) names connectors by shape
     # Prefix with zz to make connectors appear at end of cell lists
-
-    # The geometrical hash lacks caching right now and ends up taking a
-    # lot of time to compute on every single connector
     """
 
     cell.name = f"zz_conn_{clean_name(str(uuid.uuid4()))[:16]}"
@@ -643,6 +1100,120 @@ def generate_manhattan_waypoints(
     return points
 
 
+def _get_directions(orientations: ndarray) -> ndarray:
+    """ returns (N, 2) unit vectors, exact for manhattan orientations """
+    radians = orientations * DEG2RAD
+    directions = np.column_stack((np.cos(radians), np.sin(radians)))
+    manhattan = orientations % 90 == 0
+    return np.where(manhattan[:, None], np.round(directions), directions)
+
+
+def generate_manhattan_waypoints_bundle(
+    input_ports: List[Port],
+    output_ports: List[Port],
+    bend90: Optional[Component] = None,
+    bend_radius: Optional[float] = None,
+    start_straight: Union[float, ndarray] = 0.01,
+    end_straight: Union[float, ndarray] = 0.01,
+    min_straight: float = 0.01,
+    **kwargs,
+) -> Waypoints:
+    """ returns the waypoints of many routes at once,
+    same as calling generate_manhattan_waypoints for each pair of ports
+
+    routes between facing ports (a straight line or an S-route with two
+    bends) are computed with numpy for all the routes at once, the other
+    routes fall back to generate_manhattan_waypoints
+
+    Args:
+        input_ports: list of N ports
+        output_ports: list of N ports
+        bend90: bend, or bend_radius
+        bend_radius:
+        start_straight: float or array of N floats
+        end_straight: float or array of N floats
+        min_straight:
+        kwargs: passed to generate_manhattan_waypoints
+    """
+    if (bend90 is None) == (bend_radius is None):
+        raise ValueError(
+            f"Either bend90 or bend_radius must be set. Got {bend90} {bend_radius}"
+        )
+    if len(input_ports) != len(output_ports):
+        raise ValueError(
+            f"Got {len(input_ports)} input ports and {len(output_ports)} output ports"
+        )
+
+    n = len(input_ports)
+    if n == 0:
+        return Waypoints(np.zeros((0, 2)), np.zeros(1, dtype=np.int64))
+
+    if bend90 is not None:
+        pname_west, pname_north = [p.name for p in _get_bend_ports(bend90)]
+        bsx, bsy = (
+            bend90.ports[pname_north].midpoint - bend90.ports[pname_west].midpoint
+        )
+    else:
+        bsx = bsy = bend_radius
+
+    inputs = PortTable(input_ports)
+    outputs = PortTable(output_ports)
+    start_straight = np.broadcast_to(np.asarray(start_straight, dtype=float), (n,))
+    end_straight = np.broadcast_to(np.asarray(end_straight, dtype=float), (n,))
+
+    # frame of each output port: t points into the output port, n to its left
+    t = -_get_directions(outputs.orientation)
+    normal = np.column_stack((-t[:, 1], t[:, 0]))
+    delta = inputs.midpoints - outputs.midpoints
+    p0 = np.einsum("ij,ij->i", delta, t)
+    p1 = np.einsum("ij,ij->i", delta, normal)
+
+    facing = (inputs.orientation - outputs.orientation) % 360 == 180
+    aligned = facing & (np.abs(p1) < TOLERANCE) & (p0 <= TOLERANCE)
+    s_route = (
+        facing
+        & ~aligned
+        & (p0 + (bsx + bsy + end_straight + start_straight) < TOLERANCE)
+        & (np.abs(p1) - (bsx + bsy + min_straight) > -TOLERANCE)
+    )
+
+    sizes = np.where(aligned, 2, np.where(s_route, 4, 0))
+    fallback = np.flatnonzero(sizes == 0)
+    routes = {}
+    for i in fallback:
+        routes[i] = generate_manhattan_waypoints(
+            input_ports[i],
+            output_ports[i],
+            bend90=bend90,
+            bend_radius=None if bend90 is not None else bend_radius,
+            start_straight=start_straight[i],
+            end_straight=end_straight[i],
+            min_straight=min_straight,
+            **kwargs,
+        )
+        sizes[i] = len(routes[i])
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    points = np.empty((offsets[-1], 2))
+    start = offsets[:-1]
+
+    points[start] = inputs.midpoints
+    points[offsets[1:] - 1] = outputs.midpoints
+
+    # S-route: input, two corners before the output, output
+    s_start = start[s_route]
+    corner = outputs.midpoints[s_route] - (
+        (end_straight[s_route] + bsy)[:, None] * t[s_route]
+    )
+    points[s_start + 1] = corner + p1[s_route][:, None] * normal[s_route]
+    points[s_start + 2] = corner
+
+    for i, route in routes.items():
+        points[offsets[i] : offsets[i + 1]] = route
+    return Waypoints(points, offsets)
+
+
 def route_manhattan(
     input_port: Port,
     output_port: Port,
@@ -704,6 +1275,168 @@ def test_manhattan():
     return top_cell
 
 
+def test_round_corners_dedupe():
+    from pp.components.bend_circular import bend_circular
+
+    bend90 = bend_circular(radius=5.0)
+    points = np.array([(0, 0), (20, 0), (20, 30), (50, 30)])
+    routes = []
+    for angle, origin in [(0, (0, 0)), (90, (100, 7)), (270, (-3.5, 40))]:
+        c, s = np.cos(angle * DEG2RAD), np.sin(angle * DEG2RAD)
+        rotated = points @ np.array([[c, s], [-s, c]]) + origin
+        ref = round_corners(rotated, bend90, waveguide, dedupe=True)
+        ref_expected = round_corners(rotated, bend90, waveguide, dedupe=False)
+        for port_name in ["input", "output"]:
+            assert np.allclose(
+                ref.ports[port_name].midpoint,
+                ref_expected.ports[port_name].midpoint,
+            )
+            assert np.isclose(
+                ref.ports[port_name].orientation,
+                ref_expected.ports[port_name].orientation,
+            )
+        assert np.allclose(ref.bbox, ref_expected.bbox)
+        routes.append(ref)
+
+    assert len({ref.parent.name for ref in routes}) == 1
+    assert routes[0].parent.name.startswith("zz_conn_")
+    assert routes[0].parent.length == routes[-1].parent.length
+
+
+def test_round_corners_dedupe_closures():
+    from pp.components.bend_circular import bend_circular
+
+    def make_waveguide(layer):
+        return lambda length, width: waveguide(length=length, width=width, layer=layer)
+
+    bend90 = bend_circular(radius=5.0)
+    points = np.array([(0, 0), (20, 0), (20, 30), (50, 30)])
+    for straight_polygons in [False, True]:
+        for layer in [(1, 0), (2, 0)]:
+            ref = round_corners(
+                points,
+                bend90,
+                make_waveguide(layer),
+                dedupe=True,
+                straight_polygons=straight_polygons,
+            )
+            assert layer in ref.parent.get_layers()
+
+    assert _get_factory_key(waveguide) == "pp.components.waveguide.waveguide"
+
+    class Factory:
+        __slots__ = ()  # no weak references
+
+        def __call__(self, **kwargs):
+            return waveguide(**kwargs)
+
+    factory = Factory()
+    assert _get_factory_key(factory) == _get_factory_key(factory)
+    for _ in range(_factory_serials_strong_size + 1):
+        _get_factory_key(Factory())
+    assert len(_factory_serials_strong) == _factory_serials_strong_size
+
+
+def test_round_corners_straight_polygons():
+    from pp.components.bend_circular import bend_circular
+    from pp.components.taper import taper as taper_factory
+
+    bend90 = bend_circular(radius=5.0)
+    taper = taper_factory(length=10.0, width1=0.5, width2=1.0)
+    points = np.array([(0, 0), (40, 0), (40, 30), (45.5, 30), (45.5, 60)])
+    for kwargs in [dict(), dict(taper=taper), dict(mirror_straight=True)]:
+        ref = round_corners(points, bend90, waveguide, straight_polygons=True, **kwargs)
+        ref_expected = round_corners(
+            points, bend90, waveguide, straight_polygons=False, **kwargs
+        )
+        c = ref.parent
+        c_expected = ref_expected.parent
+        assert not any(r.parent.name.startswith("waveguide") for r in c.references)
+        assert len(c.references) < len(c_expected.references)
+        for port_name in ["input", "output"]:
+            assert np.allclose(
+                c.ports[port_name].midpoint, c_expected.ports[port_name].midpoint
+            )
+            assert c.ports[port_name].orientation == (
+                c_expected.ports[port_name].orientation
+            )
+        areas = c.area(by_spec=True)
+        areas_expected = c_expected.area(by_spec=True)
+        assert sorted(areas) == sorted(areas_expected)
+        for layer, area in areas.items():
+            assert np.isclose(area, areas_expected[layer])
+        assert np.allclose(c.bbox, c_expected.bbox)
+        assert c.length == c_expected.length
+
+    for width in range(_straight_templates_size + 1):
+        get_straight_template(waveguide, width=1 + width / 1000)
+    assert len(_straight_templates) == _straight_templates_size
+
+
+def test_generate_manhattan_waypoints_bundle():
+    inputs = [
+        Port("aligned", (0, 0), 0.5, 0),
+        Port("s_route", (0, 50), 0.5, 0),
+        Port("too_close", (90, 0), 0.5, 90),
+        Port("south", (20, 300), 0.5, 270),
+    ]
+    outputs = [
+        Port("o1", (100, 0), 0.5, 180),
+        Port("o2", (100, 0), 0.5, 180),
+        Port("o3", (100, 10), 0.5, 180),
+        Port("o4", (-200, 0), 0.5, 90),
+    ]
+    end_straights = np.array([5.0, 10.0, 0.01, 20.0])
+    waypoints = generate_manhattan_waypoints_bundle(
+        inputs, outputs, bend_radius=10.0, end_straight=end_straights
+    )
+    assert len(waypoints) == len(inputs)
+    assert list(waypoints.sizes[:2]) == [2, 4]
+    for i, (p1, p2) in enumerate(zip(inputs, outputs)):
+        expected = generate_manhattan_waypoints(
+            p1, p2, bend_radius=10.0, end_straight=end_straights[i]
+        )
+        assert np.allclose(waypoints[i], expected)
+
+    routes = Waypoints.from_routes(waypoints.to_list())
+    assert np.array_equal(routes.points, waypoints.points)
+    assert np.array_equal(routes.offsets, waypoints.offsets)
+
+    bend90 = pp.c.bend_circular(radius=10.0)
+    ref = round_corners(waypoints[1], bend90, waveguide)
+    assert np.allclose(ref.ports["output"].midpoint, (100, 0))
+
+
+def test_round_corners_bundle():
+    from pp.components.bend_circular import bend_circular
+
+    bend90 = bend_circular(radius=5.0)
+    routes = [
+        np.array([(0, 0), (20, 0), (20, 30), (50, 30)]),
+        np.array([(100, 0), (100, 20), (100, 40), (70, 40), (70, 80)]),
+        np.array([(0, 100), (-20, 100), (-40, 100), (-40, 70)]),
+        np.array([(7, 7), (7, -30)]),
+        np.array([(0, 0), (20, 0), (20, 30), (50, 30)]) + (300, 300),
+    ]
+    waypoints = _remove_flat_angles_bundle(Waypoints.from_routes(routes))
+    for points, route in zip(waypoints, routes):
+        assert np.array_equal(points, remove_flat_angles(route.astype(float)))
+
+    for dedupe in [True, False]:
+        refs = list(round_corners_bundle(routes, bend90, waveguide, dedupe=dedupe))
+        assert len(refs) == len(routes)
+        for ref, route in zip(refs, routes):
+            ref_expected = round_corners(route, bend90, waveguide, dedupe=dedupe)
+            if dedupe:
+                assert ref.parent is ref_expected.parent
+            for port_name in ["input", "output"]:
+                assert np.allclose(
+                    ref.ports[port_name].midpoint,
+                    ref_expected.ports[port_name].midpoint,
+                )
+        assert (refs[0].parent is refs[4].parent) == dedupe
+
+
 if __name__ == "__main__":
     top_cell = test_manhattan()
     pp.show(top_cell)
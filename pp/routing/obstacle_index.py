@@ -0,0 +1,425 @@
+""" spatial index of obstacles (placed references, polygons and routes)
+to detect route collisions as routes are added
+
+Candidates are found with a quadtree (pyqtree) on bounding boxes, then each
+candidate is checked with a boolean AND of the polygons. Polygons only
+collide with polygons on the same layer. Bounding box obstacles (for example
+the references of a component) have no layer and collide with any polygon.
+"""
+
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+import gdspy
+import numpy as np
+import pyqtree
+from numpy import ndarray
+
+from pp.component import Component, ComponentReference
+from pp.config import logging
+from pp.layers import LAYER
+from pp.port import Port
+
+Bbox = Tuple[float, float, float, float]
+
+# layers that are allowed to overlap (claddings, pins, device recognition ...)
+IGNORE_LAYERS = (
+    LAYER.WGCLAD,
+    LAYER.DEVREC,
+    LAYER.PADDING,
+    LAYER.PORT,
+    LAYER.PORTE,
+    LAYER.PORTH,
+    LAYER.TEXT,
+    LAYER.LABEL,
+)
+
+
+class Obstacle:
+    """ polygon or bounding box in the index
+
+    Args:
+        name: name of the reference or route it belongs to
+        bbox: (xmin, ymin, xmax, ymax)
+        layer: (layer, datatype) or None to collide with all layers
+        points: polygon points, None for the bounding box
+        reference: reference of the bounding box (add_component)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        bbox: Bbox,
+        layer: Optional[Tuple[int, int]] = None,
+        points: Optional[ndarray] = None,
+        reference: Optional[ComponentReference] = None,
+    ) -> None:
+        self.name = name
+        self.bbox = tuple(float(x) for x in bbox)
+        self.layer = layer
+        self.points = points
+        self.reference = reference
+
+    def get_points(self) -> ndarray:
+        if self.points is not None:
+            return self.points
+        xmin, ymin, xmax, ymax = self.bbox
+        return np.array([(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)])
+
+    def __repr__(self) -> str:
+        return f"Obstacle({self.name}, bbox={self.bbox}, layer={self.layer})"
+
+
+class Collision:
+    """ overlap between a route and an obstacle """
+
+    def __init__(self, route: str, obstacle: Obstacle, area: float) -> None:
+        self.route = route
+        self.obstacle = obstacle
+        self.area = area
+
+    def __repr__(self) -> str:
+        return (
+            f"Collision(route {self.route} with {self.obstacle.name} "
+            f"on layer {self.obstacle.layer}, bbox {self.obstacle.bbox}, "
+            f"area {self.area:.3f})"
+        )
+
+
+def _get_bbox(points: ndarray) -> Bbox:
+    xmin, ymin = points.min(axis=0)
+    xmax, ymax = points.max(axis=0)
+    return (xmin, ymin, xmax, ymax)
+
+
+class ObstacleIndex:
+    """ quadtree of obstacles that routers query to report collisions
+    incrementally, as each route is added
+
+    Args:
+        bbox: area where most obstacles are (obstacles outside are also found)
+        raise_on_collision: raises ValueError instead of logging a warning
+        min_area: smaller overlaps (um2) are not collisions (touching routes)
+        precision: for the polygon booleans
+        ignore_layers: route and component polygons on these layers are not checked
+        ignore_port_instances: routers do not check their routes against the
+            references that own the ports they connect
+
+    .. code::
+
+        obstacles = ObstacleIndex.from_component(c)
+        routes = pp.routing.connect_bundle(ports1, ports2, obstacles=obstacles)
+        print(obstacles.collisions)
+
+    """
+
+    def __init__(
+        self,
+        bbox: Bbox = (-1e4, -1e4, 1e4, 1e4),
+        raise_on_collision: bool = False,
+        min_area: float = 1e-6,
+        precision: float = 1e-4,
+        ignore_layers: Iterable[Tuple[int, int]] = IGNORE_LAYERS,
+        ignore_port_instances: bool = True,
+    ) -> None:
+        self.quadtree = pyqtree.Index(bbox=bbox)
+        self.raise_on_collision = raise_on_collision
+        self.min_area = min_area
+        self.precision = precision
+        self.ignore_layers = set(tuple(layer) for layer in ignore_layers)
+        self.ignore_port_instances = ignore_port_instances
+        self.obstacles = []
+        self.collisions = []
+        self.n_routes = 0
+
+    @classmethod
+    def from_component(cls, component: Component, **kwargs) -> "ObstacleIndex":
+        """ returns an index with the references and polygons of a component """
+        xmin, ymin = component.bbox[0] if component.bbox is not None else (0, 0)
+        xmax, ymax = component.bbox[1] if component.bbox is not None else (0, 0)
+        margin = max(xmax - xmin, ymax - ymin, 1.0)
+        kwargs.setdefault(
+            "bbox", (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+        )
+        index = cls(**kwargs)
+        index.add_component(component)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.obstacles)
+
+    def _insert(self, obstacle: Obstacle) -> Obstacle:
+        self.quadtree.insert(obstacle, obstacle.bbox)
+        self.obstacles.append(obstacle)
+        return obstacle
+
+    def add_bbox(
+        self,
+        name: str,
+        bbox: Bbox,
+        layer: Optional[Tuple[int, int]] = None,
+        reference: Optional[ComponentReference] = None,
+    ) -> Obstacle:
+        """ adds a rectangle obstacle (xmin, ymin, xmax, ymax) """
+        return self._insert(Obstacle(name, bbox, layer=layer, reference=reference))
+
+    def add_polygon(
+        self, name: str, points: ndarray, layer: Optional[Tuple[int, int]] = None
+    ) -> Obstacle:
+        """ adds a polygon obstacle """
+        points = np.asarray(points, dtype=float)
+        return self._insert(Obstacle(name, _get_bbox(points), layer, points))
+
+    def add_component(self, component: Component) -> None:
+        """ adds the bounding box of each reference of a component
+        and the polygons of the component itself
+        """
+        for i, reference in enumerate(component.references):
+            bbox = reference.bbox
+            if bbox is not None:
+                name = _get_reference_name(component, reference, i)
+                self.add_bbox(name, bbox.ravel(), reference=reference)
+        for polygonset in component.polygons:
+            for points, layer, datatype in zip(
+                polygonset.polygons, polygonset.layers, polygonset.datatypes
+            ):
+                if (layer, datatype) not in self.ignore_layers:
+                    self.add_polygon(component.name, points, (layer, datatype))
+
+    def query(
+        self, bbox: Bbox, layer: Optional[Tuple[int, int]] = None
+    ) -> List[Obstacle]:
+        """ returns the obstacles whose bounding box intersects bbox
+        on the same layer (or without layer)
+        """
+        return [
+            obstacle
+            for obstacle in self.quadtree.intersect(bbox)
+            if layer is None or obstacle.layer is None or obstacle.layer == layer
+        ]
+
+    def _get_route_polygons(self, route: Any) -> List[Tuple[Tuple[int, int], ndarray]]:
+        return [
+            (layer, points)
+            for layer, points in _get_route_polygons(route)
+            if layer not in self.ignore_layers
+        ]
+
+    def _get_overlap(self, points: ndarray, obstacle: Obstacle) -> float:
+        overlap = gdspy.boolean(
+            [points],
+            [obstacle.get_points()],
+            "and",
+            precision=self.precision,
+        )
+        return overlap.area() if overlap is not None else 0.0
+
+    def check_route(
+        self, route: Any, name: Optional[str] = None, ignore: Iterable[str] = ()
+    ) -> List[Collision]:
+        """ returns the collisions of a route (reference or component)
+        with the obstacles, without adding it
+
+        Args:
+            route: ComponentReference, Component or list of them
+            name: route name for the report
+            ignore: obstacle names or references to ignore (for example
+                the references the route connects)
+        """
+        name = name or f"route_{self.n_routes}"
+        ignore_names = {x for x in ignore if isinstance(x, str)}
+        ignore_ids = {id(x) for x in ignore if x is not None and not isinstance(x, str)}
+        areas = {}  # overlap area of each obstacle with all the route polygons
+        for layer, points in self._get_route_polygons(route):
+            bbox = _get_bbox(points)
+            for obstacle in self.query(bbox, layer):
+                if (
+                    obstacle.name == name
+                    or obstacle.name in ignore_names
+                    or id(obstacle.reference) in ignore_ids
+                ):
+                    continue
+                area = self._get_overlap(points, obstacle)
+                if area > self.min_area:
+                    areas[obstacle] = areas.get(obstacle, 0) + area
+        return [Collision(name, obstacle, area) for obstacle, area in areas.items()]
+
+    def add_route(
+        self,
+        route: Any,
+        name: Optional[str] = None,
+        check: bool = True,
+        ignore: Iterable[str] = (),
+    ) -> List[Collision]:
+        """ checks a route against the obstacles (reporting collisions)
+        and then adds its polygons to the index
+
+        Returns:
+            collisions of the route
+        """
+        name = name or f"route_{self.n_routes}"
+        collisions = self.check_route(route, name=name, ignore=ignore) if check else []
+        self.n_routes += 1
+        self.collisions += collisions
+        for layer, points in self._get_route_polygons(route):
+            self.add_polygon(name, points, layer)
+
+        if collisions:
+            message = "\n".join(str(collision) for collision in collisions)
+            if self.raise_on_collision:
+                raise ValueError(f"route collisions:\n{message}")
+            logging.warning(f"route collisions:\n{message}")
+        return collisions
+
+    def add_routes(
+        self,
+        routes: Iterable[Any],
+        prefix: str = "route",
+        check: bool = True,
+        ignore: Iterable[str] = (),
+    ) -> List[Collision]:
+        """ adds routes one by one, each route is checked against the
+        obstacles and the previous routes
+
+        Returns:
+            collisions of all the routes
+        """
+        collisions = []
+        for route in routes:
+            name = f"{prefix}_{self.n_routes}"
+            collisions += self.add_route(route, name=name, check=check, ignore=ignore)
+        return collisions
+
+    def get_ignored(self, ports: Iterable[Port]) -> List[Any]:
+        """ returns the references that own the ports
+        (none if ignore_port_instances is False)
+        """
+        if not self.ignore_port_instances:
+            return []
+        return [
+            port.parent
+            for port in ports
+            if isinstance(getattr(port, "parent", None), ComponentReference)
+        ]
+
+    def wrap(
+        self,
+        route_function: Callable,
+        ports: Iterable[Port] = (),
+        bundle: bool = False,
+    ) -> Callable:
+        """ returns a function that calls route_function and adds the route
+        it returns to the index, so each route is checked as it is generated
+
+        Args:
+            route_function: returns a route (reference, component or list)
+            ports: ports that the routes connect (see ignore_port_instances)
+            bundle: route_function returns an iterable of routes, each route
+                is added to the index as it is consumed
+        """
+        ignore = self.get_ignored(ports)
+
+        def _route_function(*args, **kwargs):
+            route = route_function(*args, **kwargs)
+            self.add_route(route, ignore=ignore)
+            return route
+
+        def _route_function_bundle(*args, **kwargs):
+            for route in route_function(*args, **kwargs):
+                self.add_route(route, ignore=ignore)
+                yield route
+
+        return _route_function_bundle if bundle else _route_function
+
+
+def _get_reference_name(component: Component, reference: Any, i: int) -> str:
+    for alias, aliased in getattr(component, "aliases", {}).items():
+        if aliased is reference:
+            return alias
+    return f"{reference.parent.name}_{i}"
+
+
+def _get_route_polygons(route: Any) -> List[Tuple[Tuple[int, int], ndarray]]:
+    """ returns list of (layer, points) of a route """
+    if isinstance(route, (ComponentReference, Component)):
+        return [
+            (layer, np.asarray(points))
+            for layer, polygons in route.get_polygons(by_spec=True).items()
+            for points in polygons
+        ]
+    polygons = []
+    for r in route:
+        polygons += _get_route_polygons(r)
+    return polygons
+
+
+def test_obstacle_index():
+    import pp
+
+    c = pp.Component()
+    mmi = c.add_ref(pp.c.mmi1x2(), alias="mmi1x2_0")
+    mmi.movex(100)
+    index = ObstacleIndex.from_component(c)
+    assert len(index) == 1
+
+    route = pp.routing.connect_strip_way_points([(0, 0), (200, 0)], taper_factory=None)
+    collisions = index.add_route(route, name="crossing")
+    assert [collision.obstacle.name for collision in collisions] == ["mmi1x2_0"]
+
+    # parallel route next to the first one, and one on top of it
+    parallel = pp.routing.connect_strip_way_points(
+        [(0, -20), (50, -20)], taper_factory=None
+    )
+    assert index.add_route(parallel, name="parallel") == []
+    overlapping = pp.routing.connect_strip_way_points(
+        [(10, 0), (50, 0)], taper_factory=None
+    )
+    collisions = index.check_route(overlapping, name="overlapping")
+    assert [collision.obstacle.name for collision in collisions] == ["crossing"]
+    assert np.isclose(collisions[0].area, 40 * 0.5)
+    assert index.collisions[0].route == "crossing"
+
+
+def test_obstacle_index_bundle():
+    import pytest
+    import pp
+
+    for ignore_port_instances in [True, False]:
+        c = pp.Component()
+        left = c.add_ref(pp.c.mmi1x2(), alias="left")
+        right = c.add_ref(pp.c.mmi2x2(), alias="right")
+        right.movex(300)
+        block = c.add_ref(pp.c.rectangle(size=(20, 60)), alias="block")
+        block.move((140, -30))
+        index = ObstacleIndex(ignore_port_instances=ignore_port_instances)
+        index.add_component(c)
+        # keep out box around the instance, where the route starts
+        index.add_bbox("left_keepout", (-5, -5, 30, 5), reference=left)
+
+        pp.routing.connect_bundle(
+            [left.ports["E0"]], [right.ports["W0"]], obstacles=index
+        )
+        names = [collision.obstacle.name for collision in index.collisions]
+        if ignore_port_instances:
+            assert names == ["block"]
+        else:
+            assert sorted(names) == ["block", "left_keepout"]
+
+    # each route is checked as it is generated: the first route raises
+    # before the others are generated
+    c = pp.Component()
+    lefts = [c.add_ref(pp.c.mmi1x2()).movey(50 * i) for i in range(3)]
+    rights = [c.add_ref(pp.c.mmi1x2()).move((300, 50 * i - 0.625)) for i in range(3)]
+    c.add_ref(pp.c.rectangle(size=(20, 20))).move((140, -10))
+    index = ObstacleIndex.from_component(c, raise_on_collision=True)
+    with pytest.raises(ValueError):
+        pp.routing.connect_bundle(
+            [r.ports["E0"] for r in lefts],
+            [r.ports["W0"] for r in rights],
+            obstacles=index,
+        )
+    assert index.n_routes == 1
+
+
+if __name__ == "__main__":
+    test_obstacle_index()
+    test_obstacle_index_bundle()
@@ -1,8 +1,16 @@
+""" path length matching of the routes of a bundle
+
+All the routes are processed at once as a (n_routes, n_points, 2) array,
+so the routes need the same number of turns.
+"""
+
+from typing import List, Union
+
 import numpy as np
-from pp.geo_utils import path_length
-from pp.routing.manhattan import remove_flat_angles
-from pp.routing.manhattan import _is_horizontal
-from pp.routing.manhattan import _is_vertical
+from numpy import ndarray
+
+from pp.geo_utils import RAD2DEG
+from pp.routing.manhattan import TOLERANCE, remove_flat_angles
 
 
 def path_length_matched_points(
@@ -45,72 +53,113 @@ def path_length_matched_points(
         return path_length_matched_points_modify_segment(**common_params)
 
 
-def path_length_matched_points_modify_segment(list_of_waypoints, modify_segment_i, dL0):
-    if type(list_of_waypoints) != list:
+def stack_waypoints(list_of_waypoints: Union[List, ndarray]) -> ndarray:
+    """ returns (n_routes, n_points, 2) array with the waypoints of all the routes
+    without flat angles
+
+    raises ValueError if the routes do not have the same number of turns
+    """
+    if not isinstance(list_of_waypoints, (list, ndarray)):
         raise ValueError(
             "list_of_waypoints should be a list, got {}".format(type(list_of_waypoints))
         )
-    list_of_waypoints = [
-        remove_flat_angles(waypoints) for waypoints in list_of_waypoints
-    ]
-    lengths = [path_length(waypoints) for waypoints in list_of_waypoints]
-    L0 = max(lengths)
 
-    N = len(list_of_waypoints[0])
+    try:
+        points = np.array(list_of_waypoints, dtype=float)
+    except ValueError:  # routes with different number of points
+        points = None
+
+    if points is not None and points.ndim == 3:
+        # same as remove_flat_angles for all the routes at once
+        d = np.roll(points, -1, axis=1) - points
+        a = np.arctan2(d[:, :, 1], d[:, :, 0]) * RAD2DEG
+        da = a - np.roll(a, 1, axis=1)
+        da = np.mod(np.round(da, 3), 180)
+        da[:, 0] = 1
+        da[:, -1] = 1
+        keep = da != 0
+        nb_points = keep.sum(axis=1)
+        if nb_points.min() == nb_points.max():
+            return points[keep].reshape(len(points), nb_points[0], 2)
+        nb_turns = nb_points - 2
 
-    # Find how many turns there are per path
-    nb_turns = [len(waypoints) - 2 for waypoints in list_of_waypoints]
+    else:
+        list_of_waypoints = [
+            remove_flat_angles(np.array(waypoints, dtype=float))
+            for waypoints in list_of_waypoints
+        ]
+        nb_turns = [len(waypoints) - 2 for waypoints in list_of_waypoints]
+        if min(nb_turns) == max(nb_turns):
+            return np.stack(list_of_waypoints)
 
     # The paths have to have the same number of turns, otherwise this algo
     # cannot path length match
-    if min(nb_turns) != max(nb_turns):
-        raise ValueError(
-            "Number of turns in paths have to be identical got \
-        {}".format(
-                nb_turns
-            )
-        )
+    raise ValueError(
+        "Number of turns in paths have to be identical got {}".format(list(nb_turns))
+    )
 
-    if modify_segment_i < 0:
-        modify_segment_i = modify_segment_i + N + 1
 
-    list_new_waypoints = []
+def get_path_lengths(points: ndarray) -> ndarray:
+    """ returns the length of each route of a (n_routes, n_points, 2) array """
+    d = points[:, 1:] - points[:, :-1]
+    d = d ** 2
+    return np.sum(np.sqrt(d[:, :, 0] + d[:, :, 1]), axis=1)
+
 
-    # For each list of waypoints, modify one segment in-place
-    for i, waypoints in enumerate(list_of_waypoints):
-        p_s0, p_s1, p_next = waypoints[modify_segment_i - 1 : modify_segment_i + 2]
+def _check_segment_index(first: int, last: int, nb_points: int) -> None:
+    if first < 0 or last >= nb_points:
+        raise ValueError(
+            f"modify_segment_i needs points {first} to {last}, "
+            f"routes have {nb_points} points"
+        )
 
-        p_s0 = np.array(p_s0)
-        p_s1 = np.array(p_s1)
 
-        L = lengths[i]
+def _get_segment_directions(p0: ndarray, p1: ndarray):
+    """ returns vertical and horizontal masks for the segments p0 -> p1 """
+    is_vertical = np.abs(p0[:, 0] - p1[:, 0]) < TOLERANCE
+    is_horizontal = np.abs(p0[:, 1] - p1[:, 1]) < TOLERANCE
+    if not np.all(is_vertical | is_horizontal):
+        raise ValueError(
+            "The segment to modify is not manhattan for routes "
+            f"{list(np.where(~(is_vertical | is_horizontal))[0])}"
+        )
+    return is_vertical, is_horizontal
 
-        # Path length compensation length
-        dL = (L0 - L) / 2
 
-        # Additional fixed length
-        dL = dL + dL0
+def path_length_matched_points_modify_segment(
+    list_of_waypoints, modify_segment_i, dL0
+) -> List[ndarray]:
+    points = stack_waypoints(list_of_waypoints)
+    lengths = get_path_lengths(points)
+    L0 = max(lengths)
 
-        # Modify the segment to accomodate for path length matching
-        # Two cases: vertical or horizontal segment
-        if _is_vertical(p_s0, p_s1):
-            sx = np.sign(p_next[0] - p_s1[0])
+    N = points.shape[1]
+    if modify_segment_i < 0:
+        modify_segment_i = modify_segment_i + N + 1
+    _check_segment_index(modify_segment_i - 1, modify_segment_i + 1, N)
 
-            dx = -sx * dL
-            dp = (dx, 0)
-            # Sequence of displacements to apply
+    p_s0 = points[:, modify_segment_i - 1]
+    p_s1 = points[:, modify_segment_i]
+    p_next = points[:, modify_segment_i + 1]
+    is_vertical, _ = _get_segment_directions(p_s0, p_s1)
 
-        elif _is_horizontal(p_s0, p_s1):
-            sy = np.sign(p_next[1] - p_s1[1])
+    # Path length compensation length
+    dL = (L0 - lengths) / 2
 
-            dy = -sy * dL
-            dp = (0, dy)
+    # Additional fixed length
+    dL = dL + dL0
 
-        waypoints[modify_segment_i - 1] = p_s0 + dp
-        waypoints[modify_segment_i] = p_s1 + dp
+    # Move the segment to accomodate for path length matching
+    # Two cases: vertical segments move along x, horizontal along y
+    sx = np.sign(p_next[:, 0] - p_s1[:, 0])
+    sy = np.sign(p_next[:, 1] - p_s1[:, 1])
+    dp = np.zeros((len(points), 2))
+    dp[:, 0] = np.where(is_vertical, -sx * dL, 0)
+    dp[:, 1] = np.where(is_vertical, 0, -sy * dL)
 
-        list_new_waypoints += [waypoints]
-    return list_new_waypoints
+    points[:, modify_segment_i - 1] = p_s0 + dp
+    points[:, modify_segment_i] = p_s1 + dp
+    return list(points)
 
 
 def path_length_matched_points_add_waypoints(
@@ -124,7 +173,7 @@ def path_length_matched_points_add_waypoints(
 
     """
     Args:
-        list_of_waypoints: a list of list_of_points:
+        list_of_waypoints: a list of list_of_points (or an array of them):
             [[p1, p2, p3,...], [q1, q2, q3,...], ...]
             - the number of turns have to be identical
                 (usually means same number of points. exception is if there are
@@ -155,32 +204,10 @@ def path_length_matched_points_add_waypoints(
 
     """
 
-    print(list_of_waypoints[0])
-
-    if type(list_of_waypoints) != list:
-        raise ValueError(
-            "list_of_waypoints should be a list, got {}".format(type(list_of_waypoints))
-        )
-    list_of_waypoints = [
-        remove_flat_angles(waypoints) for waypoints in list_of_waypoints
-    ]
-    lengths = [path_length(waypoints) for waypoints in list_of_waypoints]
+    points = stack_waypoints(list_of_waypoints)
+    lengths = get_path_lengths(points)
     L0 = max(lengths)
-
-    N = len(list_of_waypoints[0])
-
-    # Find how many turns there are per path
-    nb_turns = [len(waypoints) - 2 for waypoints in list_of_waypoints]
-
-    # The paths have to have the same number of turns, otherwise cannot path-length
-    # match with this algorithm
-    if min(nb_turns) != max(nb_turns):
-        raise ValueError(
-            "Number of turns in paths have to be identical got \
-        {}".format(
-                nb_turns
-            )
-        )
+    N = points.shape[1]
 
     # To have flexibility in the path length, we need to add 4 bends
     """
@@ -197,70 +224,78 @@ def path_length_matched_points_add_waypoints(
     a = margin + bend_radius
     if modify_segment_i < 0:
         modify_segment_i = modify_segment_i + N + 1
-    list_new_waypoints = []
-
-    for i, waypoints in enumerate(list_of_waypoints):
-        p_s0, p_s1, p_next = waypoints[modify_segment_i - 2 : modify_segment_i + 1]
-
-        p_s1 = np.array(p_s1)
-
-        L = lengths[i]
-
-        # Path length compensation length
-        dL = (L0 - L) / (2 * nb_loops)
-
-        # Additional fixed length
-        dL = dL + dL0
-
-        # Generate a new sequence of points which will replace this segment
-        # Two cases: vertical or horizontal segment
-        if _is_vertical(p_s0, p_s1):
-            sx = np.sign(p_next[0] - p_s1[0])
-            sy = np.sign(p_s1[1] - p_s0[1])
-
-            dx = sx * (2 * a + dL)
-            dy = sy * 2 * a
-
-            # First new point to insert
-            q0 = p_s1 + (0, -2 * nb_loops * dy)
-
-            # Sequence of displacements to apply
-            seq = [(dx, 0), (0, dy), (-dx, 0), (0, dy)] * nb_loops
-            seq.pop()  # Remove last point to avoid flat angle with next point
-
-        elif _is_horizontal(p_s0, p_s1):
-            sy = np.sign(p_next[1] - p_s1[1])
-            sx = np.sign(p_s1[0] - p_s0[0])
-
-            dx = sx * 2 * a
-            dy = sy * (2 * a + dL)
-
-            q0 = p_s1 + (-2 * dx * nb_loops, 0)
-            # Sequence of displacements to apply
-            seq = [(0, dy), (dx, 0), (0, -dy), (dx, 0)] * nb_loops
-            seq.pop()  # Remove last point to avoid flat angle with next point
-
-        # Generate points to insert
-        qs = [q0]
-        for dp in seq:
-            qs += [qs[-1] + dp]
-
-        # print()
-        # print(nb_loops)
-        # for q in qs:
-        # print(q)
-        # print()
-        inserted_points = np.stack(qs, axis=0)
-        waypoints = np.array(waypoints)
+    _check_segment_index(modify_segment_i - 2, modify_segment_i, N)
+
+    p_s0 = points[:, modify_segment_i - 2]
+    p_s1 = points[:, modify_segment_i - 1]
+    p_next = points[:, modify_segment_i]
+    is_vertical, _ = _get_segment_directions(p_s0, p_s1)
+
+    # Path length compensation length
+    dL = (L0 - lengths) / (2 * nb_loops)
+
+    # Additional fixed length
+    dL = dL + dL0
+
+    # Generate a new sequence of points which will replace this segment
+    # Two cases: vertical or horizontal segment
+    sx_vertical = np.sign(p_next[:, 0] - p_s1[:, 0])
+    sy_vertical = np.sign(p_s1[:, 1] - p_s0[:, 1])
+    sy_horizontal = np.sign(p_next[:, 1] - p_s1[:, 1])
+    sx_horizontal = np.sign(p_s1[:, 0] - p_s0[:, 0])
+
+    dx = np.where(is_vertical, sx_vertical * (2 * a + dL), sx_horizontal * 2 * a)
+    dy = np.where(is_vertical, sy_vertical * 2 * a, sy_horizontal * (2 * a + dL))
+    zero = np.zeros(len(points))
+
+    # First new point to insert
+    q0 = np.stack(
+        [
+            p_s1[:, 0] + np.where(is_vertical, zero, -2 * dx * nb_loops),
+            p_s1[:, 1] + np.where(is_vertical, -2 * nb_loops * dy, zero),
+        ],
+        axis=1,
+    )
+
+    # Sequence of displacements to apply (one loop)
+    # vertical: (dx, 0), (0, dy), (-dx, 0), (0, dy)
+    # horizontal: (0, dy), (dx, 0), (0, -dy), (dx, 0)
+    loop_x = np.where(is_vertical, [dx, zero, -dx, zero], [zero, dx, zero, dx])
+    loop_y = np.where(is_vertical, [zero, dy, zero, dy], [dy, zero, -dy, zero])
+    seq = np.stack([loop_x.T, loop_y.T], axis=2)
+    seq = np.tile(seq, (1, nb_loops, 1))[:, :-1]  # last point is a flat angle
+
+    # Generate points to insert
+    inserted_points = np.cumsum(np.concatenate([q0[:, None], seq], axis=1), axis=1)
+
+    # Insert the points
+    new_points = np.concatenate(
+        [
+            points[:, : modify_segment_i - 1],
+            inserted_points,
+            points[:, modify_segment_i - 1 :],
+        ],
+        axis=1,
+    )
+    return list(new_points)
+
+
+def test_path_length_matched_points():
+    # bundle of 8 S-routes going up, with different lengths
+    list_of_waypoints = [
+        [(10.0 * i, 0), (10.0 * i, 100 + 5 * i), (200 + 30 * i, 100 + 5 * i)]
+        + [(200 + 30 * i, 300)]
+        for i in range(8)
+    ]
+    # a flat angle is removed
+    list_of_waypoints[3].insert(1, (30.0, 50.0))
 
-        # Insert the points
-        new_points = np.vstack(
-            [
-                waypoints[: modify_segment_i - 1],
-                inserted_points,
-                waypoints[modify_segment_i - 1 :],
-            ]
+    for nb_loops in [1, 2]:
+        routes = path_length_matched_points(
+            list_of_waypoints, nb_loops=nb_loops, dL0=1.0
         )
-        list_new_waypoints += [new_points]
-
-    return list_new_waypoints
+        lengths = get_path_lengths(np.stack(routes))
+        assert np.allclose(lengths, lengths[0])
+        assert all(len(route) == 4 + 4 * nb_loops for route in routes)
+        assert np.allclose(routes[0][0], (0, 0))
+        assert np.allclose(routes[-1][-1], (410, 300))
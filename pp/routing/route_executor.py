@@ -0,0 +1,83 @@
+""" route independent bundles on a process pool
+
+Each bundle (list of input ports, list of output ports) is routed by a forked
+worker (pp.executor.fork_map), so the ports and the routing function do not
+need to be pickled. The routes come back in the order of the bundles, so the
+result does not depend on which worker finishes first. Cells with the same
+name are merged into one cell (a layout can only have one cell per name),
+reusing the cells already in memory (pp.cache.NAME_TO_DEVICE).
+"""
+
+from typing import Any, Callable, List, Optional, Tuple
+
+from pp.cache import get_dependencies
+from pp.component import ComponentReference
+from pp.executor import fork_map, share_cells
+from pp.port import Port
+from pp.routing.connect_bundle import link_optical_ports
+
+Bundle = Tuple[List[Port], List[Port]]
+
+
+def _as_list(routes: Any) -> List[ComponentReference]:
+    return list(routes) if isinstance(routes, (list, tuple)) else [routes]
+
+
+def route_bundles(
+    bundles: List[Bundle],
+    routing_func: Callable = link_optical_ports,
+    processes: Optional[int] = None,
+    **kwargs,
+) -> List[List[ComponentReference]]:
+    """ returns the routes of independent bundles, routed on a process pool
+
+    Workers are forked, when forking is not possible (or processes=1)
+    bundles are routed in this process.
+
+    Args:
+        bundles: list of (ports1, ports2)
+        routing_func: function(ports1, ports2, **kwargs) that returns
+            a route reference or a list of route references
+        processes: number of worker processes (defaults to the number of CPUs)
+        kwargs: for routing_func
+
+    Returns:
+        list of routes (list of references) for each bundle, in the same order
+    """
+    results = fork_map(routing_func, bundles, processes=processes, **kwargs)
+    if processes == 1 or len(bundles) <= 1:
+        return [_as_list(routes) for routes in results]
+
+    # routes from different workers
+    cells = {}
+    return [share_cells(_as_list(routes), cells) for routes in results]
+
+
+def test_route_bundles():
+    import numpy as np
+
+    bundles = []
+    for i in range(3):
+        y = 200 * i
+        ports1 = [Port(f"w{i}_{j}", (0, y + 5 * j), 0.5, 0) for j in range(4)]
+        ports2 = [Port(f"e{i}_{j}", (200, y + 50 + 10 * j), 0.5, 180) for j in range(4)]
+        bundles.append((ports1, ports2))
+
+    serial = route_bundles(bundles, processes=1)
+    parallel = route_bundles(bundles, processes=2)
+    assert len(parallel) == len(serial)
+    for routes1, routes2 in zip(serial, parallel):
+        assert len(routes1) == len(routes2)
+        for r1, r2 in zip(routes1, routes2):
+            assert np.allclose(r1.bbox, r2.bbox)
+
+    # cells with the same name are one cell, shared with the cells in memory
+    cells = {}
+    for routes in serial + parallel:
+        for route in routes:
+            for cell in get_dependencies(route.parent):
+                assert cells.setdefault(cell.name, cell) is cell
+
+
+if __name__ == "__main__":
+    test_route_bundles()
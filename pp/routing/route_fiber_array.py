@@ -10,6 +10,7 @@ from pp.components.grating_coupler.elliptical_trenches import grating_coupler_te
 from pp.routing.manhattan import round_corners
 from pp.routing.connect_bundle import link_optical_ports
 from pp.routing.connect_bundle import get_min_spacing
+from pp.routing.route_executor import route_bundles
 from pp.routing.route_south import route_south
 
 from pp.routing.utils import direction_ports_from_list_ports
@@ -51,6 +52,7 @@ def route_fiber_array(
     route_factory: Callable = route_south,
     get_input_labels_function: Callable = get_input_labels,
     select_ports: Callable = select_optical_ports,
+    processes: int = 1,
 ) -> Tuple[
     List[Union[ComponentReference, Label]], List[List[ComponentReference]], float64
 ]:
@@ -92,6 +94,8 @@ def route_fiber_array(
         route_factory: factories for route
         get_input_labels_function: functions to add labels
         select_ports: function to select ports
+        processes: with several lines of gratings, route each line on a process pool
+            (1 routes them in this process, None uses all the CPUs)
 
     Returns:
         elements, io_grating_lines, y0_optical
@@ -351,21 +355,24 @@ def route_fiber_array(
             )
 
         else:
+            # each line takes the ports in the middle of the ports left to route
+            bundles = []
             for io_gratings in io_gratings_lines:
                 gc_ports = [gc.ports[gc_port_name] for gc in io_gratings]
-                nb_gc_ports = len(io_gratings)
-                nb_ports_to_route = len(to_route)
-                n0 = nb_ports_to_route / 2
-                dn = nb_gc_ports / 2
-                elements += link_optical_ports(
-                    to_route[n0 - dn : n0 + dn],
-                    gc_ports,
-                    separation=sep,
-                    end_straight_offset=end_straight_offset,
-                    route_filter=route_filter,
-                    **route_filter_params,
-                )
-                del to_route[n0 - dn : n0 + dn]
+                n0 = len(to_route) // 2 - len(gc_ports) // 2
+                bundles.append((to_route[n0 : n0 + len(gc_ports)], gc_ports))
+                del to_route[n0 : n0 + len(gc_ports)]
+
+            for routes in route_bundles(
+                bundles,
+                routing_func=link_optical_ports,
+                processes=processes,
+                separation=sep,
+                end_straight_offset=end_straight_offset,
+                route_filter=route_filter,
+                **route_filter_params,
+            ):
+                elements += routes
 
     if with_align_ports:
         """
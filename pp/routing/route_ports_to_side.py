@@ -15,7 +15,7 @@ def route_elec_ports_to_side(ports, side="north", wire_sep=20.0, x=None, y=None)
 
 
 def route_ports_to_side(
-    ports, side="north", x=None, y=None, routing_func=None, **kwargs
+    ports, side="north", x=None, y=None, routing_func=None, obstacles=None, **kwargs
 ):
     """ Routes ports to a given side
 
@@ -34,6 +34,11 @@ def route_ports_to_side(
         routing_func: the routing function. By default uses either `connect_elec`
         or `connect_strip` depending on the ports layer.
 
+        obstacles: ObstacleIndex, reports the collisions of each route with
+            the obstacles and the previous routes as it is generated, and adds
+            it to the index. The references of the ports are ignored
+            (ObstacleIndex.ignore_port_instances)
+
         kwargs: may include:
             `bend_radius`
             `extend_bottom`, `extend_top` for east/west routing
@@ -73,7 +78,11 @@ def route_ports_to_side(
 
         func_route = connect_ports_to_x
 
-    return func_route(ports, xy, routing_func=routing_func, **kwargs)
+    if obstacles is not None:
+        routing_func = obstacles.wrap(routing_func, ports=ports)
+
+    routes, ports = func_route(ports, xy, routing_func=routing_func, **kwargs)
+    return routes, ports
 
 
 def route_ports_to_north(list_ports, **kwargs):
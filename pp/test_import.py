@@ -0,0 +1,61 @@
+""" `import pp` startup: heavy submodules are only imported when used
+
+    python pp/test_import.py
+
+prints the median time of `import pp` and of the first use of pp.c,
+each measured in a new python process
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+import pp
+
+LAZY_MODULES = ["pp.components", "pp.routing", "pp.sp", "pp.klive", "git"]
+
+
+def run_python(code: str) -> str:
+    """ returns the stdout of python -c code, with pp importable """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(pp.CONFIG["repo_path"])] + env.get("PYTHONPATH", "").split(os.pathsep)
+    )
+    return subprocess.check_output([sys.executable, "-c", code], env=env).decode()
+
+
+def get_import_time(attribute: str = "", repeat: int = 5) -> float:
+    """ returns the median seconds of `import pp` (then of pp.attribute) """
+    code = (
+        "import time\n"
+        "t = time.perf_counter()\n"
+        "import pp\n"
+        f"{'pp.' + attribute if attribute else ''}\n"
+        "print(time.perf_counter() - t)\n"
+    )
+    return statistics.median(float(run_python(code)) for _ in range(repeat))
+
+
+def test_import_lazy():
+    code = (
+        "import sys\n"
+        "import pp\n"
+        f"print([m for m in {LAZY_MODULES} if m in sys.modules])\n"
+        "print(pp.c.waveguide.__name__, pp.routing.__name__, pp.sp.__name__)\n"
+        "git_hash = pp.conf.git_hash\n"
+        "print('git' in sys.modules, git_hash == pp.conf['git_hash'])\n"
+        "print('c' in dir(pp), all(hasattr(pp, name) for name in pp.__all__))\n"
+    )
+    lines = run_python(code).splitlines()
+    assert lines == [
+        "[]",
+        "waveguide pp.routing pp.sp",
+        "True True",
+        "True True",
+    ]
+
+
+if __name__ == "__main__":
+    print(f"import pp: {get_import_time():.3f}s")
+    print(f"import pp + pp.c: {get_import_time('c'):.3f}s")
@@ -1,5 +1,8 @@
+import hashlib
+import numpy as np
 import gdspy
-from pp.compare_cells import hash_cells
+from pp.compare_cells import hash_cells, hash_polygons, magic_offset
+from pp.compare_cells import get_polygons_by_spec, normalize_polygon_start_point
 from pp.components.mzi2x2 import mzi2x2
 import pp
 
@@ -45,5 +48,44 @@ def test_hash():
     assert h1 != h2
 
 
+def test_hash_polygons():
+    """ vectorized polygon hashing matches hashing each polygon """
+    precision = 1e-4
+    c = pp.c.mzi2x2()
+    for cell in [c] + list(c.get_dependencies(True)):
+        for polygons in get_polygons_by_spec(cell).values():
+            hashes = [
+                hashlib.sha1(
+                    normalize_polygon_start_point(
+                        ((p / precision) + magic_offset).astype(np.int64)
+                    )
+                ).hexdigest()
+                for p in polygons
+            ]
+            assert hash_polygons(polygons, precision) == sorted(hashes)
+
+
+def test_hash_cache():
+    c = pp.Component()
+    ref = c << pp.c.waveguide(length=10)
+    h0 = c.hash_geometry()
+    assert c.hash_geometry() == h0
+
+    ref.movex(1)
+    h1 = c.hash_geometry()
+    assert h1 != h0
+
+    c.add_polygon([(0, 0), (1, 0), (1, 1)])
+    assert c.hash_geometry() != h1
+
+    h2 = c.hash_geometry()
+    c.remap_layers({(1, 0): (2, 0)})
+    h3 = c.hash_geometry()
+    assert h3 != h2
+
+    c.polygons[0].layers = [3]
+    assert c.hash_geometry() != h3
+
+
 if __name__ == "__main__":
     debug()
@@ -3,25 +3,32 @@ write_component_type: try to load a component from library or creates if it does
 write_component: write component and metadata
 """
 
+import datetime
+import hashlib
+import io
+import multiprocessing
+import os
 import pathlib
 import json
+import time
+import weakref
 from pathlib import PosixPath
-from typing import Optional
+from typing import Dict, Iterator, List, Optional
+import gdspy
 from phidl import device_layout as pd
 
+from pp.build_profile import record_output
 from pp.config import CONFIG, conf
 from pp.name import get_component_name
-from pp.components import component_type2factory
-from pp import klive
 from pp.component import Component
 
 from pp.layers import LAYER
 
 
-def get_component_type(
-    component_type, component_type2factory=component_type2factory, **kwargs
-):
-    """ returns a component from the factory """
+def get_component_type(component_type, component_type2factory=None, **kwargs):
+    """ returns a component from the factory (pp.components by default) """
+    if component_type2factory is None:
+        from pp.components import component_type2factory
     component_name = get_component_name(component_type, **kwargs)
     return component_type2factory[component_type](name=component_name, **kwargs)
 
@@ -30,7 +37,7 @@ def write_component_type(
     component_type,
     overwrite=False,
     path_directory=CONFIG["gds_directory"],
-    component_type2factory=component_type2factory,
+    component_type2factory=None,
     **kwargs,
 ):
     """ write_component by type or function
@@ -39,9 +46,11 @@ def write_component_type(
         component_type: can be function or factory name
         overwrite:
         path_directory: to store GDS + metadata
-        component_type2factory: factory dictionary
+        component_type2factory: factory dictionary (pp.components by default)
         **kwargs: component args
     """
+    if component_type2factory is None:
+        from pp.components import component_type2factory
     if callable(component_type):
         component_type = component_type.__name__
 
@@ -153,6 +162,113 @@ def write_component(
     return gdspath
 
 
+# components written by write_components workers (inherited when forking)
+_components_to_write = []
+
+
+def _write_component_files(
+    index: int, gdspath: str, precision: float
+) -> Dict[str, float]:
+    """ writes GDS, .ports and .json of a component through temporary files
+    that are renamed together once all of them are written, so readers never
+    see partial files or a GDS next to the .json of a previous build
+
+    Returns:
+        time to write each file {path: seconds}
+    """
+    component = _components_to_write[index]
+    gdspath = pathlib.Path(gdspath)
+    tmp_stem = f".{gdspath.stem}.{os.getpid()}.tmp"
+    tmp_gdspath = gdspath.with_name(tmp_stem + ".gds")
+    tmp_json_path = gdspath.with_name(tmp_stem + ".json")
+    tmp_ports_path = gdspath.with_name(tmp_stem + ".ports")
+
+    timings = {}
+    try:
+        t0 = time.time()
+        component.write_gds(str(tmp_gdspath), precision=precision, auto_rename=False)
+        t1 = time.time()
+        write_component_report(component, json_path=str(tmp_json_path))
+        t2 = time.time()
+
+        if tmp_ports_path.exists():
+            os.replace(tmp_ports_path, gdspath.with_suffix(".ports"))
+        os.replace(tmp_json_path, gdspath.with_suffix(".json"))
+        os.replace(tmp_gdspath, gdspath)
+        record_output(gdspath)
+        timings[str(gdspath)] = t1 - t0
+        timings[str(gdspath.with_suffix(".json"))] = t2 - t1
+    finally:
+        for tmp_path in [tmp_gdspath, tmp_json_path, tmp_ports_path]:
+            if tmp_path.exists():
+                tmp_path.unlink()
+    return timings
+
+
+def write_components(
+    components: List[Component],
+    dirpath: Optional[PosixPath] = None,
+    gdspaths: Optional[List[PosixPath]] = None,
+    precision: float = 1e-9,
+    with_settings_label: bool = conf.tech.with_settings_label,
+    processes: Optional[int] = None,
+) -> Dict[str, float]:
+    """ writes GDS, .ports and .json for a list of components on a process pool
+
+    Each file is written into a temporary file and renamed when complete.
+    Components sharing sub-cells are fine: every GDS includes all its dependencies.
+    Workers are forked so components do not need to be pickled,
+    when forking is not possible (or processes=1) files are written in this process.
+
+    Args:
+        components: list of components
+        dirpath: directory for the files (defaults to CONFIG['gds_directory'])
+        gdspaths: optional GDS path for each component (defaults to dirpath/name.gds)
+        precision: to save GDS points
+        with_settings_label: add settings labels to the components before
+            writing (the components are modified, like in write_gds)
+        processes: number of worker processes (defaults to the number of CPUs).
+            Daemonic processes (such as the generate_does workers) can not
+            start a pool, so they write the files sequentially
+
+    Returns:
+        time spent writing each file {path: seconds}
+    """
+    global _components_to_write
+
+    dirpath = pathlib.Path(dirpath or CONFIG["gds_directory"])
+    dirpath.mkdir(parents=True, exist_ok=True)
+    gdspaths = gdspaths or [dirpath / f"{c.name}.gds" for c in components]
+    gdspaths = [str(gdspath) for gdspath in gdspaths]
+
+    for component, gdspath in zip(components, gdspaths):
+        if with_settings_label:
+            add_settings_label(component)
+        component.path = gdspath
+
+    processes = processes or os.cpu_count() or 1
+    processes = min(processes, len(components))
+    can_fork = "fork" in multiprocessing.get_all_start_methods()
+    is_daemon = multiprocessing.current_process().daemon
+    args = [(i, gdspath, precision) for i, gdspath in enumerate(gdspaths)]
+
+    _components_to_write = list(components)
+    timings = {}
+    try:
+        if processes > 1 and can_fork and not is_daemon:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(processes) as pool:
+                results = pool.starmap(_write_component_files, args)
+        else:
+            results = [_write_component_files(*arg) for arg in args]
+    finally:
+        _components_to_write = []
+
+    for result in results:
+        timings.update(result)
+    return timings
+
+
 def write_json(json_path, **settings):
     """ write properties dict into a json_path file"""
 
@@ -168,6 +284,7 @@ def write_gds(
     remove_previous_markers: bool = False,
     auto_rename: bool = False,
     with_settings_label: bool = conf.tech.with_settings_label,
+    streaming: bool = False,
 ) -> str:
     """ write component to GDS and returs gdspath
 
@@ -177,10 +294,13 @@ def write_gds(
         auto_rename: False by default (otherwise it calls it top_cell)
         unit
         precission
+        streaming: writes cells bottom-up with GdsStreamWriter (does not support auto_rename)
 
     Returns:
         gdspath
     """
+    if streaming and auto_rename:
+        raise ValueError("write_gds(streaming=True) does not support auto_rename")
 
     gdspath = gdspath or CONFIG["gds_directory"] / (component.name + ".gds")
     gdspath = pathlib.Path(gdspath)
@@ -196,27 +316,135 @@ def write_gds(
         component.remove_layers([port_layer])
         component.remove_layers([label_layer])
 
-    # write component settings into text layer
     if with_settings_label:
-        settings = component.get_settings()
-
-        for i, k in enumerate(sorted(list(settings.keys()))):
-            v = settings.get(k)
-            text = f"{k} = {clean_value(v)}"
-            # print(text)
-            component.add_label(
-                text=text,
-                position=component.center - [0, i * 1],
-                layer=CONFIG["layers"]["TEXT"],
-            )
-
-    component.write_gds(
-        gdspath, precision=precision, auto_rename=auto_rename,
-    )
+        add_settings_label(component)
+
+    if streaming:
+        with GdsStreamWriter(gdspath, unit=unit, precision=precision) as writer:
+            writer.write(component)
+    else:
+        component.write_gds(
+            gdspath, precision=precision, auto_rename=auto_rename,
+        )
     component.path = gdspath
+    record_output(gdspath)
     return gdspath
 
 
+def add_settings_label(component: Component) -> None:
+    """ write component settings into text layer """
+    settings = component.get_settings()
+
+    for i, k in enumerate(sorted(list(settings.keys()))):
+        v = settings.get(k)
+        text = f"{k} = {clean_value(v)}"
+        # print(text)
+        component.add_label(
+            text=text,
+            position=component.center - [0, i * 1],
+            layer=CONFIG["layers"]["TEXT"],
+        )
+
+
+def _get_referenced_cells(cell: gdspy.Cell) -> Iterator[gdspy.Cell]:
+    """ yields the cells referenced by a cell (in reference order) """
+    for reference in cell.references:
+        if isinstance(reference.ref_cell, gdspy.Cell):
+            yield reference.ref_cell
+
+
+def get_cells_bottom_up(component: Component) -> Iterator[Component]:
+    """ yields a component and all its dependencies, each cell after its dependencies
+    the order is deterministic (depth first, in reference order)
+    """
+    visited = {id(component)}
+    stack = [(component, _get_referenced_cells(component))]
+    while stack:
+        cell, dependencies = stack[-1]
+        for dependency in dependencies:
+            if id(dependency) not in visited:
+                visited.add(id(dependency))
+                stack.append((dependency, _get_referenced_cells(dependency)))
+                break
+        else:
+            stack.pop()
+            yield cell
+
+
+class GdsStreamWriter:
+    """ writes components to a GDS stream, cell by cell
+
+    Each cell is written as soon as all its dependencies are written,
+    and the writer only remembers the name, a weak reference and a hash of
+    the GDS records of the written cells, so components can be written one
+    by one (as they are built) and released.
+
+    A cell with the name of a written cell is skipped if it is the same cell
+    or has the same GDS records (rebuilt after it was released), otherwise
+    write raises ValueError: a GDS can not have two cells with the same name.
+
+    Args:
+        gdspath: GDS file path (or binary file)
+        unit: unit size for the objects in the library (in meters)
+        precision: precision for the dimensions of the objects (in meters)
+        timestamp: GDS timestamp (defaults to now)
+        name: GDS library name
+
+    .. code::
+
+        with GdsStreamWriter("mask.gds") as writer:
+            for doe in does:
+                writer.write(build(doe))
+
+    """
+
+    def __init__(
+        self,
+        gdspath,
+        unit: float = 1e-6,
+        precision: float = 1e-9,
+        timestamp: Optional[datetime.datetime] = None,
+        name: str = "library",
+    ) -> None:
+        self.timestamp = timestamp or datetime.datetime.today()
+        self.cells = {}  # {name: (weak reference, hash)} of the written cells
+        self._writer = gdspy.GdsWriter(
+            gdspath,
+            name=name,
+            unit=unit,
+            precision=precision,
+            timestamp=self.timestamp,
+        )
+
+    def write(self, component: Component) -> None:
+        """ writes a component and the dependencies that were not written yet """
+        for cell in get_cells_bottom_up(component):
+            written = self.cells.get(cell.name)
+            if written is not None and written[0]() is cell:
+                continue
+            data = io.BytesIO()
+            cell.to_gds(data, self._writer._res, self.timestamp)
+            data = data.getvalue()
+            h = hashlib.sha1(data).digest()
+            if written is None:
+                self._writer._outfile.write(data)
+                self.cells[cell.name] = (weakref.ref(cell), h)
+            elif written[1] != h:
+                raise ValueError(
+                    f"Can not write {cell.name}: another cell named {cell.name}"
+                    " was already written with a different geometry"
+                )
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def __enter__(self) -> "GdsStreamWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
 def clean_value(value):
     if isinstance(value, Component):
         value = value.name
@@ -227,6 +455,71 @@ def clean_value(value):
     return value
 
 
+def test_write_gds_streaming(tmp_path):
+    import pytest
+    import pp
+
+    c = pp.c.mzi2x2()
+    gdspath1 = write_gds(c, tmp_path / "c1.gds")
+    gdspath2 = write_gds(c, tmp_path / "c2.gds", streaming=True)
+    assert gdspy.gdsii_hash(gdspath1) == gdspy.gdsii_hash(gdspath2)
+
+    cells = list(get_cells_bottom_up(c))
+    timestamp = datetime.datetime(2020, 10, 10)
+    gdspath3 = tmp_path / "c3.gds"
+    library = gdspy.GdsLibrary(name="library")
+    library.write_gds(str(gdspath3), cells=cells, timestamp=timestamp)
+    gdspath4 = tmp_path / "c4.gds"
+    with GdsStreamWriter(gdspath4, timestamp=timestamp) as writer:
+        writer.write(c)
+        writer.write(c)
+    assert gdspath3.read_bytes() == gdspath4.read_bytes()
+
+    c1 = pp.c.waveguide(length=5, name="wg", cache=False)
+    c2 = pp.c.waveguide(length=5, name="wg", cache=False)
+    c3 = pp.c.waveguide(length=6, name="wg", cache=False)
+    assert c1 is not c2
+    with GdsStreamWriter(tmp_path / "c5.gds") as writer:
+        writer.write(c1)
+        writer.write(c2)
+        with pytest.raises(ValueError):
+            writer.write(c3)
+
+
+def test_write_components(tmp_path):
+    import pp
+
+    components = [pp.c.waveguide(length=length) for length in [1, 2, 3]]
+    components += [pp.c.mzi2x2()]
+    timings = write_components(components, dirpath=tmp_path, processes=2)
+    for c in components:
+        gdspath = tmp_path / f"{c.name}.gds"
+        assert str(gdspath) in timings
+        assert gdspath.with_suffix(".json").exists()
+        assert gdspath.with_suffix(".ports").exists()
+        expected_gdspath = write_gds(c, tmp_path / "expected" / f"{c.name}.gds")
+        assert gdspy.gdsii_hash(gdspath) == gdspy.gdsii_hash(expected_gdspath)
+    assert not list(tmp_path.glob(".*.tmp.*"))
+
+
+def test_write_components_error(tmp_path, monkeypatch):
+    import sys
+    import pytest
+    import pp
+
+    def write_component_report(component, json_path):
+        pathlib.Path(json_path).write_text("{")
+        raise ValueError("report failed")
+
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, "write_component_report", write_component_report)
+    c = pp.c.waveguide(length=7.7)
+    with pytest.raises(ValueError):
+        write_components([c], dirpath=tmp_path, processes=1)
+    assert not list(tmp_path.glob("*"))
+    assert not list(tmp_path.glob(".*.tmp.*"))
+
+
 def show(
     component: Component, gdspath: PosixPath = CONFIG["gdspath"], **kwargs
 ) -> None:
@@ -236,6 +529,8 @@ def show(
         component
         gdspath: where to save the gds
     """
+    from pp import klive
+
     if isinstance(component, pathlib.Path):
         component = str(component)
         return klive.show(component)
@@ -1,14 +1,8 @@
 import json
 from pp.name import get_component_name
-from pp.components import component_type2factory
 from pp.write_component import write_component
 from pp.config import CONFIG
 from pp.doe import get_settings_list
-from pp.routing.add_fiber_array import add_fiber_array_te, add_fiber_array_tm
-
-name2function = dict(
-    add_fiber_array_te=add_fiber_array_te, add_fiber_array_tm=add_fiber_array_tm
-)
 
 
 def write_doe_metadata(
@@ -117,7 +111,7 @@ def write_doe(
     path=CONFIG["build_directory"],
     doe_metadata_path=CONFIG["doe_directory"],
     functions=None,
-    name2function=name2function,
+    name2function=None,
     **kwargs,
 ):
     """ writes each device GDS, together with metadata for each device:
@@ -140,8 +134,18 @@ def write_doe(
         path: to store build artifacts
         functions: list of function names to apply to DOE
         name2function: function names to functions dict
+            (add_fiber_array_te and add_fiber_array_tm by default)
         **kwargs: Doe default settings or variations
     """
+    from pp.components import component_type2factory
+
+    if name2function is None:
+        from pp.routing.add_fiber_array import add_fiber_array_te
+        from pp.routing.add_fiber_array import add_fiber_array_tm
+
+        name2function = dict(
+            add_fiber_array_te=add_fiber_array_te, add_fiber_array_tm=add_fiber_array_tm
+        )
     if hasattr(component_type, "__call__"):
         component_type = component_type.__name__
 